@@ -0,0 +1,121 @@
+#ifndef _ACQ_BufferPool_hh_
+#define _ACQ_BufferPool_hh_
+#include <vector>
+#include <boost/shared_ptr.hpp>
+#include <boost/weak_ptr.hpp>
+#include <boost/enable_shared_from_this.hpp>
+#include <boost/thread/mutex.hpp>
+#include <boost/bind.hpp>
+
+namespace acq {
+
+// Pool of pre-allocated slabs that the data socket reads into directly.
+// Slabs are handed out as shared_ptrs whose deleter returns the slab to the
+// pool, so whoever holds the last reference (e.g. a numpy array on the python
+// side) decides when the memory can be reused.  If the pool is destroyed
+// before all slabs are returned, the outstanding slabs are simply freed.
+//
+// At most num_slabs free slabs are kept: slabs allocated while the pool was
+// empty (because readers hold many, e.g. a writer queue or the ring) are
+// freed on release once the free list is full again, so the memory held
+// goes back down after a backlog.
+template <typename T>
+class buffer_pool : public boost::enable_shared_from_this< buffer_pool<T> >
+{
+public:
+  typedef std::vector<T> data_type;
+  typedef boost::shared_ptr<data_type> ptr_type;
+  typedef boost::weak_ptr< buffer_pool<T> > weak_type;
+
+  buffer_pool(size_t slab_size, size_t num_slabs) :
+    m_SlabSize(slab_size), m_MaxFree(num_slabs), m_Allocated(0),
+    m_Allocations(0)
+  {
+    m_Free.reserve(num_slabs);
+    for (size_t i=0;i<num_slabs;i++) {
+      m_Free.push_back(new data_type(slab_size));
+      m_Allocated++;
+    }
+  }
+
+  ~buffer_pool()
+  {
+    for (size_t i=0;i<m_Free.size();i++) delete m_Free[i];
+  }
+
+  // Get a slab of slab_size() elements.  Never blocks: if all slabs are in
+  // use a new one is allocated and kept (up to the pool size) on release.
+  ptr_type acquire()
+  {
+    data_type* p = 0;
+    {
+      boost::mutex::scoped_lock lock(m_mutex);
+      if (!m_Free.empty()) {
+        p = m_Free.back();
+        m_Free.pop_back();
+      } else {
+        m_Allocated++;
+        m_Allocations++;
+      }
+    }
+    if (!p) p = new data_type(m_SlabSize);
+    // Only grows if a previous read was short, does not reallocate
+    p->resize(m_SlabSize);
+    return ptr_type(p, boost::bind(&buffer_pool<T>::release,
+      weak_type(this->shared_from_this()), _1));
+  }
+
+  size_t slab_size() const { return m_SlabSize; }
+
+  size_t available() const
+  {
+    boost::mutex::scoped_lock lock(m_mutex);
+    return m_Free.size();
+  }
+
+  // Slabs currently allocated, in use or free
+  size_t allocated() const
+  {
+    boost::mutex::scoped_lock lock(m_mutex);
+    return m_Allocated;
+  }
+
+  // Slabs allocated because the pool was empty, beyond the initial ones
+  size_t allocations() const
+  {
+    boost::mutex::scoped_lock lock(m_mutex);
+    return m_Allocations;
+  }
+
+private:
+  buffer_pool(const buffer_pool&);              // Disabled copy constructor.
+  buffer_pool& operator = (const buffer_pool&); // Disabled assign operator.
+
+  static void release(weak_type wp, data_type* p)
+  {
+    boost::shared_ptr< buffer_pool<T> > pool = wp.lock();
+    if (!pool || !pool->put_back(p)) delete p;
+  }
+
+  bool put_back(data_type* p)
+  {
+    boost::mutex::scoped_lock lock(m_mutex);
+    if (m_Free.size() >= m_MaxFree) {
+      m_Allocated--;
+      return false;
+    }
+    m_Free.push_back(p);
+    return true;
+  }
+
+  size_t m_SlabSize;
+  size_t m_MaxFree;
+  size_t m_Allocated;
+  size_t m_Allocations;
+  std::vector<data_type*> m_Free;
+  mutable boost::mutex m_mutex;
+};
+
+}
+
+#endif /* _ACQ_BufferPool_hh_ */
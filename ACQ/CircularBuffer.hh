@@ -6,6 +6,7 @@
 #include <boost/thread/thread.hpp>
 #include <boost/call_traits.hpp>
 #include <boost/bind.hpp>
+#include <vector>
 
 namespace acq {
 
@@ -45,6 +46,9 @@ public:
           return false;
       }
       *pItem = m_container[--m_unread];
+      // Remove the element so the container does not keep (shared) buffers
+      // alive after they have been consumed.
+      m_container.pop_back();
       lock.unlock();
       m_not_full.notify_one();
       return true;
@@ -67,12 +71,43 @@ public:
       size_t element_count = 0;
       while (is_not_empty()) {
         f(m_container[--m_unread]);
+        m_container.pop_back();
         element_count += 1;
       }
       return element_count;
   }
 
 
+  // Block until at least one item is available, then move all pending items
+  // (oldest first) into batch.  batch is cleared first, reusing its storage,
+  // so no allocation happens once it has grown to the largest batch.
+  size_t consume_all_wait(std::vector<value_type>& batch)
+  {
+      batch.clear();
+      boost::mutex::scoped_lock lock(m_mutex);
+      m_not_empty.wait(lock, [this] () { return is_not_empty(); });
+      move_all_no_lock(batch);
+      lock.unlock();
+      m_not_full.notify_all();
+      return batch.size();
+  }
+
+  // As consume_all_wait, but appends to batch and waits at most until
+  // deadline.  Returns false if nothing arrived in time.
+  bool append_all_wait_until(std::vector<value_type>& batch,
+                             const boost::system_time& deadline)
+  {
+      boost::mutex::scoped_lock lock(m_mutex);
+      if (!m_not_empty.timed_wait(lock, deadline,
+          [this] () { return is_not_empty(); })) {
+          return false;
+      }
+      move_all_no_lock(batch);
+      lock.unlock();
+      m_not_full.notify_all();
+      return true;
+  }
+
   template <typename Functor>
   size_t consume_all(Functor & f)
   {
@@ -84,6 +119,14 @@ private:
   bounded_buffer(const bounded_buffer&);              // Disabled copy constructor.
   bounded_buffer& operator = (const bounded_buffer&); // Disabled assign operator.
 
+  void move_all_no_lock(std::vector<value_type>& batch)
+  {
+      while (is_not_empty()) {
+        batch.push_back(m_container[--m_unread]);
+        m_container.pop_back();
+      }
+  }
+
   bool is_not_empty() const { return m_unread > 0; }
   bool is_not_full() const { return m_unread < m_container.capacity(); }
 
@@ -5,10 +5,13 @@
 #include <boost/asio/read_until.hpp>
 #include <boost/asio/read.hpp>
 #include <boost/bind.hpp>
+#include <boost/make_shared.hpp>
 #include <boost/lexical_cast.hpp>
 #include <boost/asio/placeholders.hpp>
 #include <boost/date_time/posix_time/posix_time.hpp>
 #include <iostream>
+#include <stdexcept>
+#include <algorithm>
 #include <sstream>
 
 namespace acq {
@@ -65,6 +68,9 @@ void Device::ResetIPAddress(const std::string& ipAddr)
     }
   }
   m_numSites = m_Channels.size();
+  m_FrameSize = 1;
+  m_isRunning = false;
+  ResetStats();
   if (boost::lexical_cast<size_t>(SendCommand("data32")) == 0) {
     m_ReadoutSize = 2;
   } else {
@@ -73,6 +79,46 @@ void Device::ResetIPAddress(const std::string& ipAddr)
 }
 
 //-----------------------------------------------------------------
+void Device::ResetStats()
+{
+  m_BuffersRead = 0;
+  m_BytesRead = 0;
+  m_BuffersConsumed = 0;
+  m_Wakeups = 0;
+  m_PartialBytes = 0;
+  m_MaxQueueDepth = 0;
+  m_CallbackNs = 0;
+  m_MaxCallbackNs = 0;
+  m_StartTime = clock_type::now();
+}
+
+//-----------------------------------------------------------------
+void Device::UpdateMax(counter_type& m, uint64_t v)
+{
+  uint64_t cur = m.load();
+  while (v > cur && !m.compare_exchange_weak(cur, v)) {}
+}
+
+//-----------------------------------------------------------------
+Device::ReadoutStats Device::GetReadoutStats() const
+{
+  ReadoutStats st;
+  st.buffers = m_BuffersRead;
+  st.bytes = m_BytesRead;
+  uint64_t consumed = m_BuffersConsumed;
+  st.queue_depth = (st.buffers > consumed) ? st.buffers - consumed : 0;
+  st.max_queue_depth = m_MaxQueueDepth;
+  st.wakeups = m_Wakeups;
+  st.partial_bytes = m_PartialBytes;
+  // The state may be replaced by a new readout meanwhile
+  boost::shared_ptr<ReadoutState> rs = boost::atomic_load(&m_ReadoutState);
+  st.slabs = rs ? rs->Slabs() : 0;
+  st.slab_allocations = rs ? rs->SlabAllocations() : 0;
+  st.callback_time = m_CallbackNs*1e-9;
+  st.max_callback_time = m_MaxCallbackNs*1e-9;
+  st.elapsed = std::chrono::duration<double>(clock_type::now() - m_StartTime).count();
+  return st;
+}
 
 //-----------------------------------------------------------------
 std::string Device::IPAddress() const
@@ -101,45 +147,107 @@ std::string Device::SendCommand(const std::string& cmd)
 
 //-----------------------------------------------------------------
 template<typename T>
-void Device::BeginReadout(typename Device::DevTempl<T>::callback_functor func, size_t bufferSize)
+void Device::BeginReadout(typename Device::DevTempl<T>::callback_functor func,
+  size_t bufferSize, size_t poolSize, size_t frameSize)
 {
-  typedef typename DevTempl<T>::data_type dt;
-  typedef typename DevTempl<T>::ptr_type pt;
-  typedef bounded_buffer< dt* > queue_type;
+  typedef typename DevTempl<T>::batch_type bt;
+  BeginBatchedReadout<T>( [func] (const bt& batch) {
+      for (auto& dat : batch) func(dat);
+    }, bufferSize, poolSize, 0, frameSize);
+}
 
-  // Static so they don't go out of scope.  *Note*, these are *class* variables
-  // for a particular readout type (uint32/uint16)
-  static dt m_DataBuffer;
-  static queue_type m_Queue(4000);
-  static std::function<void ()> DoSingleRead;
+//-----------------------------------------------------------------
+template<typename T>
+void Device::BeginBatchedReadout(
+  typename Device::DevTempl<T>::batch_callback_functor func,
+  size_t bufferSize, size_t poolSize, double maxLatency, size_t frameSize)
+{
+  typedef typename DevTempl<T>::ptr_type pt;
+  typedef typename DevTempl<T>::pool_type pool_type;
+  typedef bounded_buffer< pt > queue_type;
+
+  // State of this readout, owned by the device (so several devices can read
+  // out at the same time) and kept until the next readout or destruction.
+  struct state_type : public ReadoutState {
+    state_type() : m_Queue(4000) {}
+    size_t Slabs() const { return m_Pool->allocated(); }
+    size_t SlabAllocations() const { return m_Pool->allocations(); }
+    boost::shared_ptr<pool_type> m_Pool;
+    queue_type m_Queue;
+    std::function<void ()> DoSingleRead;
+  };
 
-  // Empty the queue
-  auto emptyQ = [] (dt*) {; };
-  m_Queue.consume_all_no_lock(emptyQ);
+  if (m_isRunning) {
+    throw std::runtime_error("Readout already running");
+  }
+  // A previous readout that ended on its own
+  if (m_workerThread.joinable()) m_workerThread.join();
+
+  // Only whole frames are handed on, so slabs hold a whole number of them.
+  // Without a frame size from the caller, NCHAN (which depends on the sites
+  // set with run0) is the frame size.
+  m_FrameSize = frameSize;
+  if (m_FrameSize == 0) {
+    try {
+      m_FrameSize = boost::lexical_cast<size_t>(SendCommand("NCHAN"));
+    } catch (boost::bad_lexical_cast &) {
+      m_FrameSize = 0;
+    }
+  }
+  if (m_FrameSize == 0) m_FrameSize = 1;
+  bufferSize = std::max(bufferSize, m_FrameSize);
+  bufferSize -= bufferSize % m_FrameSize;
 
   mutex::scoped_lock sL(m_DataSocketMutex);
   m_DataSocket.reset( new sock_type( m_IOService ) );
-  assert(ReadoutSize() == sizeof(m_DataBuffer[0]));
+  assert(ReadoutSize() == sizeof(T));
 
   //StopReadout();
 
-  // Resize local buffer
-  m_DataBuffer.resize(bufferSize);
+  // New pool of slabs, slabs still held from a previous readout are freed
+  // once released.
+  boost::shared_ptr<state_type> state = boost::make_shared<state_type>();
+  state->m_Pool = boost::make_shared<pool_type>(bufferSize, poolSize);
+  state_type* st = state.get();
+  // Handlers of the previous readout may still be finishing on the I/O
+  // thread, so its state is released from there
+  boost::shared_ptr<ReadoutState> previous = m_ReadoutState;
+  boost::atomic_store(&m_ReadoutState, boost::shared_ptr<ReadoutState>(state));
+  m_IOService.post([previous] () {});
 
   /////////////////////////////////////////////////////////////////
   // DoSingleRead lambda
   // Analysis thread
-  auto AnalysisThread = [&,this,func]()
+  auto AnalysisThread = [this,st,func,maxLatency]()
   {
-    auto ConsumeFromQueue = [func] (dt* dat) {
-      if (!dat || dat->size() == 0) throw socket_complete();
-      func(pt(dat));
-    };
     try {
+      // Sleep on the queue until data arrives, then handle everything that
+      // is pending in one go
+      std::vector<pt> batch;
       while (1) {
-        if( !m_Queue.consume_one( ConsumeFromQueue ) ) {
-          boost::this_thread::sleep(boost::posix_time::milliseconds(1));
+        st->m_Queue.consume_all_wait(batch);
+        m_Wakeups++;
+        if (maxLatency > 0) {
+          boost::system_time deadline = boost::get_system_time() +
+            boost::posix_time::microseconds(int64_t(maxLatency*1e6));
+          while (batch.back() && batch.back()->size() != 0 &&
+                 st->m_Queue.append_all_wait_until(batch, deadline));
+        }
+        // A null (or empty) buffer marks the end of the readout
+        auto end = std::find_if(batch.begin(), batch.end(),
+          [] (const pt& dat) { return !dat || dat->size() == 0; });
+        bool complete = (end != batch.end());
+        batch.erase(end, batch.end());
+        if (!batch.empty()) {
+          clock_type::time_point start = clock_type::now();
+          func(batch);
+          uint64_t ns = std::chrono::duration_cast<std::chrono::nanoseconds>(
+                          clock_type::now() - start).count();
+          m_CallbackNs += ns;
+          UpdateMax(m_MaxCallbackNs, ns);
+          m_BuffersConsumed += batch.size();
         }
+        if (complete) throw socket_complete();
       }
     } catch (socket_complete&) {
       // If we get here the socket has been closed, consume the rest of the data
@@ -166,46 +274,57 @@ void Device::BeginReadout(typename Device::DevTempl<T>::callback_functor func, s
 
   boost::asio::connect(*m_DataSocket, endpts);
   m_DataRead = 0;
+  ResetStats();
 
   // Start processing thread
   m_isRunning = true;
   m_workerThread = boost::thread(AnalysisThread);
-  DoSingleRead = [&]()
+  st->DoSingleRead = [this,st]()
   {
-    auto HandleRead = [&](const boost::system::error_code& error,
+    // Read directly into a slab, which is then handed on without copying
+    pt slab = st->m_Pool->acquire();
+    auto HandleRead = [this,st,slab](const boost::system::error_code& error,
                   std::size_t bytes_transferred) {
-      if (bytes_transferred > 0) {
-        m_Queue.push( new dt(m_DataBuffer.begin(),
-          m_DataBuffer.begin() + bytes_transferred/sizeof(m_DataBuffer[0])) );
+      // async_read only returns less than a full slab when the stream
+      // ends, a partial frame at the end can never be completed and is
+      // dropped.
+      size_t frameBytes = m_FrameSize*sizeof(T);
+      size_t wholeBytes = bytes_transferred - bytes_transferred % frameBytes;
+      m_BytesRead += bytes_transferred;
+      m_PartialBytes += bytes_transferred - wholeBytes;
+      if (wholeBytes > 0) {
+        slab->resize(wholeBytes/sizeof(T));
+        uint64_t depth = ++m_BuffersRead - m_BuffersConsumed;
+        UpdateMax(m_MaxQueueDepth, depth);
+        st->m_Queue.push( slab );
       }
-      if (error == 0) {
-        DoSingleRead();
+      if (!error) {
+        st->DoSingleRead();
       } else {
         std::cout << "Was shutdown, ec=" << error << std::endl;
         // This means we were shut down.
         // Make sure we insert a new set of data so it gets processed.
-        m_Queue.push( new dt() );
+        st->m_Queue.push( pt() );
       }
     };
 
     boost::asio::async_read(
           *m_DataSocket,
-          boost::asio::buffer(m_DataBuffer,
-            m_DataBuffer.size()*sizeof(m_DataBuffer[0])),
+          boost::asio::buffer(&(*slab)[0], slab->size()*sizeof(T)),
             HandleRead);
   };
 
-  DoSingleRead();
+  st->DoSingleRead();
 }
 
 //-----------------------------------------------------------------
-void Device::BeginReadout(size_t bufferSize)
+void Device::BeginReadout(size_t bufferSize, size_t poolSize, size_t frameSize)
 {
   #define BEGINREADOUTYPE(atype) \
     case sizeof(atype):          \
       BeginReadout<atype>( [this] (DevTempl<atype>::ptr_type pt) { \
         m_DataRead += pt->size();                                  \
-      }, bufferSize); break;
+      }, bufferSize, poolSize, frameSize); break;
   switch(ReadoutSize()) {
     BEGINREADOUTYPE(int16_t)
     BEGINREADOUTYPE(int32_t)
@@ -247,10 +366,13 @@ void Device::Cleanup()
   m_DataSocket.reset();
   m_IOWork.reset();
   m_IOThread.join();
+  // Pending reads were aborted, which ends the analysis thread
+  if (m_workerThread.joinable()) m_workerThread.join();
 }
 
 #define INSTANTIATE_TEMPLATE(atype) \
-template void Device::BeginReadout<atype>(Device::DevTempl<atype>::callback_functor, size_t);
+template void Device::BeginReadout<atype>(Device::DevTempl<atype>::callback_functor, size_t, size_t, size_t); \
+template void Device::BeginBatchedReadout<atype>(Device::DevTempl<atype>::batch_callback_functor, size_t, size_t, double, size_t);
 
 INSTANTIATE_TEMPLATE(int16_t)
 INSTANTIATE_TEMPLATE(int32_t)
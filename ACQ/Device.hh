@@ -2,12 +2,15 @@
 #define _ACQ_Device_hh_
 
 #include <string>
+#include <atomic>
+#include <chrono>
 #include <boost/asio/ip/tcp.hpp>
 #include <boost/thread.hpp>
 #include <boost/thread/mutex.hpp>
 #include <boost/function.hpp>
 #include <boost/scoped_ptr.hpp>
 #include "CircularBuffer.hh"
+#include "BufferPool.hh"
 
 namespace acq {
 
@@ -20,6 +23,9 @@ class Device {
         typedef typename std::vector< T > data_type;
         typedef typename boost::shared_ptr< data_type > ptr_type;
         typedef typename boost::function< void (ptr_type) > callback_functor;
+        typedef typename std::vector< ptr_type > batch_type;
+        typedef typename boost::function< void (const batch_type&) > batch_callback_functor;
+        typedef buffer_pool< T > pool_type;
 
     };
 
@@ -31,22 +37,66 @@ class Device {
 
     std::string IPAddress() const;
 
-    void BeginReadout(size_t bufferSize = 1024*1024);
+    void BeginReadout(size_t bufferSize = 1024*1024, size_t poolSize = 16,
+                      size_t frameSize = 0);
 
 	// Following function will abort if the correct size (in typename) isn't
 	// called.  At the moment, only int16_t and int32_t are implemented
+	//
+	// The socket reads directly into slabs of bufferSize elements taken from
+	// a pool of (initially) poolSize slabs.  The buffer passed to func *is*
+	// the slab, it is returned to the pool when the last reference is
+	// released.
+	//
+	// Buffers hold whole frames of frameSize samples, the frame size the
+	// caller uses to de-interleave them.  With frameSize 0, NCHAN of the
+	// device is used.
 	template<typename T>
     void BeginReadout(
             typename DevTempl<T>::callback_functor func,
-            size_t bufferSize = 1024*1024);
+            size_t bufferSize = 1024*1024,
+            size_t poolSize = 16,
+            size_t frameSize = 0);
+
+	// As BeginReadout, but func is called with all buffers that arrived
+	// since the last call.  If maxLatency (s) is > 0, buffers are collected
+	// until the first of them has waited maxLatency, so func is called at
+	// most every maxLatency seconds.
+	template<typename T>
+    void BeginBatchedReadout(
+            typename DevTempl<T>::batch_callback_functor func,
+            size_t bufferSize = 1024*1024,
+            size_t poolSize = 16,
+            double maxLatency = 0,
+            size_t frameSize = 0);
 
     void StopReadout();
 
     bool IsRunning() const;
 
+    // Statistics of the current (or last) readout
+    struct ReadoutStats {
+      uint64_t buffers;          // buffers read from the socket
+      uint64_t bytes;            // bytes read from the socket
+      size_t queue_depth;        // buffers waiting for the callback
+      size_t max_queue_depth;
+      uint64_t wakeups;          // times the callback thread woke up
+      uint64_t partial_bytes;    // bytes of an incomplete last frame
+      size_t slabs;              // slabs allocated, in use or free
+      size_t slab_allocations;   // slabs allocated beyond the pool size
+      double callback_time;      // total time spent in the callback (s)
+      double max_callback_time;
+      double elapsed;            // time since BeginReadout (s)
+    };
+
+    ReadoutStats GetReadoutStats() const;
+
     size_t NumSites() const { return m_numSites; }
     size_t NumChannels(size_t site_no) const { return m_Channels[site_no]; }
     size_t ReadoutSize() const { return m_ReadoutSize; }
+    // Samples per frame of the current (or last) readout, buffers passed to
+    // the callback always contain a whole number of frames
+    size_t FrameSize() const { return m_FrameSize; }
   protected:
 
     // Disable copy operator
@@ -73,10 +123,34 @@ class Device {
     chan_number_type m_Channels;
     size_t m_numSites;
     size_t m_ReadoutSize;
+    size_t m_FrameSize;
 
     boost::thread m_IOThread;
     bool m_isRunning;
 
+    // Queue, slab pool, ... of the current readout, see BeginBatchedReadout
+    struct ReadoutState {
+      virtual ~ReadoutState() {}
+      virtual size_t Slabs() const = 0;
+      virtual size_t SlabAllocations() const = 0;
+    };
+    boost::shared_ptr<ReadoutState> m_ReadoutState;
+
+    typedef std::chrono::steady_clock clock_type;
+    typedef std::atomic<uint64_t> counter_type;
+    counter_type m_BuffersRead;
+    counter_type m_BytesRead;
+    counter_type m_BuffersConsumed;
+    counter_type m_Wakeups;
+    counter_type m_PartialBytes;
+    counter_type m_MaxQueueDepth;
+    counter_type m_CallbackNs;
+    counter_type m_MaxCallbackNs;
+    clock_type::time_point m_StartTime;
+
+    void ResetStats();
+    static void UpdateMax(counter_type& m, uint64_t v);
+
     void ResetIPAddress(const std::string& ipAddr);
     void Cleanup();
 
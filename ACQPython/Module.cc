@@ -22,7 +22,17 @@ template< typename T >
 struct DataType_to_python_dat
 {
     typedef typename Device::DevTempl<T>::data_type dt;
-    static object convertObj(const dt& s)
+    typedef typename Device::DevTempl<T>::ptr_type pt;
+
+    static void releaseOwner(PyObject* cap)
+    {
+      delete static_cast<pt*>(PyCapsule_GetPointer(cap, NULL));
+    }
+
+    // The returned array shares the memory of s.  If owner is given, the
+    // array holds a reference to it (as its base object) so that the memory
+    // stays valid, and is returned to its pool, when the array is deleted.
+    static object convertObj(const dt& s, const pt& owner = pt())
     {
         npy_intp p = (npy_intp)s.size();
         PyObject* py_buffer;
@@ -33,6 +43,10 @@ struct DataType_to_python_dat
             (sizeof(s[0]) == 2) ? NPY_INT16 : NPY_INT32, // type
             (void*)&s[0] // address
           );
+          if (py_buffer && owner) {
+            PyObject* base = PyCapsule_New(new pt(owner), NULL, &releaseOwner);
+            PyArray_SetBaseObject((PyArrayObject*)py_buffer, base);
+          }
         } else {
           py_buffer = PyArray_SimpleNew(
             1, // dimension
@@ -61,9 +75,10 @@ class dev_buffer
       return _ptr->size();
     }
 
+    // Zero-copy, the array keeps the underlying buffer alive
     object vec()
     {
-      return DataType_to_python_dat<T>::convertObj(*_ptr);
+      return DataType_to_python_dat<T>::convertObj(*_ptr, _ptr);
     }
 
   private:
@@ -74,19 +89,46 @@ class dev_buffer
 class PyDevice: public Device
 {
   public:
-    PyDevice(const std::string& ip) : Device(ip) {}
+    PyDevice(const std::string& ip) : Device(ip) { ResetGilStats(); }
+    PyDevice(const PyDevice& dev) : Device(dev), _func(dev._func) { ResetGilStats(); }
     void beginReadoutWrapper( object function,
-      uint64_t buffer_size = 1024*1024 )
+      uint64_t buffer_size = 1024*1024,
+      uint64_t pool_size = 16,
+      bool batch = false,
+      double max_latency = 0,
+      uint64_t frame_size = 0 )
     {
         _func = function;
-        #define READOUTTYPE(atype)                            \
-        case sizeof(atype):                                   \
-          BeginReadout<atype>( [this]                         \
-              (DevTempl<atype>::ptr_type pt) {                \
-            ensure_gil_state gS;                              \
-            typedef dev_buffer<atype> db;                     \
-            _func(boost::make_shared<db>(pt));                \
-          }, buffer_size); break;
+        ResetGilStats();
+        // The time waiting for the GIL and the time holding it (i.e. running
+        // python) are recorded separately.  When batching, the GIL is taken
+        // once for all buffers and function gets a list of them.
+        #define READOUTTYPE(atype)                                    \
+        case sizeof(atype):                                           \
+          if (batch) {                                                \
+            BeginBatchedReadout<atype>( [this]                        \
+                (const DevTempl<atype>::batch_type& bt) {             \
+              clock_type::time_point t0 = clock_type::now();          \
+              ensure_gil_state gS;                                    \
+              clock_type::time_point t1 = clock_type::now();          \
+              typedef dev_buffer<atype> db;                           \
+              list l;                                                 \
+              for (auto& pt : bt) l.append(boost::make_shared<db>(pt)); \
+              _func(l);                                               \
+              RecordGil(t0, t1, clock_type::now());                   \
+            }, buffer_size, pool_size, max_latency, frame_size);      \
+          } else {                                                    \
+            BeginReadout<atype>( [this]                               \
+                (DevTempl<atype>::ptr_type pt) {                      \
+              clock_type::time_point t0 = clock_type::now();          \
+              ensure_gil_state gS;                                    \
+              clock_type::time_point t1 = clock_type::now();          \
+              typedef dev_buffer<atype> db;                           \
+              _func(boost::make_shared<db>(pt));                      \
+              RecordGil(t0, t1, clock_type::now());                   \
+            }, buffer_size, pool_size, frame_size);                   \
+          }                                                           \
+          break;
 
         switch( ReadoutSize() ) {
           READOUTTYPE(int16_t)
@@ -105,9 +147,58 @@ class PyDevice: public Device
       release_gil_policy sL;
       return Device::StopReadout();
     }
+
+    dict readoutStats() const
+    {
+      ReadoutStats st = GetReadoutStats();
+      dict d;
+      d["buffers"] = st.buffers;
+      d["bytes"] = st.bytes;
+      d["queue_depth"] = st.queue_depth;
+      d["max_queue_depth"] = st.max_queue_depth;
+      d["wakeups"] = st.wakeups;
+      d["partial_bytes"] = st.partial_bytes;
+      d["slabs"] = st.slabs;
+      d["slab_allocations"] = st.slab_allocations;
+      d["callback_time"] = st.callback_time;
+      d["max_callback_time"] = st.max_callback_time;
+      d["elapsed"] = st.elapsed;
+      d["gil_wait_time"] = _gilWaitNs*1e-9;
+      d["max_gil_wait_time"] = _maxGilWaitNs*1e-9;
+      d["gil_hold_time"] = _gilHoldNs*1e-9;
+      d["max_gil_hold_time"] = _maxGilHoldNs*1e-9;
+      return d;
+    }
+
   protected:
     object _func;
 
+    counter_type _gilWaitNs;
+    counter_type _maxGilWaitNs;
+    counter_type _gilHoldNs;
+    counter_type _maxGilHoldNs;
+
+    void ResetGilStats()
+    {
+      _gilWaitNs = 0;
+      _maxGilWaitNs = 0;
+      _gilHoldNs = 0;
+      _maxGilHoldNs = 0;
+    }
+
+    void RecordGil(clock_type::time_point t0, clock_type::time_point t1,
+                   clock_type::time_point t2)
+    {
+      using std::chrono::duration_cast;
+      using std::chrono::nanoseconds;
+      uint64_t wait = duration_cast<nanoseconds>(t1 - t0).count();
+      uint64_t hold = duration_cast<nanoseconds>(t2 - t1).count();
+      _gilWaitNs += wait;
+      UpdateMax(_maxGilWaitNs, wait);
+      _gilHoldNs += hold;
+      UpdateMax(_maxGilHoldNs, hold);
+    }
+
 };
 
 
@@ -136,8 +227,12 @@ BOOST_PYTHON_MODULE(pyacq)
     .def("NumChannels", &PyDevice::NumChannels)
     .def("IsRunning", &PyDevice::IsRunning)
     .def("ReadoutSize", &PyDevice::ReadoutSize)
+    .def("FrameSize", &PyDevice::FrameSize)
+    .def("ReadoutStats", &PyDevice::readoutStats)
     .def("BeginReadout", &PyDevice::beginReadoutWrapper,
-      ( arg( "function" ), arg( "buffer_size" ) ));
+      ( arg( "function" ), arg( "buffer_size" ),
+        arg( "pool_size" ) = 16, arg( "batch" ) = false,
+        arg( "max_latency" ) = 0., arg( "frame_size" ) = 0 ));
 
   define_buffer<int16_t>("DevBuffer_16");
   define_buffer<int32_t>("DevBuffer_32");
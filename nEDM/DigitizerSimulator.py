@@ -0,0 +1,40 @@
+"""
+  Runs simulated D-TACQ digitizers, for testing and benchmarking the readout
+  without hardware.  Each simulator listens on its own address, e.g.
+
+    python DigitizerSimulator.py ACQ425ELF@127.0.0.2 ACQ437ELF@127.0.0.3
+"""
+
+from dtacq.simulator import SimulatedDigitizer, personalities
+
+if __name__ == '__main__':
+   import argparse
+   import logging
+   import time
+
+   parser = argparse.ArgumentParser(description=__doc__,
+     formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("devices", nargs="+",
+     help="PERSONALITY@ADDRESS, personality one of {}".format(
+       ", ".join(sorted(personalities))))
+   parser.add_argument("--rate", type=float, default=None,
+     help="frame rate in Hz (0: as fast as possible), default from clkdiv")
+   parser.add_argument("--drop-every", type=int, default=0,
+     help="skip a sample counter every N frames")
+   args = parser.parse_args()
+
+   logging.basicConfig(level=logging.INFO)
+   sims = []
+   for d in args.devices:
+      personality, address = d.split("@")
+      sim = SimulatedDigitizer(personality, address, rate=args.rate,
+                               drop_every=args.drop_every)
+      sim.start()
+      sims.append(sim)
+
+   try:
+      while True:
+         time.sleep(1)
+   except KeyboardInterrupt:
+      for s in sims:
+         s.stop()
@@ -110,11 +110,11 @@ class ReadoutObj(object):
         buffer_size = kw.get("buffer_size", 1*1024*1024)
         bytes_per_frame = self.total_ch*2
         buffer_size += (bytes_per_frame - (buffer_size % bytes_per_frame))
-        self.last_offset = 0
         self.last_counter = 0
         self._exc = None
 
-        self.dev.BeginReadout(function=self, buffer_size=buffer_size)
+        self.dev.BeginReadout(function=self, buffer_size=buffer_size,
+                              frame_size=self.total_ch)
         self.isRunning = True
 
     def stopReadout(self, **kw):
@@ -123,13 +123,8 @@ class ReadoutObj(object):
 
     def _writeToFile(self, v, afile, ch_list):
         try:
+            # Buffers hold whole frames
             ch = self.total_ch
-            # if we get stopped, it's possible we don't have all the data
-            # make sure we're aligned
-            at_end = len(v) % ch
-            if at_end != 0:
-                # truncating end
-                v = v[:-at_end]
             t = numpy.array([v[c::ch] for c in ch_list])
             t.T.tofile(afile)
         except Exception as e:
@@ -142,15 +137,8 @@ class ReadoutObj(object):
            if len(x) == 0: return
            v = x.vec()
            print("Read in ({})".format(v))
-           if self.last_offset != 0:
-               raise ReadoutException("Buffer not aligned")
            self._validateData(v)
            #self._writeToFile(v, self.open_file, self.doc_to_save["channel_list"])
-           ch = self.total_ch
-           start_pt = (ch - self.last_offset) % ch
-           end_pt = (len(v)-start_pt) % ch
-           t = v[start_pt:]
-           self.last_offset += end_pt
         except Exception as e:
            self._exc = traceback.format_exc()
            print self._exc
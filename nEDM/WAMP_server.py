@@ -5,6 +5,13 @@
 from dtacq import ShipData
 
 if __name__ == '__main__':
+   # Fork the processing workers first, while the server has no threads
+   # or sockets yet
+   from dtacq.settings import processing_workers, processing_slot_mb
+   from dtacq.pool import start_pool
+   start_pool(int(processing_workers or 0),
+              slot_bytes=int(float(processing_slot_mb or 16)*1024*1024))
+
    from twisted.python import log
    from twisted.internet import reactor
    import sys
@@ -16,4 +23,9 @@ if __name__ == '__main__':
    factory.protocol = ShipData
 
    reactor.listenTCP(port=9000, factory=factory)
+
+   # Send files whose upload did not finish before the last shutdown
+   from dtacq.database import UploadClass
+   from dtacq.uploader import get_uploader
+   reactor.callWhenRunning(get_uploader(UploadClass._acct).resumePending)
    reactor.run()
@@ -0,0 +1,107 @@
+"""
+  Compression ratio and throughput of compressed .dig files
+  (dtacq.codec) on simulated data.
+
+  The data imitates an ACQ437ELF recording: 24 bit samples in the upper
+  bits of int32 words (low byte constant), every channel a slow sine plus
+  Gaussian noise of --noise LSB.  For every compression level, the
+  encoding MB/s (of raw data) through a BlockWriter with 1..--workers
+  threads and the decoding MB/s of the file are reported.
+
+  Usage: python bench_compress.py [--channels 32] [--seconds 10]
+           [--noise 8] [--levels 1 6] [--workers 4]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.codec import BlockWriter
+from dtacq.writer import AsyncFileWriter
+from dtacq.digfile import DigFile
+
+
+def simulated(nch, nframes, rate, noise, dtype, shift):
+    t = numpy.arange(nframes)[:, None]/rate
+    freq = numpy.linspace(0.5, 60., nch)[None, :]
+    amp = 2**(8*numpy.dtype(dtype).itemsize - shift - 3)
+    sig = amp*numpy.sin(2*numpy.pi*freq*t) + numpy.random.normal(0, noise, (nframes, nch))
+    return (sig.astype(numpy.int64) << shift).astype(dtype)
+
+
+def write(fn, data, chunk, **opts):
+    w = BlockWriter(AsyncFileWriter(), **opts)
+    hdr = dict(channel_list=list(range(data.shape[1])), version=2,
+               byte_depth=data.itemsize, is_float=False, codec=w.codec(),
+               index=True)
+    hdr = json.dumps(hdr)
+    hdr += " "*(-len(hdr) % 4)
+    start = time.time()
+    w.open(fn, numpy.array([len(hdr)], dtype=numpy.uint32).tostring() + hdr)
+    for s in range(0, len(data), chunk):
+        w.write(data[s:s+chunk])
+    w.close().wait()
+    elapsed = time.time() - start
+    w.stop()
+    return elapsed, w.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=48828.125,
+      help="sample rate (Hz)")
+    parser.add_argument("--seconds", type=float, default=10.)
+    parser.add_argument("--noise", type=float, default=8.,
+      help="noise (LSB of the 24 bit samples)")
+    parser.add_argument("--int16", action="store_true",
+      help="int16 samples (ACQ425ELF) instead")
+    parser.add_argument("--block-frames", type=int, default=65536)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    dtype, shift = (numpy.int16, 0) if args.int16 else (numpy.int32, 8)
+    data = simulated(args.channels, int(args.seconds*args.rate), args.rate,
+                     args.noise, dtype, shift)
+    # About 20 ms buffers, as from the readout
+    chunk = max(int(args.rate/50), 1)
+    fn = os.path.join(tempfile.mkdtemp(), "bench.dig")
+
+    fmt = "{:>6}{:>9}{:>8}{:>12}{:>12}"
+    print("{:.1f} MB of {} channels".format(data.nbytes/1e6, args.channels))
+    print(fmt.format("level", "workers", "ratio", "enc MB/s", "dec MB/s"))
+    results = []
+    try:
+        for level in args.levels:
+            for workers in range(1, args.workers + 1):
+                elapsed, stats = write(fn, data, chunk, level=level,
+                                       workers=workers,
+                                       block_frames=args.block_frames)
+                start = time.time()
+                out = DigFile(fn).read()
+                dec = time.time() - start
+                if not numpy.array_equal(out, data):
+                    raise AssertionError("Decoded data differs")
+                r = dict(level=level, workers=workers, ratio=stats["ratio"],
+                         encode_MBps=data.nbytes/elapsed/1e6,
+                         decode_MBps=data.nbytes/dec/1e6)
+                results.append(r)
+                print(fmt.format(level, workers, "{:.2f}".format(r["ratio"]),
+                  "{:.0f}".format(r["encode_MBps"]), "{:.0f}".format(r["decode_MBps"])))
+    finally:
+        if os.path.exists(fn):
+            os.remove(fn)
+        os.rmdir(os.path.dirname(fn))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+  Throughput (MB/s of raw buffer) of downsampling before writing .dig files
+  on 80 channel LIA data (int16, no spad), comparing the block mean
+  (downsample_filter="mean") with the stateful FIR Decimator
+  (downsample_filter="fir") computing in float64 and float32.  The
+  level (dB) of a tone at 1.6 times the output Nyquist frequency, which
+  aliases into the passband, is given for each.
+
+  Usage: python bench_decimate.py [--buffer-size N] [--repeat N]
+           [--factors 10 100 1000]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.processing import deinterleave, frames, select_channels, Decimator
+
+total_ch = 80
+
+
+def throughput(func, bufs, repeat):
+    func(bufs[0])
+    start = time.time()
+    for i in range(repeat):
+        func(bufs[i % len(bufs)])
+    return bufs[0].nbytes*repeat/(time.time() - start)/1e6
+
+
+def alias_rejection(process, factor, nframes):
+    # Tone at 1.6 times the output Nyquist frequency
+    t = numpy.arange(nframes)
+    x = (10000*numpy.sin(numpy.pi*1.6*t/factor)).astype(numpy.int16)
+    y = process(numpy.repeat(x[:, None], total_ch, axis=1).ravel())[:, 0]
+    y = y[len(y)//4:]
+    return 20*numpy.log10(max(numpy.abs(y).max(), 1e-12)/10000.)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buffer-size", type=int, default=1024*1024,
+      help="samples per buffer")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--factors", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    ch_list = list(range(total_ch))
+    fmt = "{:>7}{:>14}{:>12}{:>12}"
+    print(fmt.format("factor", "method", "MB/s", "alias dB"))
+    for ds in args.factors:
+        # Whole blocks per buffer, as startReadout ensures
+        nframes = args.buffer_size // total_ch
+        nframes -= nframes % ds
+        bufs = [numpy.random.randint(-2**15, 2**15, size=nframes*total_ch).astype(numpy.int16)
+                for _ in range(4)]
+        methods = [("mean", lambda: (lambda v: deinterleave(v, total_ch, ch_list, ds)))]
+        for dt in (numpy.float64, numpy.float32):
+            def make(dt=dt):
+                dec = Decimator(ds, total_ch, dtype=dt)
+                return lambda v: dec.process(select_channels(frames(v, total_ch), ch_list))
+            methods.append(("fir " + numpy.dtype(dt).name, make))
+        for name, make in methods:
+            mbps = throughput(make(), bufs, args.repeat)
+            rej = alias_rejection(make(), ds, max(nframes, 200*ds))
+            print(fmt.format(ds, name, "{:.0f}".format(mbps), "{:.0f}".format(rej)))
+
+if __name__ == '__main__':
+    main()
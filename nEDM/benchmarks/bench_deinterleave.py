@@ -0,0 +1,72 @@
+"""
+  Throughput (MB/s of raw buffer) of the channel de-interleave and
+  downsampling done before writing .dig files, comparing the previous
+  per-channel implementation with dtacq.processing.deinterleave.
+
+  Usage: python bench_deinterleave.py [--buffer-size N] [--repeat N]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.processing import deinterleave
+
+# (sample type, spad words appended to each frame)
+layouts = {
+  "ACQ425ELF"    : (numpy.int16, 4),
+  "ACQ425ELFLIA" : (numpy.int16, 0),
+  "ACQ437ELF"    : (numpy.int32, 2),
+}
+
+def legacy(v, ch, ch_list, ds):
+    at_end = len(v) % ch
+    if at_end != 0:
+        v = v[:-at_end]
+    if ds == 1:
+        t = numpy.array([v[c::ch] for c in ch_list])
+    else:
+        ds_end = len(v) % (ds*ch)
+        if ds_end != 0:
+            v = v[:-ds_end]
+        t = numpy.array([v[c::ch].reshape(-1, ds).mean(axis=1) for c in ch_list])
+    return numpy.ascontiguousarray(t.T)
+
+def timeit(func, v, repeat):
+    func(v)
+    start = time.time()
+    for _ in range(repeat):
+        func(v)
+    return v.nbytes*repeat/(time.time() - start)/1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buffer-size", type=int, default=1024*1024,
+      help="samples per buffer")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--downsample", type=int, nargs="+", default=[1, 10])
+    args = parser.parse_args()
+
+    fmt = "{:<14}{:>6}{:>5}{:>10}{:>12}{:>12}{:>12}"
+    print(fmt.format("layout", "chans", "ds", "legacy", "float64", "float32", "speedup"))
+    for name in sorted(layouts):
+        dtype, spad = layouts[name]
+        for nch in (32, 64, 80):
+            total_ch = nch + spad
+            v = numpy.random.randint(-2**15, 2**15,
+                  size=args.buffer_size - args.buffer_size % total_ch).astype(dtype)
+            ch_list = list(range(nch))
+            for ds in args.downsample:
+                old = timeit(lambda x: legacy(x, total_ch, ch_list, ds), v, args.repeat)
+                new = timeit(lambda x: deinterleave(x, total_ch, ch_list, ds), v, args.repeat)
+                new32 = timeit(lambda x: deinterleave(x, total_ch, ch_list, ds, numpy.float32),
+                               v, args.repeat)
+                print(fmt.format(name, nch, ds, "{:.0f}".format(old),
+                  "{:.0f}".format(new), "{:.0f}".format(new32),
+                  "{:.1f}x".format(new/old)))
+
+if __name__ == '__main__':
+    main()
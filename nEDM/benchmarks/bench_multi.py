@@ -0,0 +1,96 @@
+"""
+  Aggregate throughput of several digitizers read out concurrently by one
+  process.  For 1..N simulated digitizers (one DigitizerSimulator.py process
+  each, on 127.0.0.2, 127.0.0.3, ...) all readouts run at the same time, the
+  total and per-device MB/s, queue depths and GIL wait times are reported.
+
+  Usage: python bench_multi.py [--devices 4] [--rate 0] [--duration 10]
+           [--buffer-size N] [--output bench_multi.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+from dtacq.readout import ReadoutObj
+from bench_pipeline import wait_for_port, git_revision
+
+
+def run(args, ndev):
+    addrs = ["127.0.0.{}".format(2 + i) for i in range(ndev)]
+    sims = [subprocess.Popen([sys.executable,
+              os.path.join(here, "..", "DigitizerSimulator.py"),
+              "{}@{}".format(args.personality, a), "--rate", str(args.rate)])
+            for a in addrs]
+    objs = []
+    try:
+        for a in addrs:
+            wait_for_port(a, 4220)
+            objs.append(ReadoutObj(a))
+        for o in objs:
+            o.startReadout(mod_list=sorted(o.available_modules),
+                           buffer_size=args.buffer_size,
+                           callback_latency=args.callback_latency)
+        time.sleep(args.duration)
+        stats = [o.dev.ReadoutStats() for o in objs]
+        errors = [o._exc for o in objs]
+        for o in objs:
+            o.stopReadout()
+        for o in objs:
+            while o.dev.IsRunning():
+                time.sleep(0.05)
+    finally:
+        for o in objs:
+            o.safeShutdown()
+        for s in sims:
+            s.terminate()
+            s.wait()
+    per_dev = [s["bytes"]/max(s["elapsed"], 1e-9)/1e6 for s in stats]
+    return dict(devices=ndev, MBps=sum(per_dev), per_device_MBps=per_dev,
+                max_queue_depth=max(s["max_queue_depth"] for s in stats),
+                gil_wait_fraction=max(s["gil_wait_time"]/max(s["elapsed"], 1e-9)
+                                      for s in stats),
+                device=stats, errors=errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--personality", default="ACQ425ELF")
+    parser.add_argument("--devices", type=int, default=4,
+      help="largest number of concurrent digitizers")
+    parser.add_argument("--rate", type=float, default=0,
+      help="frame rate (Hz) of each simulator, 0 for as fast as possible")
+    parser.add_argument("--buffer-size", type=int, default=1024*1024)
+    parser.add_argument("--callback-latency", type=float, default=None)
+    parser.add_argument("--duration", type=float, default=10.)
+    parser.add_argument("--output", default="bench_multi.json")
+    args = parser.parse_args()
+
+    fmt = "{:>8}{:>12}{:>14}{:>8}{:>10}{:>8}"
+    print(fmt.format("devices", "total MB/s", "per device", "scaling",
+                     "GIL wait", "errors"))
+    results = []
+    for n in range(1, args.devices + 1):
+        r = run(args, n)
+        results.append(r)
+        print(fmt.format(n, "{:.1f}".format(r["MBps"]),
+          "{:.1f}".format(r["MBps"]/n),
+          "{:.2f}".format(r["MBps"]/results[0]["MBps"]) if results[0]["MBps"] else "-",
+          "{:.1f}%".format(100*r["gil_wait_fraction"]),
+          sum(1 for e in r["errors"] if e)))
+
+    out = dict(revision=git_revision(), date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+               host=platform.node(), python=platform.python_version(),
+               args=vars(args), results=results)
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=1, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+  End-to-end benchmark of the readout pipeline:
+
+    pyacq.Device.BeginReadout -> ReadoutObj.__call__ (validation, trigger,
+    .dig write) -> ring -> readBuffer
+
+  against a simulated digitizer (DigitizerSimulator.py, started for every
+  configuration) or real hardware (--external ADDRESS).  For each
+  combination of sample rate, buffer size and number of read channels it
+  reports the sustained MB/s, latency percentiles of each stage, queue depths
+  and GIL wait/hold times.  Results are written as JSON, --compare prints the
+  change with respect to an earlier result file.
+
+  Latencies:
+    wire     - generation of the last frame of a buffer (from its sample
+               counter and the simulator start time) to the callback
+    process  - duration of the callback (and each stage of it)
+    read     - start of the callback to readBuffer returning the buffer
+
+  Usage: python bench_pipeline.py [--rates 100000,500000]
+           [--buffer-sizes 262144,1048576] [--channels 4,32] [--duration 10]
+           [--callback-latency 0.05] [--write] [--trigger]
+           [--output results.json]
+           [--compare old.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+import numpy
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+from dtacq.readout import ReadoutObj, summarize_times
+from dtacq import cards
+
+
+class TimedReadout(ReadoutObj):
+    """
+    Records when each buffer reaches the callback, with the sample counter
+    of its last frame and its ring sequence number
+    """
+    def startReadout(self, **kw):
+        self.arrivals = []
+        self.seq_arrival = {}
+        # The LIA firmware sends no counter
+        self.has_counter = not isinstance(self.card, cards.ACQ425ELFLIA)
+        return ReadoutObj.startReadout(self, **kw)
+
+    def __call__(self, x):
+        self._t_call = time.time()
+        ReadoutObj.__call__(self, x)
+
+    def _add_to_list(self, al):
+        seq = ReadoutObj._add_to_list(self, al)
+        ctr = -1
+        if self.has_counter and len(al) >= self.total_ch:
+            ctr = int(self.card._counters(al)[-1])
+        self.arrivals.append((self._t_call, ctr))
+        self.seq_arrival[seq % 0xffffffff] = self._t_call
+
+
+def wait_for_port(addr, port, timeout=10.):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection((addr, port), 0.5).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Simulator on {} did not start".format(addr))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                 cwd=here).decode("ascii").strip()
+    except Exception:
+        return None
+
+
+def run_config(args, rate, buffer_size, nchan):
+    sim = None
+    addr = args.external or args.address
+    if not args.external:
+        sim = subprocess.Popen([sys.executable,
+                 os.path.join(here, "..", "DigitizerSimulator.py"),
+                 "{}@{}".format(args.personality, addr),
+                 "--rate", str(rate)])
+    workdir = tempfile.mkdtemp(prefix="bench_pipeline")
+    cwd = os.getcwd()
+    try:
+        wait_for_port(addr, 4220)
+        os.chdir(workdir)
+        obj = TimedReadout(addr)
+        channels = list(range(min(nchan, sum(obj.available_modules.values()))))
+        kw = dict(mod_list=sorted(obj.available_modules),
+                  buffer_size=buffer_size,
+                  pool_size=args.pool_size,
+                  channel_list=channels)
+        if args.callback_latency is not None:
+            kw["callback_latency"] = args.callback_latency
+        if args.write:
+            kw.update(should_upload=True, should_save=True)
+        if args.trigger:
+            kw["trigger"] = dict(type="threshold", channel=0, threshold=0,
+                                 pre=100, post=1000)
+        obj.startReadout(**kw)
+        t0 = None
+        if sim is not None:
+            time.sleep(0.2)
+            t0 = float(obj.dev.SendCommand("sim.t0"))
+
+        read_lat = []
+        end = time.time() + args.duration
+        while time.time() < end and obj.dev.IsRunning():
+            buf = obj.readBuffer(channels=channels, include_counter=True,
+                                 reader="bench")
+            now = time.time()
+            # Header: length (with flags), channel list, counter
+            hdr = numpy.frombuffer(buf[:4*(len(channels) + 2)], dtype=numpy.uint32)
+            if len(hdr) == len(channels) + 2 and hdr[0] & 0xff00:
+                arrived = obj.seq_arrival.pop(int(hdr[-1]), None)
+                if arrived is not None:
+                    read_lat.append(now - arrived)
+            time.sleep(args.read_interval)
+
+        stats = obj.readoutStats()
+        obj.stopReadout()
+        while obj.dev.IsRunning():
+            time.sleep(0.05)
+        if obj.upload_class is not None and obj.upload_class.writer:
+            obj.upload_class.writer.close(remove=True)
+            obj.upload_class.writer.stop()
+            obj.upload_class.writer.join()
+            stats["writer"] = obj.writerStats()
+        # ReadoutException stored by the callback (e.g. a counter gap)
+        error = obj._exc
+
+        wire = []
+        if t0 is not None and rate:
+            wire = [t - (t0 + c/float(rate)) for t, c in obj.arrivals if c >= 0]
+        dev = stats["device"]
+        elapsed = max(dev["elapsed"], 1e-9)
+        obj.safeShutdown()
+        return dict(rate=rate, buffer_size=buffer_size, channels=len(channels),
+                    total_ch=obj.total_ch, readout_size=obj.readout_size,
+                    MBps=dev["bytes"]/elapsed/1e6,
+                    expected_MBps=rate*obj.total_ch*obj.readout_size/1e6,
+                    buffers=dev["buffers"],
+                    queue_depth=dev["max_queue_depth"],
+                    gil_wait_fraction=dev["gil_wait_time"]/elapsed,
+                    gil_hold_fraction=dev["gil_hold_time"]/elapsed,
+                    latency=dict(wire=summarize_times(wire),
+                                 read=summarize_times(read_lat)),
+                    stages=stats["stages"],
+                    device=dev,
+                    writer=stats["writer"],
+                    error=error)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if sim is not None:
+            sim.terminate()
+            sim.wait()
+
+
+def compare(old, new):
+    key = lambda r: (r["rate"], r["buffer_size"], r["channels"])
+    old_res = dict((key(r), r) for r in old["results"])
+    fmt = "{:>10}{:>10}{:>6}{:>14}{:>20}"
+    print(fmt.format("rate", "buffer", "ch", "MB/s change", "total p99 change"))
+    for r in new["results"]:
+        o = old_res.get(key(r))
+        if o is None:
+            continue
+        rel = lambda a, b: "{:+.1f}%".format(100*(a/b - 1)) if b else "-"
+        print(fmt.format(r["rate"], r["buffer_size"], r["channels"],
+          rel(r["MBps"], o["MBps"]),
+          rel(r["stages"]["total"].get("p99", 0), o["stages"]["total"].get("p99", 0))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    ints = lambda s: [int(float(x)) for x in s.split(",")]
+    parser.add_argument("--personality", default="ACQ425ELF")
+    parser.add_argument("--address", default="127.0.0.2",
+      help="address of the simulator started for each configuration")
+    parser.add_argument("--external", default=None,
+      help="use an already running digitizer (or simulator) at this address")
+    parser.add_argument("--rates", type=ints, default=[100000, 500000],
+      help="frame rates (Hz) of the simulator, 0 for as fast as possible")
+    parser.add_argument("--buffer-sizes", type=ints, default=[256*1024, 1024*1024])
+    parser.add_argument("--channels", type=ints, default=[4, 32],
+      help="number of channels read (and written)")
+    parser.add_argument("--pool-size", type=int, default=16)
+    parser.add_argument("--callback-latency", type=float, default=None,
+      help="batch buffers into one callback at most every N seconds")
+    parser.add_argument("--duration", type=float, default=10.)
+    parser.add_argument("--read-interval", type=float, default=0.05)
+    parser.add_argument("--write", action="store_true", help="write .dig files")
+    parser.add_argument("--trigger", action="store_true",
+      help="use a threshold trigger on channel 0")
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", default=None,
+      help="earlier result file to compare with")
+    args = parser.parse_args()
+
+    results = []
+    fmt = "{:>10}{:>10}{:>6}{:>10}{:>10}{:>8}{:>12}{:>12}{:>10}"
+    print(fmt.format("rate", "buffer", "ch", "MB/s", "expected", "queue",
+                     "wire p99", "total p99", "GIL hold"))
+    for rate, bs, nch in itertools.product(args.rates, args.buffer_sizes,
+                                           args.channels):
+        r = run_config(args, rate, bs, nch)
+        results.append(r)
+        ms = lambda d: "{:.2f}ms".format(d["p99"]*1e3) if d.get("count") else "-"
+        print(fmt.format(rate, bs, r["channels"], "{:.1f}".format(r["MBps"]),
+          "{:.1f}".format(r["expected_MBps"]), r["queue_depth"],
+          ms(r["latency"]["wire"]), ms(r["stages"]["total"]),
+          "{:.1f}%".format(100*r["gil_hold_fraction"])))
+        if r["error"]:
+            print("  error: {}".format(r["error"].strip().splitlines()[-1]))
+
+    out = dict(revision=git_revision(), date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+               host=platform.node(), python=platform.python_version(),
+               args=vars(args), results=results)
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=1, sort_keys=True)
+    print("Results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), out)
+
+if __name__ == '__main__':
+    main()
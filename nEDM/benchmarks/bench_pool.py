@@ -0,0 +1,84 @@
+"""
+  Throughput (MB/s of raw buffer) of computing the file output of readout
+  buffers inline (as in ReadoutObj without processing_pool) and with a
+  ProcessingPool of 1..--workers processes, on 80 channel LIA data (int16).
+  For every downsampling method: none, block mean and the FIR Decimator.
+  Committed outputs are copied, as done before queueing them for writing.
+
+  Usage: python bench_pool.py [--buffer-size N] [--buffers N]
+           [--downsample 100] [--workers 4]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.processing import (deinterleave, frames, select_channels, to_dtype,
+                              Decimator)
+from dtacq.pool import ProcessingPool
+
+total_ch = 80
+
+
+def inline(bufs, ch_list, ds, decimator):
+    start = time.time()
+    for v in bufs:
+        if decimator is not None:
+            f = select_channels(frames(v, total_ch), ch_list)
+            out = to_dtype(decimator.process(f), numpy.float32)
+        else:
+            out = deinterleave(v, total_ch, ch_list, ds, numpy.float32)
+        numpy.array(out)
+    return time.time() - start
+
+
+def pooled(bufs, ch_list, ds, decimator, pool):
+    run = pool.run(lambda meta, out: numpy.array(out),
+                   total_ch, ch_list, len(bufs[0]), bufs[0].dtype,
+                   downsample=ds, ds_dtype=numpy.float32, decimator=decimator)
+    start = time.time()
+    for v in bufs:
+        run.submit(v)
+    run.close()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buffer-size", type=int, default=1024*1024,
+      help="samples per buffer")
+    parser.add_argument("--buffers", type=int, default=40)
+    parser.add_argument("--downsample", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    ds = args.downsample
+    nframes = args.buffer_size // total_ch
+    nframes -= nframes % ds
+    bufs = [numpy.random.randint(-2**15, 2**15, size=nframes*total_ch).astype(numpy.int16)
+            for _ in range(args.buffers)]
+    mb = sum(v.nbytes for v in bufs)/1e6
+    ch_list = list(range(total_ch))
+
+    # The workers are forked once and used for every method
+    pools = [ProcessingPool(w, slot_bytes=4*bufs[0].nbytes)
+             for w in range(1, args.workers + 1)]
+
+    fmt = "{:>8}{:>10}{:>10}"
+    print("{} CPUs, {} buffers of {:.1f} MB".format(os.sysconf("SC_NPROCESSORS_ONLN"),
+          len(bufs), bufs[0].nbytes/1e6))
+    print(fmt.format("method", "workers", "MB/s"))
+    for name in ("none", "mean", "fir"):
+        d = 1 if name == "none" else ds
+        dec = lambda: Decimator(ds, total_ch, dtype=numpy.float32) if name == "fir" else None
+        print(fmt.format(name, "inline", "{:.0f}".format(mb/inline(bufs, ch_list, d, dec()))))
+        for pool in pools:
+            print(fmt.format(name, pool.workers, "{:.0f}".format(mb/pooled(bufs, ch_list, d, dec(), pool))))
+    for pool in pools:
+        pool.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+  Cost of counter validation per buffer (last frame only vs. every frame)
+  compared to the time it takes the digitizer to fill that buffer.
+
+  Usage: python bench_validate.py [--buffer-size N] [--repeat N]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq import cards
+
+# (card class, data channels, spad words, frame rate in Hz)
+layouts = {
+  "ACQ425ELF" : (cards.ACQ425ELF, 32, 4, 1000000),
+  "ACQ437ELF" : (cards.ACQ437ELF, 64, 2, 50000),
+}
+
+def make_card(cls, check_word, total_ch):
+    card = cls.__new__(cls)
+    card.isRunning = False
+    card.reset(check_word, total_ch)
+    return card
+
+def make_buffer(dtype, nch, total_ch, frames, start):
+    f = numpy.zeros((frames, total_ch), dtype=dtype)
+    counters = (numpy.arange(frames, dtype=numpy.uint64) + start).astype(numpy.uint32)
+    # Counter occupies 4 bytes after the data channels
+    f.view(numpy.uint8)[:, nch*f.itemsize:nch*f.itemsize+4] = counters.view(numpy.uint8).reshape(frames, 4)
+    return f.ravel()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buffer-size", type=int, default=1024*1024,
+      help="samples per buffer")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    fmt = "{:<12}{:>10}{:>12}{:>12}{:>12}{:>10}"
+    print(fmt.format("layout", "frames", "arrival ms", "last ms", "full ms", "full %"))
+    for name in sorted(layouts):
+        cls, nch, spad, rate = layouts[name]
+        dtype = numpy.int16 if name.startswith("ACQ425") else numpy.int32
+        total_ch = nch + spad
+        frames = args.buffer_size // total_ch
+        bufs = [make_buffer(dtype, nch, total_ch, frames, 1 + i*frames)
+                for i in range(args.repeat)]
+        res = []
+        for full in (False, True):
+            card = make_card(cls, nch, total_ch)
+            card.full_validation = full
+            start = time.time()
+            for b in bufs:
+                card.validateData(b)
+            res.append((time.time() - start)/args.repeat*1e3)
+        arrival = frames/float(rate)*1e3
+        print(fmt.format(name, frames, "{:.2f}".format(arrival),
+          "{:.3f}".format(res[0]), "{:.3f}".format(res[1]),
+          "{:.2f}".format(100*res[1]/arrival)))
+
+if __name__ == '__main__':
+    main()
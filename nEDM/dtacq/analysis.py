@@ -0,0 +1,198 @@
+"""
+Online statistics and spectra of the channels during a readout
+
+OnlineAnalysis is fed every readout buffer and keeps, per channel, the
+running count, mean, rms, min and max and a Welch-averaged power spectral
+density.  The work is done on its own thread: the readout only queues the
+(read-only) buffers, at most max_queued of them, dropping the oldest when
+the analysis cannot keep up.
+"""
+import threading
+import collections
+import logging
+import numpy
+from numpy.lib.stride_tricks import as_strided
+from .processing import frames, select_channels
+from .digitizer_utils import ReadoutException
+
+
+class OnlineAnalysis(object):
+    """
+    Analysis of channels (indices in the frames of total_ch values) sampled
+    at freq (Hz), values are right-shifted by bit_shift.
+
+    Spectra use segments of nperseg frames overlapping by half, with a Hann
+    window and the mean of each segment removed.  averages > 0 averages
+    exponentially over about that many segments, averages = 0 over all
+    segments since the last reset.
+    """
+    def __init__(self, total_ch, channels, freq, bit_shift=0, nperseg=4096,
+                 averages=0, max_queued=16):
+        if nperseg < 2:
+            raise ValueError("nperseg must be >= 2")
+        self.total_ch = total_ch
+        self.channels = list(channels)
+        self.freq = float(freq)
+        self.bit_shift = bit_shift
+        self.nperseg = nperseg
+        self.step = nperseg - nperseg // 2
+        self.averages = averages
+        self.window = numpy.hanning(nperseg + 1)[:-1]
+        # One-sided density scaling, DC and Nyquist are not doubled
+        self._scale = numpy.full(nperseg//2 + 1,
+                                 2./(self.freq*(self.window**2).sum()))
+        self._scale[0] /= 2
+        if nperseg % 2 == 0:
+            self._scale[-1] /= 2
+        self.max_queued = max_queued
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = collections.deque()
+        self._running = True
+        # Counts resets and gaps (dropped buffers), a buffer processed
+        # across one of them must not bring back the state from before
+        self._generation = 0
+        self._breaks = 0
+        self.reset()
+        self._thread = threading.Thread(target=self._run, name="OnlineAnalysis")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def reset(self):
+        with self._cond:
+            nch = len(self.channels)
+            self._n = 0
+            self._sum = numpy.zeros(nch)
+            self._sumsq = numpy.zeros(nch)
+            self._min = numpy.full(nch, numpy.inf)
+            self._max = numpy.full(nch, -numpy.inf)
+            self._psd = numpy.zeros((self.nperseg//2 + 1, nch))
+            self._segments = 0
+            self._tail = None
+            self.dropped = 0
+            self._generation += 1
+
+    def push(self, v):
+        """
+        Queue the interleaved buffer v, called by the readout
+        """
+        with self._cond:
+            self._queue.append(v)
+            if len(self._queue) > self.max_queued:
+                self._queue.popleft()
+                self.dropped += 1
+                # Segments must not span the gap
+                self._tail = None
+                self._breaks += 1
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                v = self._queue.popleft()
+            try:
+                self._process(v)
+            except Exception:
+                logging.exception("Error in online analysis")
+
+    def _process(self, v):
+        f = select_channels(frames(v, self.total_ch), self.channels)
+        if self.bit_shift:
+            f = numpy.right_shift(f, self.bit_shift)
+        a = f.astype(numpy.float64)
+        n = a.shape[0]
+        s, ss = a.sum(axis=0), numpy.einsum("ij,ij->j", a, a)
+        mn, mx = a.min(axis=0), a.max(axis=0)
+
+        with self._cond:
+            tail = self._tail
+            generation, breaks = self._generation, self._breaks
+        if tail is not None:
+            a = numpy.concatenate([tail, a])
+        nseg = (a.shape[0] - self.nperseg) // self.step + 1 if a.shape[0] >= self.nperseg else 0
+        psd = None
+        if nseg > 0:
+            seg = as_strided(a, shape=(nseg, self.nperseg, a.shape[1]),
+                             strides=(a.strides[0]*self.step,) + a.strides)
+            seg = seg - seg.mean(axis=1)[:, None, :]
+            spec = numpy.fft.rfft(seg*self.window[None, :, None], axis=1)
+            psd = (spec.real**2 + spec.imag**2)*self._scale[None, :, None]
+        tail = a[nseg*self.step:].copy()
+
+        with self._cond:
+            if generation != self._generation:
+                # Reset while processing, v belongs to before it
+                return
+            self._n += n
+            self._sum += s
+            self._sumsq += ss
+            numpy.minimum(self._min, mn, out=self._min)
+            numpy.maximum(self._max, mx, out=self._max)
+            self._tail = tail if breaks == self._breaks else None
+            if psd is not None:
+                if self.averages > 0:
+                    # Exponential average, seeded by the first segment
+                    alpha = 1./self.averages
+                    for p in psd:
+                        if self._segments == 0:
+                            self._psd[:] = p
+                        else:
+                            self._psd += alpha*(p - self._psd)
+                        self._segments += 1
+                else:
+                    self._psd += psd.sum(axis=0)
+                    self._segments += nseg
+
+    def _index(self, channels):
+        if channels is None:
+            return list(range(len(self.channels)))
+        try:
+            return [self.channels.index(c) for c in channels]
+        except ValueError:
+            raise ReadoutException("Channels {} not all analysed ({})".format(channels, self.channels))
+
+    def stats(self, channels=None):
+        """
+        Running statistics since the last reset
+        """
+        idx = self._index(channels)
+        with self._cond:
+            # None (not NaN, which is not valid JSON) before any data
+            n = float(self._n)
+            return dict(channels=[self.channels[i] for i in idx],
+                        count=self._n,
+                        mean=(self._sum[idx]/n).tolist() if self._n else None,
+                        rms=numpy.sqrt(self._sumsq[idx]/n).tolist() if self._n else None,
+                        min=self._min[idx].tolist() if self._n else None,
+                        max=self._max[idx].tolist() if self._n else None,
+                        dropped=self.dropped)
+
+    def spectrum(self, channels=None, points=None):
+        """
+        Averaged power spectral density (units^2/Hz), reduced to at most
+        points frequency bins by averaging neighbouring bins
+        """
+        idx = self._index(channels)
+        with self._cond:
+            psd = self._psd[:, idx].copy()
+            segments = self._segments
+        if self.averages == 0 and segments:
+            psd /= segments
+        f = numpy.fft.rfftfreq(self.nperseg, 1./self.freq)
+        if points and points < len(f):
+            edges = numpy.linspace(0, len(f), points + 1).astype(int)
+            counts = numpy.diff(edges).astype(numpy.float64)
+            f = numpy.add.reduceat(f, edges[:-1])/counts
+            psd = numpy.add.reduceat(psd, edges[:-1], axis=0)/counts[:, None]
+        return dict(channels=[self.channels[i] for i in idx],
+                    freq=f.tolist(), psd=psd.T.tolist(),
+                    segments=segments, nperseg=self.nperseg,
+                    resolution=self.freq/self.nperseg)
@@ -4,6 +4,9 @@ import numpy
 
 class ACQCard(object):
     min_frequency = 5000
+    # Check the counter of every frame (instead of only the last) in
+    # validateData
+    full_validation = False
 
     def __init__(self, dev):
         # Set up the counter for all cards
@@ -16,15 +19,51 @@ class ACQCard(object):
         self.reset()
 
     def _checkCounter(self, full_pts, total_counter):
-        self.last_counter += full_pts
-        while self.last_counter > 0xFFFFFFFF:
-            self.last_counter -= 0x100000000
-        if self.last_counter != (total_counter % 0xFFFFFFFF):
+        # The card's counter is uint32 and wraps at 2**32
+        self.last_counter = (self.last_counter + full_pts) & 0xFFFFFFFF
+        if self.last_counter != (int(total_counter) & 0xFFFFFFFF):
             raise ReadoutException("ReadoutBuffer corrupted: expected({}) seen({})".format(self.last_counter, total_counter))
 
+    def _counters(self, v):
+        """
+        Strided uint32 view of the spad counter of every (whole) frame in v
+        """
+        n = len(v) // self.total_ch
+        return numpy.ndarray((n,), dtype=numpy.uint32, buffer=v,
+                             offset=self.check_word*v.itemsize,
+                             strides=(self.total_ch*v.itemsize,))
+
+    def _checkAllCounters(self, counters):
+        """
+        Check that the counters step by exactly 1 through the buffer, and
+        continue from the previous buffer.  Reports the sample index of
+        every discontinuity.
+        """
+        expected = numpy.empty_like(counters)
+        expected[0] = (self.last_counter + 1) & 0xFFFFFFFF
+        # uint32 arithmetic, wraps like the card's counter
+        expected[1:] = counters[:-1] + numpy.uint32(1)
+        bad = numpy.flatnonzero(counters != expected)
+        if len(bad):
+            raise ReadoutException("ReadoutBuffer corrupted, {} discontinuities: {}".format(len(bad),
+              ", ".join("sample {}: expected({}) seen({})".format(self.samples_seen + i,
+                        expected[i], counters[i]) for i in bad[:10])))
+        self.last_counter = int(counters[-1])
+
+    def validateData(self, v):
+        counters = self._counters(v)
+        if len(counters) == 0:
+            return
+        if self.full_validation:
+            self._checkAllCounters(counters)
+        else:
+            self._checkCounter(len(counters), counters[-1])
+        self.samples_seen += len(counters)
+
     @notRunning
     def reset(self, check_word=0, total_channels=0):
         self.last_counter = 0
+        self.samples_seen = 0
         self.total_ch = total_channels
         self.check_word = check_word
 
@@ -74,14 +113,6 @@ class ACQ425ELF(ACQCard):
     max_buffer = 2*1024*1024
     gain_settings = { 0 : "x1", 1 : "x2", 2 : "x4", 3 : "x8" }
 
-    def validateData(self, v):
-        ch = self.total_ch
-        full_pts = len(v)/ch
-        last_set = v[(full_pts-1)*ch:]
-        cw = self.check_word
-        total_counter = numpy.fromstring(numpy.array(last_set[cw:cw+2]).tostring(), numpy.uint32)[0]
-        self._checkCounter(full_pts, total_counter)
-
 class ACQ425ELFLIA(ACQ425ELF):
     gain_settings = { 0 : "x1" }
     clk_divider = 128
@@ -99,6 +130,7 @@ class ACQ425ELFLIA(ACQ425ELF):
     @notRunning
     def reset(self, check_word=0, total_channels=0):
         self.last_counter = 0
+        self.samples_seen = 0
         self.total_ch = 80
         self.check_word = check_word
 
@@ -120,12 +152,4 @@ class ACQ437ELF(ACQCard):
         else:
           self.clk_divider = 512
 
-    def validateData(self, v):
-        ch = self.total_ch
-        full_pts = len(v)/ch
-        last_set = v[(full_pts-1)*ch:]
-        cw = self.check_word
-        total_counter = last_set[cw]
-        self._checkCounter(full_pts, total_counter)
-
 
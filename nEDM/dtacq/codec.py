@@ -0,0 +1,374 @@
+"""
+Block structure of .dig data: compression and the trailing block index
+
+A compressed .dig file (header "version" : 2, with "codec") holds after the
+header a sequence of blocks of up to block_frames frames each:
+
+  uint32 compressed length, uint32 number of frames, compressed payload
+
+For integer data the payload is the first frame followed by the differences
+of consecutive frames (per channel, wrapping in the sample type, so the
+coding is lossless), for float data the samples themselves.  These are
+ordered channel by channel and byte shuffled (all lowest bytes, then all
+second bytes, ...) before zlib compression, so that the mostly constant high
+bytes of slowly varying signals compress well.  Every block can be decoded
+on its own.
+
+Files with "index" in the header (raw or compressed) end with an index of
+their blocks (of index block_frames frames for raw files, the compressed
+blocks otherwise):
+
+  JSON index (padded with spaces to a multiple of 4 bytes),
+  uint32 length of the JSON index, "DIDX"
+
+The index holds per block (as lists over the blocks) the first frame
+(start), number of frames, byte offset in the file, the run sample of the
+first frame (index from the start of the readout, the spad counter - 1 for
+cards sending one) and per channel min, max, mean and rms of the stored
+values.  segments lists the contiguous ranges of the run written to the
+file, e.g. from triggers, as [first frame, frames, run sample].  A file
+that was not closed has no index.
+"""
+import json
+import zlib
+import threading
+import collections
+import numpy
+from multiprocessing.pool import ThreadPool
+
+codec_name = "delta-shuffle-zlib"
+index_magic = b"DIDX"
+_block_header = numpy.dtype("<u4")
+
+
+def encode_block(f, level=6):
+    """
+    Compressed payload of f, a (frames, channels) array
+    """
+    if f.dtype.kind in "iu":
+        d = numpy.empty(f.shape[::-1], dtype=f.dtype)
+        d[:, :1] = f[:1].T
+        numpy.subtract(f[1:].T, f[:-1].T, out=d[:, 1:])
+    else:
+        d = numpy.ascontiguousarray(f.T)
+    shuffled = d.view(numpy.uint8).reshape(-1, d.itemsize).T
+    return zlib.compress(numpy.ascontiguousarray(shuffled).tostring(), level)
+
+
+def decode_block(payload, nframes, nch, dtype):
+    """
+    (nframes, nch) array of dtype from a payload of encode_block
+    """
+    dtype = numpy.dtype(dtype)
+    raw = numpy.frombuffer(zlib.decompress(payload), dtype=numpy.uint8)
+    d = numpy.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+    d = d.view(dtype).reshape(nch, nframes).T
+    if dtype.kind in "iu":
+        return numpy.cumsum(d, axis=0, dtype=dtype)
+    return numpy.ascontiguousarray(d)
+
+
+def block_stats(f):
+    """
+    Partial statistics of f ((frames, channels)), combined per block by
+    _Block.stats
+    """
+    a = f.astype(numpy.float64)
+    return (f.min(axis=0), f.max(axis=0), a.sum(axis=0),
+            numpy.einsum("ij,ij->j", a, a), f.shape[0])
+
+
+def frame_block(f, level=6):
+    """
+    f encoded as a block of the file (block header and payload), with its
+    statistics
+    """
+    payload = encode_block(f, level)
+    hdr = numpy.array([len(payload), f.shape[0]], dtype=_block_header)
+    return hdr.tostring() + payload, block_stats(f)
+
+
+def read_block(fileobj, offset, nch, dtype):
+    """
+    Decoded block starting (with its block header) at offset
+    """
+    fileobj.seek(offset)
+    clen, n = numpy.frombuffer(fileobj.read(2*_block_header.itemsize),
+                               dtype=_block_header)
+    return decode_block(fileobj.read(clen), n, nch, dtype)
+
+
+def scan_blocks(fileobj, offset, end):
+    """
+    Offsets and frames of the blocks in fileobj between offset and end, as
+    arrays.  A truncated last block (e.g. of a file still being written)
+    is left out.
+    """
+    offs, frames = [], []
+    hsize = 2*_block_header.itemsize
+    while offset + hsize <= end:
+        fileobj.seek(offset)
+        clen, n = numpy.frombuffer(fileobj.read(hsize), dtype=_block_header)
+        if offset + hsize + clen > end:
+            break
+        offs.append(offset)
+        frames.append(int(n))
+        offset += hsize + int(clen)
+    return (numpy.array(offs, dtype=numpy.int64),
+            numpy.array(frames, dtype=numpy.int64))
+
+
+def read_index(fileobj, end):
+    """
+    Returns (index, end of the data) of a file of size end, index is None
+    if the file has no (complete) trailing index
+    """
+    if end < 8:
+        return None, end
+    fileobj.seek(end - 8)
+    tail = fileobj.read(8)
+    if tail[4:] != index_magic:
+        return None, end
+    n = int(numpy.frombuffer(tail[:4], dtype=_block_header)[0])
+    fileobj.seek(end - 8 - n)
+    index = json.loads(fileobj.read(n).decode("utf-8"))
+    for k in ("start", "frames", "offset"):
+        index[k] = numpy.array(index[k], dtype=numpy.int64)
+    for k in ("min", "max", "mean", "rms"):
+        index[k] = numpy.array(index[k])
+    return index, end - 8 - n
+
+
+class _Block(object):
+    """
+    Index entry of one block while its statistics may still be computed
+    """
+    def __init__(self, start, offset):
+        self.start = start
+        self.offset = offset
+        self.frames = 0
+        # block_stats results (or AsyncResults of them)
+        self.parts = []
+        # (first frame in block, frames, run sample)
+        self.segments = []
+
+    def add(self, stats, n, run_sample):
+        self.parts.append(stats)
+        if run_sample is not None:
+            self.segments.append((self.frames, n, run_sample))
+        self.frames += n
+
+    def stats(self):
+        p = [x.get() if hasattr(x, "get") else x for x in self.parts]
+        n = float(sum(x[4] for x in p))
+        return (numpy.min([x[0] for x in p], axis=0),
+                numpy.max([x[1] for x in p], axis=0),
+                numpy.sum([x[2] for x in p], axis=0)/n,
+                numpy.sqrt(numpy.sum([x[3] for x in p], axis=0)/n))
+
+
+class BlockWriter(object):
+    """
+    Front end to an AsyncFileWriter, with the same interface, writing
+    (frames, channels) arrays in blocks of block_frames frames.
+
+    With a compression level, blocks are compressed on a pool of worker
+    threads (zlib and numpy release the GIL) and handed to the writer in
+    order; at most max_pending blocks are compressed at a time, write
+    blocks beyond that.  With level None the data is written unchanged and
+    as it comes.  With index, the statistics of every block are computed
+    on the pool too, and the index is appended when a file is closed.
+    Opening or closing a file ends the current (partial) block.
+
+    downsample is the number of run samples per frame written, to give
+    the run sample of every segment.
+    """
+    def __init__(self, writer, block_frames=65536, level=None, workers=2,
+                 max_pending=None, index=True, downsample=1):
+        if block_frames < 1:
+            raise ValueError("block_frames must be >= 1")
+        self.writer = writer
+        self.block_frames = block_frames
+        self.level = level
+        self.index = index
+        self.downsample = downsample
+        self.max_pending = max_pending or 4*workers
+        self._pool = ThreadPool(workers)
+        self._lock = threading.RLock()
+        self._part = []
+        self._part_frames = 0
+        self._pending = collections.deque()
+        self._blocks = []
+        self._current = None
+        self._file_frames = self._file_bytes = 0
+        self._stats = dict(blocks=0, raw_bytes=0, compressed_bytes=0,
+                           dropped_frames=0)
+
+    def codec(self):
+        """
+        Description of the coding for the file header, None if not
+        compressed
+        """
+        if self.level is None:
+            return None
+        return dict(name=codec_name, block_frames=self.block_frames,
+                    level=self.level)
+
+    def open(self, name, header=None):
+        with self._lock:
+            self._finish()
+            self._blocks = []
+            self._file_frames = 0
+            self._file_bytes = len(header) if header is not None else 0
+            self.writer.open(name, header)
+
+    def write(self, dat, run_sample=None):
+        """
+        Write dat, whose first frame is run_sample (if known) of the run
+        """
+        if dat.ndim != 2:
+            raise ValueError("Block files need (frames, channels) arrays")
+        with self._lock:
+            if self.level is None:
+                self._writeRaw(dat, run_sample)
+                return True
+            self._part.append((dat, run_sample))
+            self._part_frames += dat.shape[0]
+            while self._part_frames >= self.block_frames:
+                self._submit(self._takePart(self.block_frames))
+            self._drain(False)
+        return True
+
+    def close(self, remove=False):
+        with self._lock:
+            self._finish()
+            if self.index and not remove:
+                self.writer.write(self._indexBytes())
+            self._blocks = []
+            return self.writer.close(remove)
+
+    def stop(self):
+        with self._lock:
+            self._finish()
+            self._pool.close()
+            self.writer.stop()
+
+    def join(self, timeout=None):
+        self.writer.join(timeout)
+
+    def stats(self):
+        s = self.writer.stats()
+        with self._lock:
+            s.update(self._stats)
+            s["compress_pending"] = len(self._pending)
+        s["ratio"] = s["raw_bytes"]/float(s["compressed_bytes"]) if s["compressed_bytes"] else None
+        return s
+
+    def _finish(self):
+        """
+        End the current block and wait for all pending blocks
+        """
+        if self._part_frames:
+            self._submit(self._takePart(self._part_frames))
+        self._part = []
+        self._part_frames = 0
+        self._drain(True)
+        if self._current is not None and self._current.frames:
+            self._blocks.append(self._current)
+        self._current = None
+
+    def _writeRaw(self, dat, run_sample):
+        pos = 0
+        while pos < dat.shape[0]:
+            if self._current is None:
+                self._current = _Block(self._file_frames, self._file_bytes)
+            blk = self._current
+            piece = dat[pos:pos + self.block_frames - blk.frames]
+            n = piece.shape[0]
+            if self.writer.write(piece):
+                blk.add(self._pool.apply_async(block_stats, (piece,)) if self.index else None,
+                        n, None if run_sample is None else run_sample + pos*self.downsample)
+                self._file_frames += n
+                self._file_bytes += piece.nbytes
+            else:
+                self._stats["dropped_frames"] += n
+            if blk.frames == self.block_frames:
+                self._blocks.append(blk)
+                self._current = None
+            pos += n
+
+    def _takePart(self, n):
+        """
+        The first n frames of the collected data, with their segments
+        """
+        arrays, segments, got = [], [], 0
+        while got < n:
+            dat, run_sample = self._part[0]
+            take = min(n - got, dat.shape[0])
+            arrays.append(dat[:take])
+            if run_sample is not None:
+                segments.append((got, take, run_sample))
+            if take == dat.shape[0]:
+                self._part.pop(0)
+            else:
+                self._part[0] = (dat[take:], None if run_sample is None
+                                 else run_sample + take*self.downsample)
+            got += take
+        self._part_frames -= n
+        return numpy.concatenate(arrays) if len(arrays) > 1 else arrays[0], segments
+
+    def _submit(self, block):
+        dat, segments = block
+        self._pending.append((self._pool.apply_async(frame_block, (dat, self.level)),
+                              dat.shape[0], dat.nbytes, segments))
+        # Bound the memory held by blocks waiting for compression
+        while len(self._pending) > self.max_pending:
+            self._writeOldest()
+
+    def _drain(self, wait):
+        while self._pending and (wait or self._pending[0][0].ready()):
+            self._writeOldest()
+
+    def _writeOldest(self):
+        res, n, raw, segments = self._pending.popleft()
+        blk, stats = res.get()
+        if not self.writer.write(blk):
+            self._stats["dropped_frames"] += n
+            return
+        b = _Block(self._file_frames, self._file_bytes)
+        b.parts.append(stats)
+        b.frames = n
+        b.segments = segments
+        self._blocks.append(b)
+        self._file_frames += n
+        self._file_bytes += len(blk)
+        self._stats["blocks"] += 1
+        self._stats["raw_bytes"] += raw
+        self._stats["compressed_bytes"] += len(blk)
+
+    def _indexBytes(self):
+        blocks = [b for b in self._blocks if b.frames]
+        stats = [b.stats() for b in blocks]
+        segments = []
+        for b in blocks:
+            for first, n, run_sample in b.segments:
+                first += b.start
+                if segments:
+                    pf, pn, prs = segments[-1]
+                    if pf + pn == first and prs + pn*self.downsample == run_sample:
+                        segments[-1][1] += n
+                        continue
+                segments.append([first, n, run_sample])
+        index = dict(block_frames=self.block_frames,
+                     start=[b.start for b in blocks],
+                     frames=[b.frames for b in blocks],
+                     offset=[b.offset for b in blocks],
+                     run_sample=[b.segments[0][2] if b.segments and b.segments[0][0] == 0
+                                 else None for b in blocks],
+                     segments=segments)
+        for i, k in enumerate(("min", "max", "mean", "rms")):
+            index[k] = [s[i].tolist() for s in stats]
+        js = json.dumps(index)
+        js += " "*(-len(js) % 4)
+        return js.encode("utf-8") + \
+               numpy.array([len(js)], dtype=_block_header).tostring() + index_magic
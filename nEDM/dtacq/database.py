@@ -1,68 +1,194 @@
 import cloudant
-from pynedm import ProcessObject
+import requests
 from twisted.internet import threads, defer
-from clint.textui.progress import Bar as ProgressBar
 import logging
 from .settings import db_url, db_name, db_un, db_pw
 import os
 import json
 import ctypes
-import traceback
+import time
+import threading
+import contextlib
+from .writer import AsyncFileWriter
+from .codec import BlockWriter
+from .uploader import get_uploader
+
+class SessionPool(object):
+   """
+   Authenticated cloudant.Account sessions, reused instead of logging in for
+   every request.  Sessions are kept per (url, user); a session is logged in
+   again once older than ttl (the CouchDB cookie lifetime defaults to 10
+   minutes) or after a request failed with 401.
+   """
+   def __init__(self, ttl=480, max_idle=4):
+     self.ttl = ttl
+     self.max_idle = max_idle
+     self._lock = threading.Lock()
+     self._idle = {}
+     self._stats = dict(hits=0, misses=0, refreshes=0)
+
+   def _login(self, acct):
+     acct.login(db_un, db_pw).raise_for_status()
+     acct._login_time = time.time()
+
+   def acquire(self):
+     key = (db_url, db_un)
+     with self._lock:
+       idle = self._idle.setdefault(key, [])
+       acct = idle.pop() if idle else None
+       self._stats["hits" if acct else "misses"] += 1
+     if acct is None:
+       acct = cloudant.Account(uri=db_url)
+       self._login(acct)
+     elif time.time() - acct._login_time > self.ttl:
+       self._login(acct)
+       with self._lock:
+         self._stats["refreshes"] += 1
+     return acct
+
+   def release(self, acct):
+     with self._lock:
+       idle = self._idle.setdefault((db_url, db_un), [])
+       if len(idle) < self.max_idle:
+         idle.append(acct)
+
+   @contextlib.contextmanager
+   def session(self):
+     """
+     with pool.session() as (acct, db):
+     """
+     acct = self.acquire()
+     try:
+       yield acct, acct[db_name]
+     except requests.HTTPError as e:
+       if e.response is not None and e.response.status_code == 401:
+         # Cookie no longer accepted, log in again on next use
+         acct._login_time = 0
+       raise
+     finally:
+       self.release(acct)
+
+   def stats(self):
+     with self._lock:
+       s = dict(self._stats)
+       s["idle"] = sum(len(v) for v in self._idle.values())
+       return s
+
+session_pool = SessionPool()
 
 class UploadClass(object):
-   def __init__(self, doc_to_save):
+   def __init__(self, doc_to_save, compression=None, index_frames=None,
+                **writer_opts):
+     """
+     writer_opts are passed to the AsyncFileWriter that writes the files.
+     With compression (a dict of options for codec.BlockWriter, may be
+     empty) the files are written compressed (.dig version 2).  With
+     index_frames, files end with an index of blocks of index_frames frames
+     (the compressed blocks if compressed), flagged by "index" in the
+     header.  Readers that take the number of frames from the file size
+     do not know about it, so it is not written by default.
+     """
      self.doc_to_post = doc_to_save
      self.doc_to_post["type"] = "measurement"
      self._fn = self.doc_to_post.get("filename", None)
      self._openfile = None
+     self.writer = None
+     if self._fn:
+         opts = dict(block_frames=index_frames or 65536, level=None,
+                     index=index_frames is not None,
+                     downsample=self.doc_to_post.get("downsample", 1))
+         if compression is not None:
+             opts["level"] = 6
+             opts.update(compression)
+         self.writer = BlockWriter(AsyncFileWriter(**writer_opts), **opts)
+         if self.writer.level is not None:
+             self.doc_to_post["version"] = 2
+             self.doc_to_post["codec"] = self.writer.codec()
+         if self.writer.index:
+             self.doc_to_post["index"] = True
      self._filenumber = 0
      self.deferred = None
-     self._first = True
+     self._uploads = []
 
      self.__performUpload()
      self.writeNewFile()
 
-   def __acct(self):
-     acct = cloudant.Account(uri=db_url)
-     acct.login(db_un, db_pw)
-     db = acct[db_name]
-     return acct, db
+   @staticmethod
+   def _acct():
+     """
+     Context manager giving (acct, db) from the session pool
+     """
+     return session_pool.session()
 
    def isWriting(self):
      return self._openfile is not None
 
    def closeAndUploadFile(self):
-     if not self.shouldUploadFile():
-       d = defer.Deferred()
-       d.callback("Not uploading file")
-       return d
+     """
+     Close the current file and upload it, also ends the writer.  The
+     returned Deferred fires with the results of all uploads.  Closing
+     waits for the pending (compressed) blocks and the writer queue, it is
+     done on a thread so that the reactor is not held up.
+     """
+     def close():
+       closed = self._closeFile()
+       if self.writer:
+           self.writer.stop()
+       return closed
+     d = threads.deferToThread(close)
+     d.addCallback(self._uploadClosed)
+     d.addCallback(lambda _: self._allUploads())
+     return d
+
+   def _allUploads(self):
+     if not self._uploads:
+         return "Not uploading file"
+     d = defer.DeferredList(self._uploads)
+     d.addCallback(lambda res: [r for _, r in res])
+     return d
 
-     def func_gen(func, open_file):
-         print("Calling func_gen: {}".format(open_file))
-         return lambda x: threads.deferToThread( func, x, open_file)
+   def _closeAndUploadFile(self):
+     self._uploadClosed(self._closeFile())
 
-     self._openfile["file"].close()
+   def _closeFile(self):
+     """
+     Close the current file, blocks until the writer has all of it.
+     Returns (name, event set once closed) of a file to upload, or None.
+     """
+     if not self.shouldUploadFile():
+       return None
+
+     closed = None
      if "written" in self._openfile:
-         self.deferred.addCallback(
-           func_gen(self.__performUploadFileInThread, self._openfile["name"]))
+         closed = (self._openfile["name"], self.writer.close())
      else:
          # Means we never wrote, just delete
-         os.remove(self._openfile["name"])
+         self.writer.close(remove=True)
      self._openfile = None
-     return self.deferred
+     return closed
+
+   def _uploadClosed(self, closed):
+     """
+     Upload the file closed by _closeFile once the document is saved
+     """
+     if closed is None:
+       return
+     d = defer.Deferred()
+     self._uploads.append(d)
+     self.deferred.addCallbacks(self.__uploadFile, self.__docFailed,
+       callbackArgs=closed + (d,), errbackArgs=(d,))
 
    def writeNewFile(self):
      if not self._fn:
          return
 
-     self.closeAndUploadFile()
+     self._closeAndUploadFile()
 
      new_file_name = "{0}-{fn}{1}".format(*os.path.splitext(self._fn), fn=self._filenumber)
      self._filenumber += 1
 
      self._openfile = {
        "name" : new_file_name,
-       "file" : open(new_file_name, "wb")
      }
      header = self.doc_to_post
      header["filename"] = new_file_name
@@ -70,19 +196,37 @@ class UploadClass(object):
      header_b = bytearray(json.dumps(header))
      while len(header_b) % 4 != 0:
          header_b += " "
-     self._openfile["file"].write(bytearray(ctypes.c_uint32(len(header_b))) + header_b)
+     self.writer.open(new_file_name, bytearray(ctypes.c_uint32(len(header_b))) + header_b)
 
-   def writeToFile(self, dat):
+   def writeToFile(self, dat, run_sample=None):
      """
-     dat should be a function type taking a file object as argument
+     dat should be a (frames, channels) numpy array, it is queued and
+     written to the current file by the writer thread.  run_sample is the
+     sample of the run of its first frame (for the index).
      """
      if not self._openfile: return
      self._openfile["written"] = True
-     dat(self._openfile["file"])
+     self.writer.write(dat, run_sample)
+
+   def writerStats(self):
+     if not self.writer:
+         return {}
+     return self.writer.stats()
 
    def __performUploadInThread(self):
-     acct, db = self.__acct()
-     resp = db.design("nedm_default").post("_update/insert_with_timestamp",params=self.doc_to_post).json()
+     # A 401 (expired session) is raised so that the pool logs in again, the
+     # post is then tried once more
+     for attempt in range(2):
+       try:
+         with self._acct() as (acct, db):
+           r = db.design("nedm_default").post("_update/insert_with_timestamp",params=self.doc_to_post)
+           if r.status_code == 401:
+             r.raise_for_status()
+           resp = r.json()
+         break
+       except requests.HTTPError:
+         if attempt > 0:
+           raise
 
      if "ok" not in resp:
          return "Measurement settings could not be saved in DB"
@@ -98,35 +242,20 @@ class UploadClass(object):
             self.deferred is not None and\
             self._openfile is not None
 
-   def __performUploadFileInThread(self, resp, fn):
-     if self._first and "ok" not in resp:
-         return "Document not saved!"
-     self._first = False
-     acct, db = self.__acct()
-     po = ProcessObject(acct=acct)
-
-     class CallBack:
-         def __init__(self):
-             self.bar = None
-         def __call__(self, size_rd, total):
-             if self.bar is None:
-                 self.bar = ProgressBar(expected_size=total, filled_char='=')
-             self.bar.show(size_rd)
-
-     logging.info("Sending file: {}".format(fn))
-     try:
-         resp = po.upload_file(fn, resp['id'], db=db_name, callback=CallBack())
-         if "ok" in resp:
-             resp["url"] = "/_attachments/{db}/{id}/{fn}".format(db=db_name,fn=fn,**resp)
-             resp["file_name"] = fn
-             resp["type"] = "FileUpload"
-             os.remove(fn)
-
-     except:
-         logging.error(" Error in upload file: {}".format(traceback.format_exc(limit=1)))
-
-     logging.info("response: {}".format(resp))
-
+   def __uploadFile(self, resp, fn, closed, d):
+     """
+     Called with the result of the document upload.  The file upload fires
+     d, uploads run concurrently (bounded by the uploader) and are not
+     chained on each other.
+     """
+     if "ok" not in resp:
+         d.callback("Document not saved!")
+         return resp
+     up = threads.deferToThread(closed.wait)
+     up.addCallback(lambda _: get_uploader(self._acct).upload(fn, resp["id"]))
+     up.chainDeferred(d)
      return resp
 
-
+   def __docFailed(self, err, d):
+     d.callback("Document not saved: {}".format(err.getErrorMessage()))
+     return err
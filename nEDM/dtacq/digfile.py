@@ -0,0 +1,257 @@
+"""
+Reading .dig files written by UploadClass
+
+A .dig file is a uint32 header length, a JSON header (padded with spaces to
+a multiple of 4 bytes) and then the samples of the channels in the header's
+channel_list, interleaved frame by frame.  Compressed files (version 2)
+hold blocks of frames instead, and files may end with an index of blocks
+with statistics of the data, see codec.  A readout that rotates files
+produces name-0.dig, name-1.dig, ... which DigRecording presents as one
+recording.
+"""
+import os
+import re
+import json
+import numpy
+from . import codec
+
+
+def _dtype(header):
+    if header.get("is_float", False):
+        return numpy.dtype({4 : numpy.float32, 8 : numpy.float64}[header["byte_depth"]])
+    return numpy.dtype({2 : numpy.int16, 4 : numpy.int32}[header["byte_depth"]])
+
+
+def read_header(fn):
+    """
+    Returns (header dict, offset of the data in the file)
+    """
+    with open(fn, "rb") as f:
+        hlen = numpy.frombuffer(f.read(4), dtype=numpy.uint32)[0]
+        header = json.loads(f.read(hlen).decode("utf-8"))
+    return header, 4 + int(hlen)
+
+
+class DigFile(object):
+    """
+    A single .dig file, the data is memory-mapped (not read into memory) and
+    available as a (samples, channels) array in data.  For compressed files
+    data is None, read decodes only the blocks needed.
+    """
+    def __init__(self, fn):
+        self.filename = fn
+        self.header, self.data_offset = read_header(fn)
+        self.dtype = _dtype(self.header)
+        self.channel_list = list(self.header.get("channel_list", []))
+        self.names = [str(x) for x in
+                      self.header.get("channel_names", self.channel_list)]
+        nch = len(self.channel_list)
+        end = os.path.getsize(fn)
+        # Block index with statistics, see codec
+        self.index = None
+        if self.header.get("index", False):
+            with open(fn, "rb") as f:
+                self.index, end = codec.read_index(f, end)
+        self.codec = self.header.get("codec")
+        if self.codec is not None:
+            if self.codec["name"] != codec.codec_name:
+                raise IOError("Unknown codec {}".format(self.codec["name"]))
+            if self.index is not None:
+                self._blocks = (self.index["offset"], self.index["frames"])
+            else:
+                with open(fn, "rb") as f:
+                    self._blocks = codec.scan_blocks(f, self.data_offset, end)
+            self._starts = numpy.cumsum(numpy.append(0, self._blocks[1]))
+            self._nsamples = int(self._starts[-1])
+            self.data = None
+            return
+        payload = end - self.data_offset
+        nsamples = payload // (self.dtype.itemsize*nch) if nch else 0
+        self._nsamples = nsamples
+        if nsamples > 0:
+            self.data = numpy.memmap(fn, dtype=self.dtype, mode="r",
+                                     offset=self.data_offset,
+                                     shape=(nsamples, nch))
+        else:
+            self.data = numpy.zeros((0, nch), dtype=self.dtype)
+
+    @property
+    def sample_rate(self):
+        """
+        Rate of the samples in the file (Hz), i.e. after downsampling
+        """
+        return self.header["freq_hz"]/float(self.header.get("downsample", 1))
+
+    @property
+    def bit_shift(self):
+        return self.header.get("bit_shift", 0)
+
+    def __len__(self):
+        return self._nsamples
+
+    def channel_index(self, channels):
+        """
+        Column indices for channels, which may be given as channel numbers
+        (as in channel_list) or names, a single channel or a list.  None
+        means all channels.
+        """
+        if channels is None:
+            return list(range(len(self.channel_list)))
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        idx = []
+        for c in channels:
+            if c in self.names:
+                idx.append(self.names.index(c))
+            elif c in self.channel_list:
+                idx.append(self.channel_list.index(c))
+            else:
+                raise KeyError("Channel {} not in file".format(c))
+        return idx
+
+    def read(self, start=None, stop=None, channels=None, shift=False):
+        """
+        Samples [start, stop) of channels, as a (samples, channels) array.
+        If shift, the data is right-shifted by the header's bit_shift.
+        """
+        if self.codec is not None:
+            out = self._decode(start, stop)[:, self.channel_index(channels)]
+        else:
+            out = self.data[start:stop, self.channel_index(channels)]
+        if shift and self.bit_shift:
+            out = numpy.right_shift(out, self.bit_shift)
+        return out
+
+    def _decode(self, start, stop):
+        """
+        Frames [start, stop) of a compressed file, from the blocks holding
+        them
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        nch = len(self.channel_list)
+        if stop <= start:
+            return numpy.zeros((0, nch), dtype=self.dtype)
+        first = numpy.searchsorted(self._starts, start, "right") - 1
+        last = numpy.searchsorted(self._starts, stop, "left")
+        parts = []
+        with open(self.filename, "rb") as f:
+            for b in range(first, last):
+                parts.append(codec.read_block(f, self._blocks[0][b], nch,
+                                              self.dtype))
+        out = numpy.concatenate(parts) if len(parts) > 1 else parts[0]
+        lo = start - self._starts[first]
+        return out[lo:lo + stop - start]
+
+    def block_stats(self, channels=None):
+        """
+        From the index: (start, frames, min, max, mean, rms) of every block,
+        the statistics as (blocks, channels) arrays, e.g. for an overview
+        of the file without reading the data
+        """
+        if self.index is None:
+            raise IOError("{} has no index".format(self.filename))
+        idx = self.channel_index(channels)
+        return tuple([self.index["start"], self.index["frames"]] +
+                     [self.index[k].reshape(len(self.index["start"]), -1)[:, idx]
+                      for k in ("min", "max", "mean", "rms")])
+
+    def find_run_sample(self, run_sample):
+        """
+        Sample of the file holding run_sample (of the readout, i.e. the spad
+        counter - 1), from the segments of the index.  None if it was not
+        written.
+        """
+        if self.index is None:
+            raise IOError("{} has no index".format(self.filename))
+        ds = self.header.get("downsample", 1)
+        for first, n, rs in self.index["segments"]:
+            if rs <= run_sample < rs + n*ds:
+                return first + (run_sample - rs) // ds
+        return None
+
+    def read_time(self, t_start=None, t_stop=None, channels=None, shift=False):
+        """
+        As read, but with start/stop given in seconds from the beginning of
+        the file
+        """
+        rate = self.sample_rate
+        start = int(numpy.ceil(t_start*rate)) if t_start is not None else None
+        stop = int(numpy.ceil(t_stop*rate)) if t_stop is not None else None
+        return self.read(start, stop, channels, shift)
+
+
+def recording_files(fn):
+    """
+    All files of the recording fn belongs to, in order.  fn can be one of
+    the rotated files (name-N.dig) or the base name (name.dig).
+    """
+    base, ext = os.path.splitext(fn)
+    m = re.match(r"(.*)-(\d+)$", base)
+    if m and os.path.exists(fn):
+        base = m.group(1)
+    dirname, prefix = os.path.split(base)
+    pat = re.compile(re.escape(prefix) + r"-(\d+)" + re.escape(ext) + "$")
+    files = []
+    for f in os.listdir(dirname or "."):
+        m = pat.match(f)
+        if m:
+            files.append((int(m.group(1)), os.path.join(dirname, f)))
+    if not files and os.path.exists(fn):
+        return [fn]
+    return [f for _, f in sorted(files)]
+
+
+class DigRecording(object):
+    """
+    The files of one readout (name-0.dig, name-1.dig, ...) as one logical
+    recording, sample indices run continuously across files.
+    """
+    def __init__(self, fn):
+        self.files = [DigFile(f) for f in recording_files(fn)]
+        if not self.files:
+            raise IOError("No .dig files found for {}".format(fn))
+        self.header = self.files[0].header
+        self._starts = numpy.cumsum([0] + [len(f) for f in self.files])
+
+    @property
+    def sample_rate(self):
+        return self.files[0].sample_rate
+
+    @property
+    def channel_list(self):
+        return self.files[0].channel_list
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def read(self, start=None, stop=None, channels=None, shift=False):
+        """
+        Samples [start, stop) of channels across files, only the
+        requested region is read from disk.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        parts = []
+        for i, f in enumerate(self.files):
+            lo, hi = self._starts[i], self._starts[i+1]
+            if hi <= start or lo >= stop:
+                continue
+            parts.append(f.read(max(start, lo) - lo, min(stop, hi) - lo,
+                                channels, shift))
+        if not parts:
+            return self.files[0].read(0, 0, channels, shift)
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts)
+
+    def read_time(self, t_start=None, t_stop=None, channels=None, shift=False):
+        rate = self.sample_rate
+        start = int(numpy.ceil(t_start*rate)) if t_start is not None else None
+        stop = int(numpy.ceil(t_stop*rate)) if t_stop is not None else None
+        return self.read(start, stop, channels, shift)
+
+    def iter_chunks(self, chunk_size=1024*1024, channels=None, shift=False):
+        """
+        Iterate over the whole recording in chunks of chunk_size samples
+        """
+        for s in range(0, len(self), chunk_size):
+            yield self.read(s, s + chunk_size, channels, shift)
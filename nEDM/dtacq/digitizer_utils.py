@@ -4,6 +4,15 @@ from .settings import dtacq_un, dtacq_pw
 class OpenNewReadoutFile(object):
     pass
 
+class WritePreviousBuffer(object):
+    """
+    Trigger command: write frames [start, end) of the previous buffer, e.g.
+    for pre-trigger data of an event at the start of the current buffer
+    """
+    def __init__(self, start, end=None):
+        self.start = start
+        self.end = end
+
 class ReadoutException(Exception):
     pass
 
@@ -0,0 +1,279 @@
+"""
+Merged recording of several cards into one .dig file
+
+Cards running on a common (external) clock are aligned by their sample
+counters: ReadoutObj validates the spad counter of every buffer, so
+card.samples_seen is the index (from the start of the card's run) of the
+sample following the buffer.  A sample index i of card k is placed at
+
+  i + offset[k]
+
+on the common axis of the merged file.  With align="counter" all offsets are
+0 (cards started together, e.g. by a common trigger).  With align="clock"
+they are estimated from the arrival time of the first buffer of every card,
+for cards started independently.  Offsets can also be given explicitly.
+
+The start time of every card's run is estimated continuously as
+min(arrival - samples/freq); the differences between cards (in samples) are
+reported as skew, together with how far each card is behind the others.
+"""
+import datetime
+import threading
+import collections
+import numpy
+from twisted.internet import defer
+from .digitizer_utils import ReadoutException
+from .database import UploadClass
+from .readout import ReadoutObj
+from .processing import deinterleave
+from . import cards
+
+
+class _CardStream(object):
+    """
+    Pending (deinterleaved) data of one card
+    """
+    def __init__(self, obj, ch_list):
+        self.obj = obj
+        self.ch_list = ch_list
+        # Chunks of (first index on the common axis, (samples, channels) array)
+        self.pending = collections.deque()
+        self.end = None
+        self.offset = None
+        self.t0 = None
+
+    def take(self, start, stop):
+        """
+        Remove and return the rows [start, stop) of the common axis, rows
+        before start are dropped
+        """
+        out = []
+        while self.pending and start < stop:
+            first, arr = self.pending[0]
+            if first + len(arr) <= start:
+                self.pending.popleft()
+                continue
+            lo = max(start - first, 0)
+            hi = min(stop - first, len(arr))
+            out.append(arr[lo:hi])
+            if hi == len(arr):
+                self.pending.popleft()
+            else:
+                self.pending[0] = (first + hi, arr[hi:])
+            start = first + hi
+        return out
+
+
+class MergedReadout(object):
+    """
+    Reads out the cards of objs (ReadoutObj) at the same time and writes all
+    their channels into one file with a common sample axis.
+
+    max_pending is the number of samples a card may be ahead of the slowest
+    card before the readout is stopped.
+    """
+    def __init__(self, objs, align="counter", offsets=None,
+                 max_pending=10*1024*1024):
+        if len(objs) < 2:
+            raise ReadoutException("Merging needs at least two cards")
+        if align not in ("counter", "clock"):
+            raise ReadoutException("align must be 'counter' or 'clock'")
+        for o in objs:
+            if isinstance(o.card, cards.ACQ425ELFLIA):
+                raise ReadoutException("'{}' sends no sample counter, cannot merge".format(o.ip_addr))
+        if len(set(o.readout_size for o in objs)) != 1:
+            raise ReadoutException("Cards to merge must have the same sample size")
+        self.objs = objs
+        self.align = align
+        self.offsets = offsets or {}
+        self.max_pending = max_pending
+        self.upload_class = None
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._written = None
+        self._error = None
+        self._ready = False
+
+    @property
+    def isRunning(self):
+        return any(o.isRunning for o in self.objs)
+
+    def startReadout(self, **kw):
+        """
+        Starts all cards, kw are passed on to each ReadoutObj.startReadout
+        (without file writing, channel_list is taken from channel_lists)
+        except:
+
+          channel_lists - { ip : channel list } of the channels to record,
+                          default all channels of a card
+          should_save   - write the merged file (and upload it)
+          compression   - write it compressed, as for ReadoutObj
+          log, logitems, measurement_name - for the merged header
+
+        Returns a Deferred firing when all cards have stopped
+        """
+        if self.isRunning:
+            raise ReadoutException("Merged readout already running")
+        ch_lists = kw.pop("channel_lists", {})
+        should_save = kw.pop("should_save", False)
+        kw["should_upload"] = False
+        kw.pop("trigger", None)
+
+        self._streams = {}
+        self._written = None
+        self._error = None
+        # Buffers arriving before everything is set up are not merged, the
+        # common axis simply starts later
+        self._ready = False
+        ds = []
+        try:
+            for o in self.objs:
+                ml = kw.get("mod_list", sorted(o.available_modules))
+                okw = dict(kw, mod_list=ml)
+                ch = ch_lists.get(o.ip_addr,
+                       list(range(sum(o.available_modules[m] for m in ml))))
+                self._streams[o.ip_addr] = _CardStream(o, list(ch))
+                o.merge_sink = self
+                ds.append(o.startReadout(**okw))
+        except:
+            for o in self.objs:
+                o.merge_sink = None
+                if o.isRunning:
+                    o.stopReadout()
+            raise
+
+        freqs = [o.freq for o in self.objs]
+        if max(freqs) - min(freqs) > 1e-6*max(freqs):
+            self.stopReadout()
+            raise ReadoutException("Cards run at different frequencies: {}".format(freqs))
+        self.freq = freqs[0]
+
+        if should_save:
+            dt = str(datetime.datetime.utcnow())
+            names = []
+            for o in self.objs:
+                names.extend("{}:{}".format(o.ip_addr, c)
+                             for c in self._streams[o.ip_addr].ch_list)
+            header = { "channels" : len(names),
+                       "log" : kw.get("log", ""),
+                       "byte_depth" : self.objs[0].readout_size,
+                       "bit_shift" : self.objs[0].bit_right_shift,
+                       "is_float" : False,
+                       "ip" : [o.ip_addr for o in self.objs],
+                       "downsample" : 1,
+                       "date" : dt,
+                       "freq_hz" : self.freq,
+                       "measurement_name" : kw.get("measurement_name", "Merged digitizers"),
+                       "channel_list" : list(range(len(names))),
+                       "channel_names" : names,
+                       "merged" : [dict(ip=o.ip_addr,
+                                        channel_list=self._streams[o.ip_addr].ch_list,
+                                        current_gains=o.readCurrentGains())
+                                   for o in self.objs],
+                       "align" : self.align,
+                       "filename" : dt.replace(':', '-') + ".dig"
+                     }
+            for k, v in kw.get("logitems", {}).items():
+                header[k] = v
+            self.upload_class = UploadClass(header,
+                                  compression=ReadoutObj._compression(kw))
+
+        self._ready = True
+        d = defer.DeferredList(ds)
+        d.addCallback(self._finished)
+        return d
+
+    def stopReadout(self, **kw):
+        for o in self.objs:
+            if o.isRunning:
+                o.stopReadout()
+
+    def add(self, obj, v, t_arrival):
+        """
+        Called by obj (from its readout thread) with every validated buffer
+        """
+        nch = obj.total_ch
+        n = len(v) // nch
+        if n == 0 or not self._ready:
+            return
+        # Index of the first sample of v in the card's run
+        first = obj.card.samples_seen - n
+        with self._lock:
+            if self._error is not None:
+                raise ReadoutException(self._error)
+            st = self._streams[obj.ip_addr]
+            t0 = t_arrival - (first + n)/self.freq
+            st.t0 = t0 if st.t0 is None else min(st.t0, t0)
+            if st.offset is None:
+                st.offset = self._initialOffset(obj.ip_addr, st)
+            start = first + st.offset
+            st.pending.append((start, deinterleave(v, nch, st.ch_list)))
+            st.end = start + n
+            self._flush()
+
+    def _initialOffset(self, ip, st):
+        if ip in self.offsets:
+            return int(self.offsets[ip])
+        if self.align == "counter":
+            return 0
+        # Relative to the first card that delivered data
+        ref = [s for s in self._streams.values() if s.offset is not None]
+        if not ref:
+            return 0
+        return int(round((st.t0 - ref[0].t0)*self.freq)) + ref[0].offset
+
+    def _flush(self):
+        streams = list(self._streams.values())
+        if any(s.end is None for s in streams):
+            return
+        if self._written is None:
+            # Common axis starts where every card has data
+            self._written = max(s.pending[0][0] for s in streams if s.pending)
+        stop = min(s.end for s in streams)
+        if stop > self._written:
+            parts = [numpy.concatenate(s.take(self._written, stop))
+                     for s in streams]
+            if self.upload_class is not None:
+                self.upload_class.writeToFile(numpy.hstack(parts), self._written)
+            self._written = stop
+        ahead = max(s.end for s in streams) - stop
+        if ahead > self.max_pending:
+            lagging = [s.obj.ip_addr for s in streams if s.end == stop]
+            self._error = "Card(s) {} lagging by {} samples, stopping merged readout".format(
+                          ", ".join(lagging), ahead)
+            raise ReadoutException(self._error)
+
+    def mergeStats(self, **kw):
+        """
+        Per card: offset on the common axis, skew (difference of the
+        estimated run start to the first card, in samples and seconds) and
+        the number of samples it is ahead of the common written position
+        """
+        with self._lock:
+            streams = [self._streams[o.ip_addr] for o in self.objs
+                       if o.ip_addr in self._streams]
+            ref = streams[0].t0 if streams else None
+            res = {}
+            for s in streams:
+                skew = None
+                if s.t0 is not None and ref is not None:
+                    skew = s.t0 - ref
+                res[s.obj.ip_addr] = dict(
+                  offset=s.offset,
+                  skew_s=skew,
+                  skew_samples=None if skew is None else skew*self.freq,
+                  ahead=None if s.end is None or self._written is None
+                             else s.end - self._written)
+            return dict(cards=res, written=self._written, error=self._error)
+
+    def _finished(self, results):
+        for o in self.objs:
+            o.merge_sink = None
+        res = [r for _, r in results]
+        stats = dict(type="MergeStats", stats=self.mergeStats())
+        if self.upload_class is not None:
+            uc, self.upload_class = self.upload_class, None
+            d = uc.closeAndUploadFile()
+            d.addCallback(lambda up: res + [up, stats])
+            return d
+        return res + [stats]
@@ -0,0 +1,392 @@
+"""
+Per-buffer processing of readouts in worker processes
+
+Selecting the channels of a buffer and downsampling it for the file runs in
+Python (numpy) under the GIL, on the same interpreter as the readout
+callback and the Twisted reactor.  A ProcessingPool moves this work to
+worker processes:
+
+  - the workers and the slots of shared memory (multiprocessing.RawArray)
+    they work on are created once, with start_pool at server start-up,
+    before the server has any threads or sockets a forked child would
+    inherit
+  - every readout gets a PoolRun from ProcessingPool.run, with the channels
+    and downsampling of that run
+  - the readout thread copies each buffer into a free slot and queues it,
+    blocking when all slots are in use
+  - any idle worker computes the output for the file into the output part
+    of the slot
+  - a commit thread of the run takes the results in the order the buffers
+    were submitted and hands them to commit(meta, out), e.g. to write them
+
+Stateful steps stay in order outside of the workers: the readout validates
+buffers and calls the trigger before submitting, the commits run one after
+the other.  The FIR decimation is made independent of the order by giving
+every buffer the preceding Decimator.history frames of the stream, which
+determine the filter state completely (see processing.Decimator).
+"""
+import time
+import ctypes
+import pickle
+import logging
+import threading
+import traceback
+import multiprocessing
+import Queue
+import numpy
+from .processing import deinterleave, frames, select_channels, to_dtype
+from .digitizer_utils import ReadoutException
+
+
+def _output(cfg, v, history):
+    """
+    Output for the frames of v after the first history ones, for the run
+    configuration cfg (see PoolRun)
+    """
+    if cfg["decimator"] is None:
+        return deinterleave(v, cfg["total_ch"], cfg["ch_list"], cfg["ds"], cfg["ds_dtype"])
+    f = select_channels(frames(v, cfg["total_ch"]), cfg["ch_list"])
+    if cfg["bit_shift"]:
+        f = numpy.right_shift(f, cfg["bit_shift"])
+    dec, ds = cfg["decimator"], cfg["ds"]
+    dec.reset()
+    y = dec.process(f)[(history + ds - 1)//ds:]
+    return to_dtype(y, cfg["ds_dtype"], cfg["ds_scale"])
+
+
+class ProcessingPool(object):
+    """
+    workers processes and slots (default 2*workers + 2) buffers of shared
+    memory of slot_bytes each, used by the runs of all readouts.  The
+    workers are forked when the pool is created, it has to be done before
+    the process starts any threads or opens sockets (see start_pool).
+    """
+    def __init__(self, workers, slots=None, slot_bytes=16*1024*1024):
+        if workers < 1:
+            raise ReadoutException("workers must be >= 1")
+        self.workers = workers
+        self.slot_bytes = slot_bytes
+        self._slots = [multiprocessing.RawArray(ctypes.c_char, slot_bytes)
+                       for _ in range(slots or 2*workers + 2)]
+        self._free = Queue.Queue()
+        for i in range(len(self._slots)):
+            self._free.put(i)
+
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._procs = [multiprocessing.Process(target=self._work, name="ProcessingPool-{}".format(i))
+                       for i in range(workers)]
+        for p in self._procs:
+            p.daemon = True
+            p.start()
+
+        # Threads only after the fork
+        self._lock = threading.Lock()
+        self._runs = {}
+        self._next_run = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._dispatch, name="ProcessingPool-results")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        # Runs in the worker processes
+        configs = {}
+        while True:
+            t = self._tasks.get()
+            if t is None:
+                return
+            run_id, cfg, task_id, slot, n, history, out_offset = t
+            try:
+                if run_id not in configs:
+                    if len(configs) > 8:
+                        configs.clear()
+                    configs[run_id] = pickle.loads(cfg)
+                cfg = configs[run_id]
+                v = numpy.frombuffer(self._slots[slot], dtype=cfg["dtype"], count=n)
+                y = _output(cfg, v, history)
+                out = numpy.frombuffer(self._slots[slot], dtype=y.dtype, count=y.size,
+                                       offset=out_offset)
+                out[:] = y.ravel()
+                self._results.put((run_id, task_id, slot, y.shape, y.dtype.str, None))
+            except Exception:
+                self._results.put((run_id, task_id, slot, None, None, traceback.format_exc()))
+
+    def _dispatch(self):
+        # Results go to the commit thread of their run, slots of runs that
+        # were terminated are free again
+        while True:
+            r = self._results.get()
+            if r is None:
+                return
+            with self._lock:
+                run = self._runs.get(r[0])
+                if run is not None:
+                    run._results.put(r[1:])
+                    continue
+            self._free.put(r[2])
+
+    def _checkWorkers(self):
+        # A worker that died (e.g. killed for lack of memory) never returns
+        # its buffer, nothing after it can be committed.  Workers are not
+        # forked again, the pool is unusable.
+        for p in self._procs:
+            if not p.is_alive() and self.error is None:
+                self.error = ReadoutException("Processing worker {} died (exit code {})".format(p.name, p.exitcode))
+                logging.error(str(self.error))
+
+    def run(self, commit, total_ch, ch_list, buffer_size, dtype, downsample=1,
+            ds_dtype=numpy.float64, decimator=None, ds_scale=1, bit_shift=0,
+            max_pending=None):
+        """
+        Start a run, see PoolRun
+        """
+        self._checkWorkers()
+        if self.error is not None:
+            raise self.error
+        with self._lock:
+            run_id = self._next_run
+            self._next_run += 1
+        run = PoolRun(self, run_id, commit, total_ch, ch_list, buffer_size,
+                      dtype, downsample, ds_dtype, decimator, ds_scale,
+                      bit_shift, max_pending)
+        with self._lock:
+            self._runs[run_id] = run
+        return run
+
+    def shutdown(self):
+        """
+        End the workers, runs still going are terminated
+        """
+        if not self._procs:
+            return
+        with self._lock:
+            runs = list(self._runs.values())
+        for run in runs:
+            run.terminate()
+        for p in self._procs:
+            self._tasks.put(None)
+        for p in self._procs:
+            p.join(5.)
+            if p.is_alive():
+                p.terminate()
+        self._procs = []
+        self._results.put(None)
+        self._thread.join()
+
+
+class PoolRun(object):
+    """
+    Computes for every buffer submitted the (frames, len(ch_list)) array of
+    its channels ch_list as written to file, downsampled by downsample
+    (block mean, or with decimator, a processing.Decimator, its output of
+    right-shifted samples as ds_dtype scaled by ds_scale), in the workers
+    of pool.
+
+    Buffers hold at most buffer_size samples of dtype.  At most
+    max_pending buffers (default 2*workers) are processed at a time.
+    commit(meta, out) is called from the commit thread, in submission
+    order, out stays valid until the following commit returns (so the
+    output of the previous buffer can be used).
+    """
+    def __init__(self, pool, run_id, commit, total_ch, ch_list, buffer_size,
+                 dtype, downsample, ds_dtype, decimator, ds_scale, bit_shift,
+                 max_pending):
+        self.pool = pool
+        self.run_id = run_id
+        self.commit = commit
+        self.total_ch = total_ch
+        self.dtype = numpy.dtype(dtype)
+        self.ds = downsample
+        self.max_frames = buffer_size // total_ch
+        self.max_pending = max_pending or 2*pool.workers
+
+        # Raw frames kept from the previous buffers for the decimator, the
+        # first frame given to it has to be a multiple of downsample
+        self.keep = 0
+        if decimator is not None:
+            self.keep = -(-decimator.history // downsample)*downsample + downsample
+        self._tail = numpy.empty(0, dtype=self.dtype)
+
+        # Input, then the output, in a slot
+        ds_dtype = numpy.dtype(ds_dtype)
+        in_frames = self.keep + self.max_frames
+        if downsample == 1:
+            out_bytes = self.max_frames*self.dtype.itemsize
+        else:
+            out_bytes = (in_frames//downsample + 1)*ds_dtype.itemsize
+        in_bytes = in_frames*total_ch*self.dtype.itemsize
+        self._out_offset = -(-in_bytes // 16)*16
+        need = self._out_offset + out_bytes*len(ch_list)
+        if need > pool.slot_bytes:
+            raise ReadoutException("Buffers need {:.1f} MB per processing slot, the pool has {:.1f} MB".format(need/1e6, pool.slot_bytes/1e6))
+        self._cfg = pickle.dumps(dict(total_ch=total_ch, ch_list=list(ch_list),
+                                      dtype=self.dtype, ds=downsample,
+                                      ds_dtype=ds_dtype, decimator=decimator,
+                                      ds_scale=ds_scale, bit_shift=bit_shift),
+                                 pickle.HIGHEST_PROTOCOL)
+
+        self._cond = threading.Condition(threading.Lock())
+        self._meta = {}
+        self._results = Queue.Queue()
+        self._stopped = False
+        self.frames = 0
+        self.submitted = self.committed = 0
+        self.blocked = 0.
+        self.error = None
+        self._thread = threading.Thread(target=self._commitLoop, name="ProcessingPool-commit")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def check(self):
+        """
+        Raise the first error of the workers or of commit
+        """
+        if self.error is None and self.pool.error is not None:
+            self.error = self.pool.error
+        if self.error is not None:
+            raise self.error
+
+    def _wait(self, cond):
+        # Wait until cond() (called with _cond held), checking the workers
+        t0 = time.time()
+        with self._cond:
+            while not cond():
+                self._cond.wait(1.)
+                self.pool._checkWorkers()
+                self.check()
+        self.blocked += time.time() - t0
+
+    def _acquire(self):
+        t0 = time.time()
+        while True:
+            try:
+                slot = self.pool._free.get(timeout=1.)
+                break
+            except Queue.Empty:
+                self.pool._checkWorkers()
+                self.check()
+        self.blocked += time.time() - t0
+        return slot
+
+    def submit(self, v, meta=None, process=True):
+        """
+        Queue the interleaved buffer v, commit will be called with meta and
+        its output.  Every buffer of the stream has to be given, those
+        without output with process False.
+        """
+        self.check()
+        tc = self.total_ch
+        n = len(v) // tc
+        start = self.frames
+        self.frames += n
+        if process:
+            if n > self.max_frames:
+                raise ReadoutException("Buffer of {} frames exceeds the pool's {}".format(n, self.max_frames))
+            history = 0
+            if self.keep:
+                history = start - max(0, ((start - self.keep + self.ds)//self.ds)*self.ds)
+            self._wait(lambda: self.submitted - self.committed < self.max_pending)
+            slot = self._acquire()
+            buf = numpy.frombuffer(self.pool._slots[slot], dtype=self.dtype, count=(history + n)*tc)
+            buf[:history*tc] = self._tail[len(self._tail) - history*tc:]
+            buf[history*tc:] = v[:n*tc]
+            with self._cond:
+                task_id = self.submitted
+                self._meta[task_id] = meta
+                self.submitted += 1
+            self.pool._tasks.put((self.run_id, self._cfg, task_id, slot, len(buf),
+                                  history, self._out_offset))
+        if self.keep:
+            if n >= self.keep:
+                self._tail = v[(n - self.keep)*tc:n*tc].copy()
+            else:
+                self._tail = numpy.concatenate([self._tail, v[:n*tc]])[-self.keep*tc:]
+
+    def _commitLoop(self):
+        free = self.pool._free
+        done = {}
+        prev = None
+        while True:
+            r = self._results.get()
+            if r is None:
+                break
+            done[r[0]] = r
+            while self.committed in done:
+                task_id, slot, shape, dt, err = done.pop(self.committed)
+                with self._cond:
+                    meta = self._meta.pop(task_id)
+                if err is not None and self.error is None:
+                    logging.error("Processing of a buffer failed:\n" + err)
+                    self.error = ReadoutException("Processing of a buffer failed")
+                if self.error is None and not self._stopped:
+                    try:
+                        dt = numpy.dtype(dt)
+                        out = numpy.frombuffer(self.pool._slots[slot], dtype=dt,
+                                               count=int(numpy.prod(shape)),
+                                               offset=self._out_offset).reshape(shape)
+                        self.commit(meta, out)
+                    except Exception as e:
+                        logging.exception("Error committing a buffer")
+                        self.error = e
+                # The previous slot is no longer needed by commit
+                if prev is not None:
+                    free.put(prev)
+                prev = slot
+                with self._cond:
+                    self.committed += 1
+                    self._cond.notify_all()
+        for r in done.values():
+            free.put(r[1])
+        if prev is not None:
+            free.put(prev)
+
+    def close(self):
+        """
+        Wait for all buffers to be committed and end the run
+        """
+        with self._cond:
+            while self.committed < self.submitted and \
+                  self.error is None and self.pool.error is None:
+                self._cond.wait(1.)
+                self.pool._checkWorkers()
+        self.terminate()
+
+    def terminate(self):
+        """
+        End the run without waiting for pending buffers, their slots are
+        freed when the workers are done with them
+        """
+        with self.pool._lock:
+            if self.pool._runs.pop(self.run_id, None) is None:
+                return
+        self._stopped = True
+        self._results.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._cond:
+            return dict(workers=self.pool.workers, submitted=self.submitted,
+                        committed=self.committed,
+                        pending=self.submitted - self.committed,
+                        slots=len(self.pool._slots), blocked_s=self.blocked,
+                        error=None if self.error is None else str(self.error))
+
+
+_pool = None
+
+def start_pool(workers, slots=None, slot_bytes=16*1024*1024):
+    """
+    Create the process-wide pool, to be called at start-up before the
+    process has threads (e.g. before the reactor runs)
+    """
+    global _pool
+    if _pool is None and workers:
+        _pool = ProcessingPool(workers, slots, slot_bytes)
+    return _pool
+
+def get_pool():
+    """
+    The pool of start_pool, None if there is none
+    """
+    return _pool
@@ -0,0 +1,261 @@
+"""
+Vectorized operations on interleaved readout buffers
+
+A readout buffer is a flat array of frames, each frame holding one sample of
+every channel (total_ch values, including the spad words).
+"""
+import numpy
+
+
+def frames(v, total_ch):
+    """
+    (frames, total_ch) view of v, a trailing partial frame is dropped
+    """
+    n = len(v) // total_ch
+    return v[:n*total_ch].reshape(n, total_ch)
+
+
+def select_channels(f, ch_list):
+    """
+    Columns ch_list of the frame array f, as a contiguous (frames, channels)
+    array.  A run of consecutive channels is taken as a slice.
+    """
+    ch_list = list(ch_list)
+    if len(ch_list) > 0 and \
+       ch_list == list(range(ch_list[0], ch_list[0] + len(ch_list))):
+        return numpy.ascontiguousarray(f[:, ch_list[0]:ch_list[0]+len(ch_list)])
+    return numpy.take(f, ch_list, axis=1)
+
+
+def block_mean(f, ds, dtype=numpy.float64):
+    """
+    Mean of non-overlapping blocks of ds frames along the first axis, frames
+    not filling a complete block are dropped.  Integer input is summed in
+    64-bit integers so that the result is exact before the final division.
+    """
+    n = (f.shape[0] // ds)*ds
+    blocks = f[:n].reshape((n // ds, ds) + f.shape[1:])
+    if f.dtype.kind in "iu":
+        out = blocks.sum(axis=1, dtype=numpy.int64).astype(dtype)
+    else:
+        out = blocks.sum(axis=1, dtype=dtype)
+    out /= ds
+    return out
+
+
+def deinterleave(v, total_ch, ch_list, downsample=1, dtype=numpy.float64):
+    """
+    Return the channels ch_list of the interleaved buffer v as a
+    (frames, len(ch_list)) array, ready to be written to file.  If
+    downsample > 1, blocks of downsample frames are averaged and the output
+    is of type dtype.
+    """
+    sel = select_channels(frames(v, total_ch), ch_list)
+    if downsample == 1:
+        return sel
+    return block_mean(sel, downsample, dtype)
+
+
+def to_dtype(y, dtype, scale=1):
+    """
+    Float array y as dtype, for integer types scaled by scale, rounded and
+    clipped to the range of the type
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == "f":
+        return y.astype(dtype)
+    info = numpy.iinfo(dtype)
+    return numpy.clip(numpy.rint(y*scale), info.min, info.max).astype(dtype)
+
+
+def envelope(f, width):
+    """
+    Min, max and mean of the frame array f ((frames, channels)) in width
+    bins of (nearly) equal numbers of frames, as (bins, channels) arrays.
+    With fewer frames than width every frame is its own bin.
+    """
+    n = f.shape[0]
+    if n <= width:
+        return f, f, f.astype(numpy.float64)
+    starts = (numpy.arange(width)*n) // width
+    counts = numpy.diff(numpy.append(starts, n))
+    acc = numpy.int64 if f.dtype.kind in "iu" else numpy.float64
+    mean = numpy.add.reduceat(f, starts, axis=0, dtype=acc) / counts[:, None].astype(numpy.float64)
+    return (numpy.minimum.reduceat(f, starts, axis=0),
+            numpy.maximum.reduceat(f, starts, axis=0), mean)
+
+
+def live_envelope(v, total_ch, ch_list, width, dtype=numpy.float32):
+    """
+    Envelope of the channels ch_list of the interleaved buffer v for
+    display, a (3, len(ch_list), bins) array of min, max and mean
+    """
+    mn, mx, mean = envelope(select_channels(frames(v, total_ch), ch_list), width)
+    out = numpy.empty((3, mn.shape[1], mn.shape[0]), dtype=dtype)
+    out[0] = mn.T
+    out[1] = mx.T
+    out[2] = mean.T
+    return out
+
+
+def fir_lowpass(pass_edge, stop_edge, atten=80.):
+    """
+    Kaiser-windowed sinc lowpass with unit DC gain, passing frequencies
+    below pass_edge and attenuating those above stop_edge by atten dB
+    (frequencies in units of the input sample rate)
+    """
+    width = stop_edge - pass_edge
+    n = int(numpy.ceil((atten - 7.95)/(14.36*width))) + 1
+    n += 1 - n % 2
+    beta = 0.1102*(atten - 8.7) if atten > 50 else \
+           0.5842*(atten - 21)**0.4 + 0.07886*(atten - 21) if atten > 21 else 0.
+    m = numpy.arange(n) - (n - 1)/2.
+    fc = (pass_edge + stop_edge)/2.
+    h = numpy.sinc(2*fc*m)*numpy.kaiser(n, beta)
+    return h/h.sum()
+
+
+def stage_factors(factor, max_stage=8):
+    """
+    Split factor into decimation stages of at most max_stage (a larger
+    prime factor is a stage on its own), largest first
+    """
+    primes, f, p = [], factor, 2
+    while p*p <= f:
+        while f % p == 0:
+            primes.append(p)
+            f //= p
+        p += 1
+    if f > 1:
+        primes.append(f)
+    stages = []
+    for p in sorted(primes, reverse=True):
+        for i, s in enumerate(stages):
+            if s*p <= max_stage:
+                stages[i] *= p
+                break
+        else:
+            stages.append(p)
+    return sorted(stages, reverse=True)
+
+
+def can_decimate(factor, max_stage=8):
+    """
+    Whether a Decimator can be built for factor, i.e. it has no prime
+    factor above max_stage
+    """
+    return all(s <= max_stage for s in stage_factors(factor, max_stage))
+
+
+def downsample_filter(factor, name=None):
+    """
+    Filter ("fir" or "mean") to downsample by factor with: name, or by
+    default "fir" if a Decimator can be built for factor, "mean" otherwise
+    """
+    if name is None:
+        name = "fir" if can_decimate(factor) else "mean"
+    if name not in ("fir", "mean"):
+        raise ValueError("downsample_filter must be 'fir' or 'mean'")
+    return name
+
+
+class _FIRStage(object):
+    """
+    One decimation stage with filter h, keeping the last len(h) - 1 input
+    frames and the position of the next output across calls
+    """
+    def __init__(self, factor, nch, h, dtype):
+        self.factor = factor
+        self.h = h.astype(dtype)
+        self.nch = nch
+        self.reset()
+
+    def reset(self):
+        self.state = numpy.zeros((len(self.h) - 1, self.nch), dtype=self.h.dtype)
+        # Start of the next output's window in state + next input
+        self.start = 0
+
+    def process(self, x):
+        ntaps, m = len(self.h), self.factor
+        buf = numpy.concatenate([self.state, x])
+        avail = buf.shape[0] - ntaps - self.start
+        nout = avail // m + 1 if avail >= 0 else 0
+        y = numpy.zeros((nout, buf.shape[1]), dtype=buf.dtype)
+        if nout:
+            tmp = numpy.empty_like(y)
+            # Polyphase: every tap is one strided multiply-add over the
+            # outputs, only the retained samples are computed
+            for j, c in enumerate(self.h):
+                s = self.start + j
+                numpy.multiply(buf[s:s + (nout - 1)*m + 1:m], c, out=tmp)
+                y += tmp
+        self.start += nout*m - (buf.shape[0] - (ntaps - 1))
+        self.state = buf[buf.shape[0] - (ntaps - 1):]
+        return y
+
+
+class Decimator(object):
+    """
+    Stateful FIR decimation of (frames, channels) arrays by factor, in
+    cascaded polyphase stages of at most max_stage each.  The filter state
+    is carried over calls, so a stream may be passed in buffers of any
+    size; output k corresponds to input frame k*factor (delayed by delay
+    input frames, the linear phase of the filters).  Arithmetic is done in
+    dtype.
+
+    Frequencies up to passband (a fraction of the output Nyquist
+    frequency) are kept, anything that would alias below it is attenuated
+    by atten dB.  Early stages only have to protect that band, which keeps
+    their filters short.
+
+    The state after an input frame only depends on the last history input
+    frames, so a Decimator reset and fed from a frame that is a multiple of
+    factor at least history frames earlier gives the same outputs (from
+    there) as one that saw the whole stream.  It is pickled as its
+    parameters, unpickled it starts a new stream.
+    """
+    def __init__(self, factor, nch, max_stage=8, passband=0.8, atten=80.,
+                 dtype=numpy.float64):
+        self._args = (factor, nch, max_stage, passband, atten, numpy.dtype(dtype).str)
+        factors = stage_factors(factor, max_stage)
+        if not can_decimate(factor, max_stage):
+            # A single stage that large needs tens of thousands of taps
+            raise ValueError("Decimation factor {} has a prime factor above {}".format(factor, max_stage))
+        self.factor = factor
+        self.dtype = numpy.dtype(dtype)
+        self.stages = []
+        remaining = factor
+        for f in factors:
+            # Band edge of the final output, at this stage's input rate
+            fp = passband*0.5/remaining
+            self.stages.append(_FIRStage(f, nch, fir_lowpass(fp, 1./f - fp, atten),
+                                         self.dtype))
+            remaining //= f
+        self.delay, self.history, step = 0., 0, 1
+        for s in self.stages:
+            self.delay += (len(s.h) - 1)/2.*step
+            self.history += (len(s.h) - 1)*step
+            step *= s.factor
+
+    def __reduce__(self):
+        return (Decimator, self._args)
+
+    def reset(self):
+        """
+        Start a new stream
+        """
+        for s in self.stages:
+            s.reset()
+
+    def describe(self):
+        """
+        Description of the filter for file headers
+        """
+        return dict(kind="fir", stages=[s.factor for s in self.stages],
+                    taps=[len(s.h) for s in self.stages], delay=self.delay)
+
+    def process(self, x):
+        y = x.astype(self.dtype)
+        for s in self.stages:
+            y = s.process(y)
+        return y
@@ -2,22 +2,46 @@ import pyacq
 import numpy
 import threading
 import datetime
+import collections
+import time
 import traceback
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, threads
 from .digitizer_utils import (execute_cmd,
                               ReadoutException,
                               ReleaseDigitizerNow,
                               OpenNewReadoutFile,
+                              WritePreviousBuffer,
                               EndReadoutNow)
 import logging
-from .database import UploadClass
+from .database import UploadClass, session_pool
 from .decorators import (notRunning, isRunning)
-from .trigger import get_trigger
+from .trigger import get_trigger, ThresholdTrigger
+from .ring import BufferRing
+from .analysis import OnlineAnalysis
+from .pool import get_pool
+from .processing import (deinterleave, live_envelope, frames,
+                         select_channels, to_dtype, Decimator,
+                         downsample_filter)
 from . import cards
 import os
 
 
+def summarize_times(values):
+    """
+    Percentiles (and count, max) of a sequence of durations in seconds
+    """
+    if len(values) == 0:
+        return dict(count=0)
+    a = numpy.asarray(values, dtype=numpy.float64)
+    p50, p90, p99 = numpy.percentile(a, [50, 90, 99])
+    return dict(count=len(a), p50=p50, p90=p90, p99=p99, max=a.max(),
+                mean=a.mean())
+
+
 class ReadoutObj(object):
+    # Steps of __call__ whose duration is recorded for every buffer
+    stages = ("validate", "trigger", "write", "ring", "total")
+
     def __init__(self, ip_addr):
         self.ip_addr = ip_addr
         dev = pyacq.Device(str(ip_addr))
@@ -38,11 +62,18 @@ class ReadoutObj(object):
         # total number of channels available
         self.useExternalClock()
 
-        self.alock = threading.Lock()
-        self.cond = threading.Condition(self.alock)
-        self.obj_buffer = None
+        self.ring = BufferRing()
         self.upload_class = None
-        self.counter = -1
+        # Set by MergedReadout, gets every validated buffer
+        self.merge_sink = None
+        # Called with self after every buffer added to the ring
+        self._listeners = ()
+        self._channel_info = None
+        self.analysis = None
+        self.decimator = None
+        self.pool = None
+        self._has_file = False
+        self._resetTimings()
 
     def __getattr__(self, name):
         """
@@ -53,25 +84,42 @@ class ReadoutObj(object):
         except:
             raise AttributeError
 
+    def _resetTimings(self, n=4096):
+        # Durations of the last n buffers for each stage
+        self._timings = dict((s, collections.deque(maxlen=n)) for s in self.stages)
+        # Buffers of a batch left unprocessed after an error
+        self._dropped = 0
+
     def _add_to_list(self, al):
-        self.cond.acquire()
-        self.counter += 1
-        if self.counter >= 0xffffffff:
-            self.counter = 0
-        self.obj_buffer = numpy.copy(al)
-        self.cond.release()
-
-    def _pop_from_list(self):
-        anobj = None
-        self.cond.acquire()
-        anobj = self.obj_buffer
-        self.obj_buffer = None
-        ctr = self.counter
-        self.cond.release()
+        # The array owns its readout buffer (no copy needed), holding on
+        # to it only keeps that buffer out of the pool until it leaves the
+        # ring.
+        # Shared by all readers of the ring
+        al.flags.writeable = False
+        seq = self.ring.push(al)
+        for f in self._listeners:
+            f(self)
+        return seq
+
+    def addBufferListener(self, f):
+        """
+        f(self) is called from the readout thread whenever a buffer is
+        added to the ring
+        """
+        # Replaced, not modified, so the readout thread can iterate safely
+        if f not in self._listeners:
+            self._listeners = self._listeners + (f,)
+
+    def removeBufferListener(self, f):
+        self._listeners = tuple(x for x in self._listeners if x != f)
+
+    def _pop_from_list(self, reader=None):
+        anobj, seq, missed = self.ring.read(reader)
+        ctr = seq % 0xffffffff if seq >= 0 else -1
 
         if anobj is not None and self.bit_right_shift != 0:
             anobj = numpy.right_shift(anobj, self.bit_right_shift)
-        return anobj, ctr
+        return anobj, ctr, missed
 
     def resetReadout(self):
         """
@@ -102,8 +150,15 @@ class ReadoutObj(object):
         raise ReleaseDigitizerNow()
 
     def getChannels(self, **kw):
+        """
+        Channel and clock settings of the card.  With cached, the result of
+        the last query is returned (if any) without contacting the card,
+        used for streaming clients.
+        """
+        if kw.get("cached", False) and self._channel_info is not None:
+            return self._channel_info
         try:
-            return dict(mods=self.available_modules,
+            self._channel_info = dict(mods=self.available_modules,
                       divide=self.clk_divider,
              current_clk_div=int(self.dev.SendCommand("get.site 1 clkdiv")),
                 readout_size=self.readout_size,
@@ -113,6 +168,7 @@ class ReadoutObj(object):
                ext_frequency=self.ext_frequency,
                current_gains=self.readCurrentGains(),
                       sysclk=int(self.dev.SendCommand("get.site 1 sysclkhz")))
+            return self._channel_info
         except:
             # Getting here means we can't continue, reboot
             self.rebootCard()
@@ -120,7 +176,8 @@ class ReadoutObj(object):
     @notRunning
     def startReadout(self, **kw):
 
-        self.counter = -1
+        self.ring = BufferRing(kw.get("ring_size", 8),
+                               kw.get("ring_bytes", 64*1024*1024))
         ml = kw.get("mod_list", [])
         mods = ','.join(map(str,ml))
         if len(ml) == 0:
@@ -129,6 +186,7 @@ class ReadoutObj(object):
 
         self.card.reset(sum([self.available_modules[m] for m in ml]),
                         int(self.dev.SendCommand("NCHAN")))
+        self.card.full_validation = kw.get("full_validation", False)
 
         buffer_size = kw.get("buffer_size", 1*1024*1024)
         pts_per_frame = self.total_ch
@@ -137,7 +195,10 @@ class ReadoutObj(object):
 
         self.trigger = get_trigger(kw.get("trigger", ""))
 
-        self.last_offset = 0
+        self._prev_v = None
+        # Frames received in this run
+        self._run_frames = 0
+        self._resetTimings()
         self.upload_class = None
         self._exc = None
         freq = self.ext_frequency
@@ -146,6 +207,14 @@ class ReadoutObj(object):
         freq /= (int(self.dev.SendCommand("get.site 1 clkdiv"))*float(self.clk_divider))
         if freq < self.min_frequency:
             raise ReadoutException("Frequency ({}) below minimum ({})".format(freq, self.min_frequency))
+        self.freq = freq
+
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self._prev_out = None
+        # Set only here, read by the readout thread
+        self._has_file = False
 
         if kw.get("should_upload", False):
             dt = str(datetime.datetime.utcnow())
@@ -153,15 +222,48 @@ class ReadoutObj(object):
             if downsample < 1:
                 raise ReadoutException("downsample must be >= 1")
             buffer_size -= (pts_per_buffer % downsample)*pts_per_frame
+            if isinstance(self.trigger, ThresholdTrigger):
+                self.trigger.check_buffer(buffer_size // pts_per_frame)
 
             bit_shift = self.bit_right_shift
             byte_depth = self.readout_size
             is_float = False
+            # downsample_filter "fir" filters every channel with a stateful
+            # Decimator, "mean" averages blocks of downsample frames.  The
+            # default is "fir" if the factor can be decimated in stages,
+            # "mean" otherwise (e.g. for a prime factor like 11).
+            try:
+                ds_filter = downsample_filter(downsample, kw.get("downsample_filter", None))
+            except ValueError as e:
+                raise ReadoutException(str(e))
+            self.ds_dtype = numpy.dtype(kw.get("downsample_dtype", "float64"))
+            if self.ds_dtype.kind != "f" and \
+              (ds_filter != "fir" or self.ds_dtype not in (numpy.int16, numpy.int32)):
+                raise ReadoutException("downsample_dtype must be a float type (or int16/int32 with 'fir')")
+            self.decimator = None
             if downsample != 1:
                 bit_shift = 0
-                byte_depth = 8
-                is_float = True
+                byte_depth = self.ds_dtype.itemsize
+                is_float = self.ds_dtype.kind == "f"
+                if ds_filter == "fir":
+                    try:
+                        self.decimator = Decimator(downsample,
+                          len(kw.get("channel_list", [])),
+                          dtype=numpy.float32 if self.ds_dtype == numpy.float32 else numpy.float64)
+                    except ValueError as e:
+                        raise ReadoutException("{}, use downsample_filter 'mean' for it".format(e))
+                    # The filter works on ADC units, integer output keeps
+                    # as many fractional bits as fit (given as bit_shift)
+                    self.ds_scale = 1
+                    if not is_float:
+                        adc_bits = 8*self.readout_size - self.bit_right_shift
+                        if adc_bits > 8*byte_depth:
+                            # Would clip most of the signal
+                            raise ReadoutException("downsample_dtype {} is narrower than the {} bit ADC".format(self.ds_dtype.name, adc_bits))
+                        bit_shift = max(8*byte_depth - 1 - adc_bits, 0)
+                        self.ds_scale = 2**bit_shift
             self.ds = downsample
+            self._prev_ds = None
 
 
             header = { "channels" : self.total_ch,
@@ -171,6 +273,8 @@ class ReadoutObj(object):
                        "is_float" : is_float,
                        "ip" : self.ip_addr,
                        "downsample" : downsample,
+                       "downsample_filter" : self.decimator.describe() if self.decimator
+                                             else ("mean" if downsample != 1 else None),
                        "date" : dt,
                        "freq_hz" : freq,
                        "measurement_name" : kw.get("measurement_name", "Digitizer " + self.ip_addr),
@@ -185,19 +289,65 @@ class ReadoutObj(object):
                 if os.path.exists(file_name):
                     raise ReadoutException("'%s' exists, not overwriting" % file_name)
                 header["filename"] = file_name
+                self._has_file = True
             self.doc_to_save = header
-            self.upload_class = UploadClass(self.doc_to_save)
 
-        self.dev.BeginReadout(function=self, buffer_size=buffer_size)
+            # With processing_pool, the output for the file of every buffer
+            # is computed by the worker processes of the pool started with
+            # the server (see pool.py)
+            if kw.get("processing_pool", False) and self._has_file:
+                pool = get_pool()
+                if pool is None:
+                    raise ReadoutException("No processing pool, start the server with DTACQ_PROCESSING_WORKERS set")
+                self.pool = pool.run(self._commitBuffer,
+                    self.total_ch, header["channel_list"], buffer_size,
+                    numpy.dtype("int{}".format(8*self.readout_size)),
+                    downsample=downsample, ds_dtype=self.ds_dtype,
+                    decimator=self.decimator,
+                    ds_scale=getattr(self, "ds_scale", 1),
+                    bit_shift=self.bit_right_shift,
+                    max_pending=kw.get("processing_pending", None))
+
+            self.upload_class = UploadClass(self.doc_to_save,
+                max_bytes=kw.get("writer_queue_bytes", 256*1024*1024),
+                fsync=kw.get("fsync", "close"),
+                on_full=kw.get("writer_on_full", "block"),
+                compression=self._compression(kw),
+                index_frames=kw.get("index_frames", None))
+
+        # Online statistics and spectra, analysis is True or a dict with
+        # channels (default all data channels) and the options of
+        # OnlineAnalysis
+        if self.analysis is not None:
+            self.analysis.stop()
+            self.analysis = None
+        opts = kw.get("analysis", None)
+        if opts:
+            opts = {} if opts is True else dict(opts)
+            chans = opts.pop("channels", range(sum(self.available_modules[m] for m in ml)))
+            self.analysis = OnlineAnalysis(self.total_ch, chans, freq,
+                                           self.bit_right_shift, **opts)
+
+        # With callback_latency (s), buffers are handed over in batches, at
+        # most one call (and GIL acquisition) per callback_latency.  Buffers
+        # hold whole frames of total_ch samples.
+        latency = kw.get("callback_latency", None)
+        self.dev.BeginReadout(function=self, buffer_size=buffer_size,
+                              pool_size=kw.get("pool_size", 16),
+                              batch=latency is not None,
+                              max_latency=latency or 0.,
+                              frame_size=self.total_ch)
         self.isRunning = True
 
-        def waitToFinish(s, d=None, uc=None):
+        def waitToFinish(s, d=None, uc=None, pool=None):
             if not d:
                 d = defer.Deferred()
             if not uc:
                 uc = s.upload_class
+            if not pool:
+                pool = s.pool
             if hasattr(s, "dev") and s.dev.IsRunning():
-                reactor.callLater(1, waitToFinish, s, d, uc)
+                reactor.callLater(1, waitToFinish, s, d, uc, pool)
             else:
                 s.isRunning = False
                 def send_result(res):
@@ -207,27 +357,53 @@ class ReadoutObj(object):
                     else:
                         res.append(dict(type="JobFinished", error=s._exc))
                     d.callback(res)
-                if uc:
+                def close_pool():
+                    # Buffers still being processed are written first
+                    pool.close()
+                    if pool.error is not None and not s._exc:
+                        s._exc = "Processing failed: {}".format(pool.error)
+                if uc and pool:
+                    threads.deferToThread(close_pool).addCallback(
+                      lambda _: uc.closeAndUploadFile()).addCallback( send_result )
+                elif uc:
                     uc.closeAndUploadFile().addCallback( send_result )
                 else:
                     send_result("")
             return d
         return waitToFinish(self)
 
+    @staticmethod
+    def _compression(kw):
+        """
+        Options of compressed writing from the compression keyword (True or
+        a dict, see codec.BlockWriter), None for raw files
+        """
+        c = kw.get("compression", None)
+        if not c:
+            return None
+        return {} if c is True else dict(c)
+
     @isRunning
     def stopReadout(self, **kw):
         self.dev.StopReadout()
 
     def readBuffer(self, **kw):
+        """
+        Next buffer (of reader) for the channels, with width the min, max
+        and mean envelope of every channel in at most width bins is sent
+        instead of the samples, see processing.live_envelope.
+        """
         if not self.isRunning:
             raise ReadoutException("measurement is not running")
         chans = kw.get("channels", [])
         include_counter = kw.get("include_counter", False)
+        include_missed = kw.get("include_missed", False)
+        width = kw.get("width")
 
         # build load into a stream
         header = [len(chans)]
         header.extend(chans)
-        al, ctr = self._pop_from_list()
+        al, ctr, missed = self._pop_from_list(kw.get("reader"))
 
         # If we include the counter, then we set a bit flag in the header and
         # append one value to the length
@@ -235,6 +411,21 @@ class ReadoutObj(object):
             header.append(ctr)
             header[0] += 0xff00
 
+        # Same for the number of buffers this reader missed since its last
+        # read, appended after the counter
+        if include_missed:
+            header.append(missed)
+            header[0] += 0xff0000
+
+        # The envelope (float32, 3 x channels x bins) is flagged and
+        # followed by the number of bins
+        env = None
+        if width and al is not None:
+            env = live_envelope(al, self.total_ch, chans, int(width))
+        if width:
+            header.append(0 if env is None else env.shape[2])
+            header[0] += 0xff000000
+
         header = numpy.array(header, dtype=numpy.uint32)
         header = header.tostring()
         if al is None:
@@ -242,62 +433,215 @@ class ReadoutObj(object):
                 if self._exc is not None:
                     raise ReadoutException("Readout unexpectedly ended!")
                 return numpy.array([0xdeadbeef], dtype=numpy.int32).tostring()
+        if env is not None:
+            return header + env.tostring()
         if al is not None:
             return header + numpy.array([al[ch::self.total_ch] for ch in chans]).tostring()
         return header
 
 
-    def _writeToFile(self, v, afile, ch_list, data_range=None):
+    def _decimate(self, v):
+        """
+        v filtered and downsampled by the decimator, which has to see every
+        buffer once and in order
+        """
+        f = select_channels(frames(v, self.total_ch), self.doc_to_save["channel_list"])
+        if self.bit_right_shift:
+            f = numpy.right_shift(f, self.bit_right_shift)
+        return to_dtype(self.decimator.process(f), self.ds_dtype, self.ds_scale)
+
+    def _writeToFile(self, v, ch_list, data_range=None, run_sample=0, decimated=None,
+                     copy=False):
+        """
+        run_sample is the sample of the run of the first frame of v,
+        decimated the output of _decimate (or of the pool) for v, copied
+        before it is queued with copy
+        """
         try:
-            ch = self.total_ch
-            # if we get stopped, it's possible we don't have all the data
-            # make sure we're aligned
-            at_end = len(v) % ch
-            if at_end != 0:
-                # truncating end
-                v = v[:-at_end]
-            t = None
-            if self.ds == 1:
-                t = numpy.array([v[c::ch] for c in ch_list])
+            # Output row i of the FIR decimator is centred delay frames
+            # before frame i*ds of the buffer
+            delay = 0
+            if decimated is not None and self.decimator is not None:
+                delay = int(self.decimator.delay)
+            if decimated is not None:
+                towrite = decimated
             else:
-                ds_end = len(v) % (self.ds*ch)
-                if ds_end != 0:
-                    v = v[:-ds_end]
-                t = numpy.array([v[c::ch].reshape(-1, self.ds).mean(axis=1) for c in ch_list])
-            towrite = t.T
+                # The last buffer of a run may end with a partial downsampling
+                # block, only whole blocks are written
+                towrite = deinterleave(v, self.total_ch, ch_list, self.ds, self.ds_dtype)
             if data_range is not None:
-                towrite = towrite[data_range[0]:data_range[1]]
-            towrite.tofile(afile)
+                # Ranges are given in frames of the buffer, edges inside the
+                # buffer are moved by the delay.  Those at its ends stay, so
+                # that a range continued in the next buffer stays contiguous.
+                n = len(towrite)
+                a, b, _ = slice(*data_range).indices(n*self.ds)
+                r0 = min((a + delay) // self.ds, n) if a > 0 else 0
+                r1 = min((b + delay) // self.ds, n) if b < n*self.ds else n
+                run_sample += r0*self.ds
+                towrite = towrite[r0:r1]
+            run_sample -= delay
+            if copy:
+                towrite = numpy.array(towrite)
+            # Queued, the actual write happens on the writer thread
+            self.upload_class.writeToFile(towrite, run_sample)
         except:
             traceback.print_exc()
             raise
 
+    def _commitBuffer(self, meta, out):
+        """
+        Write the output of a buffer computed by the pool, called in the
+        order of the buffers by the commit thread.  meta holds the trigger
+        commands and the first and end frame of the buffer.
+        """
+        cmds, start, end = meta
+        ch_list = self.doc_to_save["channel_list"]
+        prev = self._prev_out
+        for y in cmds:
+            if y == OpenNewReadoutFile:
+                self.upload_class.writeNewFile()
+            elif isinstance(y, WritePreviousBuffer):
+                # Only if the previous buffer was processed
+                if prev is not None and prev[1] == start:
+                    self._writeToFile(None, ch_list, data_range=(y.start, y.end),
+                                      run_sample=prev[0], decimated=prev[2], copy=True)
+            else:
+                self._writeToFile(None, ch_list, data_range=y, run_sample=start,
+                                  decimated=out, copy=True)
+        # The pool keeps out valid until the next commit returns
+        self._prev_out = (start, end, out)
+
+    def writerStats(self, **kw):
+        if self.upload_class is None:
+            return {}
+        return self.upload_class.writerStats()
+
+    def _analysis(self):
+        if self.analysis is None:
+            raise ReadoutException("No online analysis, start the readout with analysis")
+        return self.analysis
+
+    def getStats(self, **kw):
+        """
+        Running mean, rms, min and max of the analysed channels
+        """
+        return self._analysis().stats(kw.get("channels"))
+
+    def getSpectrum(self, **kw):
+        """
+        Welch-averaged power spectral density of the analysed channels, at
+        most points frequencies
+        """
+        return self._analysis().spectrum(kw.get("channels"), kw.get("points"))
+
+    def resetAnalysis(self, **kw):
+        self._analysis().reset()
+
+    def sessionStats(self, **kw):
+        return session_pool.stats()
+
+    def readoutStats(self, **kw):
+        """
+        Device counters (buffers, queue depth, callback and GIL times), the
+        per-buffer durations of each stage of the callback, the buffers
+        dropped after an error and the writer statistics
+        """
+        return dict(device=self.dev.ReadoutStats(),
+                    dropped=self._dropped,
+                    stages=dict((k, summarize_times(v))
+                                for k, v in self._timings.items()),
+                    writer=self.writerStats(),
+                    pool=self.pool.stats() if self.pool else {})
+
     def __call__(self, x):
+        if isinstance(x, list):
+            # Batched readout, every buffer since the last call.  An error
+            # ends the readout, the rest of the batch is neither validated,
+            # written nor added to the ring.
+            for i, b in enumerate(x):
+                try:
+                    self._processBuffer(b)
+                except:
+                    n = len(x) - i - 1
+                    if n:
+                        self._dropped += n
+                        logging.error("Dropped the last {} buffers of the batch".format(n))
+                    raise
+        else:
+            self._processBuffer(x)
+
+    def _triggerCommands(self, v):
+        """
+        List of the trigger's commands for v
+        """
+        retVal = self.trigger.call_trigger(v, range(self.total_ch), self.total_ch)
+        if retVal == False:
+            # Nothing written, the buffer is still kept for readers
+            return []
+        if retVal == True:
+            return [None]
+        return retVal
+
+    def _processBuffer(self, x):
         try:
            if len(x) == 0: return
+           t0 = time.time()
+           # Buffers always hold whole frames (ensured by pyacq)
            v = x.vec()
-           if self.last_offset != 0:
-               # This should generally not happen, but we check anyways
-               raise ReadoutException("Buffer not aligned")
+           if len(v) % self.total_ch != 0:
+               raise ReadoutException("Buffer not aligned ({} samples, {} per frame)".format(len(v), self.total_ch))
            self.validateData(v)
-           # This should generally be 0, though it's possible that the *last*
-           # buffer is not aligned.
-           self.last_offset += len(v) % self.total_ch
-
-           if self.upload_class:
+           start = self._run_frames
+           self._run_frames += len(v) // self.total_ch
+           if self.analysis is not None:
+               self.analysis.push(v)
+           if self.merge_sink is not None:
+               self.merge_sink.add(self, v, t0)
+           t1 = t2 = time.time()
+
+           if self.upload_class and self.pool is not None:
+               # Triggers are called in order here, every buffer of an open
+               # file is processed so that the previous one can be written.
+               # The file is (re)opened on the commit thread, so whether we
+               # write is not asked from upload_class.
+               writing = self._has_file
+               cmds = []
+               if writing:
+                   cmds = self._triggerCommands(v)
+               t2 = time.time()
+               self.pool.submit(v, (cmds, start, self._run_frames), process=writing)
+           elif self.upload_class:
+               dec = None
+               if self.decimator is not None:
+                   dec = self._decimate(v)
                if self.upload_class.isWriting():
-                   retVal = self.trigger.call_trigger(v, range(self.total_ch), self.total_ch)
-                   if retVal == False:
-                       return
-                   if retVal == True:
-                       retVal = [None]
+                   retVal = self._triggerCommands(v)
+                   t2 = time.time()
                    # We were given a set of commands to write the file, loop through them
                    for y in retVal:
                        if y == OpenNewReadoutFile:
                            self.upload_class.writeNewFile()
+                       elif isinstance(y, WritePreviousBuffer):
+                           if self._prev_v is not None:
+                               self._writeToFile(self._prev_v, self.doc_to_save["channel_list"],
+                                                 data_range=(y.start, y.end),
+                                                 run_sample=start - len(self._prev_v) // self.total_ch,
+                                                 decimated=self._prev_ds)
                        else:
-                           self.upload_class.writeToFile(lambda x: self._writeToFile(v, x, self.doc_to_save["channel_list"], data_range=y))
+                           self._writeToFile(v, self.doc_to_save["channel_list"],
+                                             data_range=y, run_sample=start,
+                                             decimated=dec)
+               self._prev_ds = dec
+           t3 = time.time()
+           self._prev_v = v
            self._add_to_list(v)
+           t4 = time.time()
+           tm = self._timings
+           tm["validate"].append(t1 - t0)
+           tm["trigger"].append(t2 - t1)
+           tm["write"].append(t3 - t2)
+           tm["ring"].append(t4 - t3)
+           tm["total"].append(t4 - t0)
         except EndReadoutNow:
            logging.info("Readout end requested")
            raise
@@ -308,5 +652,9 @@ class ReadoutObj(object):
 
     def safeShutdown(self):
         if self.isRunning: self.stopReadout()
+        if self.analysis is not None:
+            self.analysis.stop()
+        if self.pool is not None:
+            self.pool.terminate()
         del self.card.dev
 
@@ -0,0 +1,90 @@
+import threading
+import collections
+
+
+class BufferRing(object):
+    """
+    Keeps the most recent readout buffers for readers (e.g. web clients)
+
+    At most `size` buffers and (if given) `max_bytes` bytes are kept, the
+    newest buffer is always kept.  Every reader has its own cursor so that
+    readers polling slower than the digitizer get every buffer still in the
+    ring, and are told how many buffers they missed when they fall behind.
+    """
+    def __init__(self, size=8, max_bytes=64*1024*1024):
+        if size < 1:
+            raise ValueError("ring size must be >= 1")
+        self.size = size
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # entries of (sequence number, buffer)
+            self._items = collections.deque()
+            self._bytes = 0
+            self._next_seq = 0
+            self._cursors = {}
+
+    def push(self, al):
+        """
+        Add a buffer, dropping the oldest buffers if over size or memory
+        limits.  Returns the sequence number of the buffer.
+        """
+        with self._lock:
+            seq = self._next_seq
+            self._items.append((seq, al))
+            self._bytes += al.nbytes
+            self._next_seq += 1
+            while len(self._items) > 1 and \
+                  (len(self._items) > self.size or
+                   (self.max_bytes and self._bytes > self.max_bytes)):
+                self._bytes -= self._items.popleft()[1].nbytes
+            return seq
+
+    def read(self, reader=None):
+        """
+        Return the next buffer for reader as (buffer, seq, missed):
+
+          buffer - next unread buffer, or None if the reader is up to date
+          seq    - sequence number of buffer (or of the last buffer read)
+          missed - number of buffers dropped from the ring before this reader
+                   could read them
+
+        A new reader starts at the newest buffer.
+        """
+        with self._lock:
+            if reader not in self._cursors:
+                self._cursors[reader] = max(self._next_seq - 1, 0)
+            cur = self._cursors[reader]
+            missed = 0
+            if self._items:
+                oldest = self._items[0][0]
+                if cur < oldest:
+                    missed = oldest - cur
+                    cur = oldest
+            if cur >= self._next_seq:
+                return None, cur - 1, missed
+            self._cursors[reader] = cur + 1
+            return self._items[cur - self._items[0][0]][1], cur, missed
+
+    def latest(self):
+        """
+        Newest buffer (without moving any cursor) as (buffer, seq)
+        """
+        with self._lock:
+            if not self._items:
+                return None, self._next_seq - 1
+            return self._items[-1][1], self._items[-1][0]
+
+    def remove_reader(self, reader):
+        with self._lock:
+            self._cursors.pop(reader, None)
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def nbytes(self):
+        return self._bytes
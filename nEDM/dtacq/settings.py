@@ -7,6 +7,10 @@ __settings_map = {
   "db_pw" : "DB_PASSWORD",
   "dtacq_un" : "DTACQ_USER_NAME",
   "dtacq_pw" : "DTACQ_PASSWORD",
+  "upload_journal" : "DTACQ_UPLOAD_JOURNAL",
+  "digitizers" : "DTACQ_DIGITIZERS",
+  "processing_workers" : "DTACQ_PROCESSING_WORKERS",
+  "processing_slot_mb" : "DTACQ_PROCESSING_SLOT_MB",
 }
 
 def _ret_value(v):
@@ -0,0 +1,209 @@
+"""
+Software stand-in for a D-TACQ digitizer
+
+Answers the command protocol on port 4220 (one command per line, answer
+followed by a '>' prompt) and streams interleaved frames on port 4210, as
+acq::Device expects.  Each frame holds the data channels of the active
+sites followed by the spad words, the first spad word being the sample
+counter (starting at 1 for every data connection).
+
+Several simulators can run on one machine by binding them to different
+loopback addresses (127.0.0.2, 127.0.0.3, ...).
+"""
+import threading
+import socket
+import logging
+import time
+import numpy
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+command_port = 4220
+data_port = 4210
+
+# MODEL, bytes per sample, channels per site, number of sites, spad words per
+# frame, fixed total channels (LIA), clkdiv, fpga_version
+personalities = {
+  "ACQ425ELF" : dict(model="ACQ425ELF", word=2, chans=16, sites=2, spad=4,
+                     total=None, clkdiv=50,
+                     fpga="ACQ2106_TOP_04_04_9011_32B"),
+  "ACQ425ELFLIA" : dict(model="ACQ425ELF", word=2, chans=16, sites=2, spad=0,
+                        total=80, clkdiv=100,
+                        fpga="ACQ2106_TOP_04_04_9011_LIA"),
+  "ACQ437ELF" : dict(model="ACQ437ELF", word=4, chans=16, sites=2, spad=2,
+                     total=None, clkdiv=4,
+                     fpga="ACQ2106_TOP_04_04_9011_64B"),
+}
+
+# Divider between clkdiv and sample rate, as in cards.py
+_clk_divider = { "ACQ425ELF" : 1, "ACQ425ELFLIA" : 128, "ACQ437ELF" : 256 }
+
+
+class SimulatedDigitizer(object):
+    """
+    rate overrides the frame rate (Hz) derived from the clock settings, a
+    rate of 0 streams as fast as possible.  drop_every > 0 skips a frame
+    (a counter discontinuity) every drop_every frames.
+    """
+    sysclkhz = 50000000
+
+    def __init__(self, personality="ACQ425ELF", address="127.0.0.1",
+                 rate=None, drop_every=0, chunk_frames=None):
+        self.p = personalities[personality]
+        self.personality = personality
+        self.address = address
+        self.rate = rate
+        self.drop_every = drop_every
+        self.chunk_frames = chunk_frames
+        self.clkdiv = self.p["clkdiv"]
+        self.active_sites = list(range(1, self.p["sites"] + 1))
+        self.gains = dict((s, "0"*self.p["chans"]) for s in self.active_sites)
+        self.data32 = int(self.p["word"] == 4)
+        self.t0 = 0.
+        self.frames_sent = 0
+        self._servers = []
+
+    # ---------------------------------------------------------------------
+    # Stream layout
+    def num_channels(self):
+        if self.p["total"] is not None:
+            return self.p["total"]
+        return self.p["chans"]*len(self.active_sites) + self.p["spad"]
+
+    def frame_rate(self):
+        if self.rate is not None:
+            return self.rate
+        return self.sysclkhz/float(self.clkdiv*_clk_divider[self.personality])
+
+    # ---------------------------------------------------------------------
+    # Command protocol
+    def command(self, cmd):
+        args = cmd.split()
+        if not args:
+            return ""
+        if args[0] == "get.site" and len(args) >= 3:
+            return self._get_site(int(args[1]), args[2])
+        if args[0] == "set.site" and len(args) >= 3:
+            return self._set_site(int(args[1]), args[2:])
+        if args[0] == "run0" and len(args) == 2:
+            self.active_sites = [int(x) for x in args[1].split(",")]
+            return ""
+        simple = {
+          "prompt" : "",
+          "NCHAN" : str(self.num_channels()),
+          "data32" : str(self.data32),
+          "fpga_version" : self.p["fpga"],
+          "sites" : ",".join(str(s) for s in range(1, self.p["sites"] + 1)),
+          "help" : "Simulated {}".format(self.personality),
+          "sim.t0" : repr(self.t0),
+          "sim.frames_sent" : str(self.frames_sent),
+        }
+        if args[0] in simple:
+            return simple[args[0]]
+        return "ERROR: unknown command {}".format(args[0])
+
+    def _get_site(self, site, knob):
+        if site < 1 or site > self.p["sites"]:
+            return "ERROR: no site {}".format(site)
+        values = {
+          "NCHAN" : str(self.p["chans"]),
+          "MODEL" : "{} N={} M=A2".format(self.p["model"], self.p["chans"]),
+          "clkdiv" : str(self.clkdiv),
+          "sysclkhz" : str(self.sysclkhz),
+          "gains" : self.gains.get(site, "0"*self.p["chans"]),
+          "hi_res_mode" : "0",
+        }
+        return values.get(knob, "ERROR: unknown knob {}".format(knob))
+
+    def _set_site(self, site, args):
+        if args[0] == "clkdiv" and len(args) == 2:
+            self.clkdiv = int(args[1])
+        elif args[0] == "gains" and len(args) == 2:
+            self.gains[site] = args[1]
+        return ""
+
+    # ---------------------------------------------------------------------
+    # Data stream
+    def _template(self, nframes):
+        """
+        Block of synthetic data frames (without counters), sines of different
+        frequency per channel plus noise
+        """
+        nch = self.num_channels()
+        ndata = nch - self.p["spad"]
+        dtype = numpy.int16 if self.p["word"] == 2 else numpy.int32
+        amp = 2**13 if self.p["word"] == 2 else 2**29
+        t = numpy.arange(nframes)[:, None]
+        periods = numpy.arange(1, ndata + 1)[None, :]
+        sig = amp*numpy.sin(2*numpy.pi*t*periods/float(nframes))
+        sig += numpy.random.normal(0, amp/100., sig.shape)
+        block = numpy.zeros((nframes, nch), dtype=dtype)
+        block[:, :ndata] = sig
+        return block
+
+    def stream(self, sock):
+        rate = self.frame_rate()
+        # About 10 ms of data per send
+        chunk = self.chunk_frames or (max(int(rate/100.), 256) if rate else 16384)
+        block = self._template(chunk)
+        nch = block.shape[1]
+        spad_off = (nch - self.p["spad"])*block.itemsize
+        byte_view = block.view(numpy.uint8).reshape(chunk, -1)
+        counter = 1
+        self.t0 = time.time()
+        self.frames_sent = 0
+        try:
+            while True:
+                counters = numpy.arange(counter, counter + chunk, dtype=numpy.uint64)
+                if self.drop_every:
+                    counters += counters // self.drop_every
+                if self.p["spad"]:
+                    byte_view[:, spad_off:spad_off+4] = \
+                      counters.astype(numpy.uint32).view(numpy.uint8).reshape(chunk, 4)
+                if rate:
+                    # Like the hardware, frames are sent once sampled
+                    wait = self.t0 + (self.frames_sent + chunk)/rate - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                sock.sendall(block.tostring())
+                counter += chunk
+                self.frames_sent += chunk
+        except socket.error:
+            # Client closed the connection
+            pass
+
+    # ---------------------------------------------------------------------
+    def start(self):
+        sim = self
+
+        class CommandHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, b""):
+                    ans = sim.command(line.decode("ascii").strip())
+                    self.wfile.write((ans + "\n>").encode("ascii"))
+
+        class DataHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sim.stream(self.request)
+
+        for port, handler in ((command_port, CommandHandler),
+                              (data_port, DataHandler)):
+            server = socketserver.ThreadingTCPServer((self.address, port),
+                                                     handler, bind_and_activate=False)
+            server.allow_reuse_address = True
+            server.daemon_threads = True
+            server.server_bind()
+            server.server_activate()
+            thr = threading.Thread(target=server.serve_forever)
+            thr.daemon = True
+            thr.start()
+            self._servers.append(server)
+        logging.info("Simulated {} listening on {}".format(self.personality, self.address))
+
+    def stop(self):
+        for s in self._servers:
+            s.shutdown()
+            s.server_close()
+        self._servers = []
@@ -0,0 +1,241 @@
+"""
+Push streaming of live data to websocket clients
+
+Instead of polling readBuffer, a client subscribes once to channels of a
+digitizer and is sent a message for new buffers as they arrive.  Messages
+are framed like every other ShipData message (int32 length, JSON header,
+payload), with header
+
+  { "cmd" : "stream", "ok" : true, "sub" : <subscription id>, "ip" : ...,
+    "seq" : <buffer sequence number>, "missed" : ..., "dropped" : ...,
+    "skipped" : ..., "channels" : [...], "decimation" : ...,
+    "dtype" : ..., "shape" : [channels, samples] }
+
+and the (channels, samples) array as payload.
+
+Every client has one Publisher, registered as (push) producer with the
+websocket transport, so it is told when the client cannot keep up.  Each
+subscription then handles this by its policy:
+
+  drop-oldest - buffers are still taken from the ring, at most max_queued
+                messages wait to be sent and the oldest are dropped
+  slow-down   - buffers are left in the ring (where the oldest are
+                eventually overwritten, counted as missed) and the interval
+                between messages is doubled on every pause, it is lowered
+                again to 1/max_rate as messages are sent
+"""
+import time
+import threading
+import itertools
+import collections
+import numpy
+from .processing import live_envelope
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from .digitizer_utils import ReadoutException
+
+
+class Subscription(object):
+    """
+    Channels of one ReadoutObj streamed to a client
+
+    With max_rate (messages/s) only the newest buffer is sent at most every
+    1/max_rate seconds, the others are skipped.  max_rate=0 sends every
+    buffer.  With width, all samples are reduced to their min, max and mean
+    in at most width bins per buffer (decimation does not apply), sent as
+    a float32 (3, channels, bins) array.
+    """
+    policies = ("drop-oldest", "slow-down")
+    max_interval = 5.
+
+    def __init__(self, sub_id, obj, channels, decimation=1, max_rate=10.,
+                 policy="drop-oldest", max_queued=16, width=None):
+        if policy not in self.policies:
+            raise ReadoutException("policy must be one of {}".format(", ".join(self.policies)))
+        if int(decimation) < 1:
+            raise ReadoutException("decimation must be >= 1")
+        if width is not None and int(width) < 1:
+            raise ReadoutException("width must be >= 1")
+        if max_rate < 0 or max_queued < 1:
+            raise ReadoutException("max_rate must be >= 0, max_queued >= 1")
+        if not channels or min(channels) < 0 or \
+           (obj.isRunning and max(channels) >= obj.total_ch):
+            raise ReadoutException("Invalid channels {}".format(channels))
+        self.id = sub_id
+        self.obj = obj
+        self.channels = list(channels)
+        self.decimation = int(decimation)
+        self.width = None if width is None else int(width)
+        self.policy = policy
+        self.max_queued = max_queued
+        self.min_interval = 1./max_rate if max_rate else 0.
+        self.interval = self.min_interval
+        # Own cursor in the ring of obj
+        self.reader = ("subscription", id(self))
+        self.queue = collections.deque()
+        self._next_time = 0
+        self._phase = 0
+        self.sent = self.skipped = self.dropped = self.missed = self.bytes = 0
+
+    def poll(self, now, paused):
+        """
+        Queue messages for new buffers.  Returns the time to poll again
+        if the rate limit holds back new buffers, otherwise None.
+        """
+        if now < self._next_time:
+            return self._next_time
+        if self.policy == "slow-down" and (paused or
+                                           len(self.queue) >= self.max_queued):
+            return None
+        bufs = []
+        while True:
+            al, seq, missed = self.obj.ring.read(self.reader)
+            self.missed += missed
+            if al is None: break
+            bufs.append((al, seq))
+        if not bufs:
+            return None
+        if self.interval:
+            self.skipped += len(bufs) - 1
+            bufs = bufs[-1:]
+            self._next_time = now + self.interval
+        for al, seq in bufs:
+            self.queue.append(self._message(al, seq))
+        while len(self.queue) > self.max_queued:
+            self.queue.popleft()
+            self.dropped += 1
+        return None
+
+    def _message(self, al, seq):
+        nch = self.obj.total_ch
+        if self.obj.bit_right_shift != 0:
+            al = numpy.right_shift(al, self.obj.bit_right_shift)
+        # Keep the decimation phase over consecutive buffers
+        off = self._phase
+        # Channels not read out in this run are left out
+        chans = [ch for ch in self.channels if ch < nch]
+        if self.width is not None:
+            dat = live_envelope(al, nch, chans, self.width)
+        else:
+            dat = numpy.array([al[ch::nch][off::self.decimation]
+                               for ch in chans])
+        self._phase = (off - len(al)//nch) % self.decimation
+        return dict(seq=seq, channels=chans), dat
+
+    def header(self, hdr, dat):
+        hdr.update(cmd="stream", ok=True, sub=self.id, ip=self.obj.ip_addr,
+                   missed=self.missed, dropped=self.dropped,
+                   skipped=self.skipped, decimation=self.decimation,
+                   envelope=self.width is not None, dtype=dat.dtype.str,
+                   shape=list(dat.shape))
+        return hdr
+
+    def paused(self):
+        if self.policy == "slow-down":
+            self.interval = min(max(2*self.interval, 0.01), self.max_interval)
+
+    def wasSent(self, nbytes):
+        self.sent += 1
+        self.bytes += nbytes
+        if self.interval > self.min_interval:
+            self.interval = max(0.9*self.interval, self.min_interval)
+
+    def stats(self):
+        return dict(ip=self.obj.ip_addr, channels=self.channels,
+                    decimation=self.decimation, width=self.width,
+                    policy=self.policy,
+                    interval=self.interval, queued=len(self.queue),
+                    sent=self.sent, bytes=self.bytes, skipped=self.skipped,
+                    dropped=self.dropped, missed=self.missed)
+
+
+@implementer(IPushProducer)
+class Publisher(object):
+    """
+    Sends the messages of all subscriptions of one client (proto, a
+    ShipData) while its transport accepts them
+    """
+    def __init__(self, proto):
+        self.proto = proto
+        self.subs = {}
+        self.paused = False
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._wake_pending = False
+        self._delayed = None
+        proto.transport.registerProducer(self, True)
+
+    def subscribe(self, obj, **kw):
+        sub = Subscription(next(self._ids), obj, **kw)
+        self.subs[sub.id] = sub
+        obj.addBufferListener(self.notify)
+        return sub
+
+    def unsubscribe(self, sub_id):
+        sub = self.subs.pop(sub_id, None)
+        if sub is None:
+            raise ReadoutException("Unknown subscription {}".format(sub_id))
+        sub.obj.ring.remove_reader(sub.reader)
+        if not any(s.obj is sub.obj for s in self.subs.values()):
+            sub.obj.removeBufferListener(self.notify)
+
+    def dropObject(self, obj):
+        """
+        End all subscriptions to obj
+        """
+        for sub_id in [k for k, s in self.subs.items() if s.obj is obj]:
+            self.unsubscribe(sub_id)
+
+    def notify(self, obj=None):
+        """
+        Called from the readout thread for every new buffer, the wake ups
+        are coalesced
+        """
+        with self._lock:
+            if self._wake_pending: return
+            self._wake_pending = True
+        reactor.callFromThread(self._run)
+
+    def _run(self):
+        with self._lock:
+            self._wake_pending = False
+        now = time.time()
+        later = [t for t in (s.poll(now, self.paused)
+                             for s in list(self.subs.values())) if t is not None]
+        self._flush()
+        if later and (self._delayed is None or not self._delayed.active()):
+            self._delayed = reactor.callLater(max(min(later) - now, 0), self._run)
+
+    def _flush(self):
+        # Round robin over the subscriptions, the transport pauses us
+        # (synchronously) once its buffer is full
+        while not self.paused:
+            subs = [s for s in self.subs.values() if s.queue]
+            if not subs: return
+            for s in subs:
+                if self.paused: return
+                hdr, dat = s.queue.popleft()
+                msg = self.proto._buildHeader(s.header(hdr, dat)) + dat.tostring()
+                s.wasSent(len(msg))
+                self.proto.sendMessage(msg, isBinary=True)
+
+    def pauseProducing(self):
+        self.paused = True
+        for s in self.subs.values():
+            s.paused()
+
+    def resumeProducing(self):
+        self.paused = False
+        self._run()
+
+    def stopProducing(self):
+        for sub_id in list(self.subs):
+            self.unsubscribe(sub_id)
+        if self._delayed is not None and self._delayed.active():
+            self._delayed.cancel()
+
+    def stats(self):
+        return dict(paused=self.paused,
+                    subscriptions=dict((str(k), s.stats())
+                                       for k, s in self.subs.items()))
@@ -1,5 +1,46 @@
 import logging
-from .digitizer_utils import ReadoutException, OpenNewReadoutFile, EndReadoutNow
+import numpy
+from .digitizer_utils import (ReadoutException,
+                              OpenNewReadoutFile,
+                              EndReadoutNow,
+                              WritePreviousBuffer)
+from .processing import frames
+
+class BufferView(object):
+    """
+    Lazy view of a readout buffer given to FrameTrigger.trigger_frames
+
+      view.frames   - (frames, total_ch) array, a view of the buffer (no copy)
+      view[c]       - samples of channel c, made contiguous on first access
+                      and cached
+      view.channels - channels available (all, or those of interest)
+
+    It can be used like the dict passed to Trigger.trigger.
+    """
+    def __init__(self, v, channel_list, total_ch):
+        self.frames = frames(v, total_ch)
+        self.total_ch = total_ch
+        self.channels = list(channel_list)
+        self._cache = {}
+
+    def __getitem__(self, c):
+        if c not in self._cache:
+            if c not in self.channels:
+                raise KeyError(c)
+            self._cache[c] = numpy.ascontiguousarray(self.frames[:, c])
+        return self._cache[c]
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __contains__(self, c):
+        return c in self.channels
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def keys(self):
+        return list(self.channels)
 
 class Trigger(object):
     """
@@ -24,30 +65,183 @@ class Trigger(object):
                closing the current file
 			 (x,y) - tuple, will write the current data (all selected channels)
              from index x to y
+             WritePreviousBuffer(x, y) - will write the data of the
+               previous buffer from index x to y
         return True
     """
 
+class FrameTrigger(Trigger):
+    """
+    Base class for triggers receiving a BufferView instead of a dict of
+    channel arrays, only channels that are accessed are copied.  Set
+    channels to the list of channels the trigger looks at to restrict the
+    view to those.
+
+    def trigger_frames(self, view):
+        Should be overloaded by the derived class, return values as for
+        Trigger.trigger
+    """
+    channels = None
+
+    def call_trigger(self, v, channel_list, total_ch):
+        if self.channels is not None:
+            channel_list = [c for c in self.channels if c in channel_list]
+        return self.trigger_frames(BufferView(v, channel_list, total_ch))
+
+class ThresholdTrigger(FrameTrigger):
+    """
+    Threshold/edge trigger evaluated with numpy over each buffer, configured
+    by a dict given to get_trigger:
+
+      channel    - channel to trigger on
+      threshold  - trigger level (in the units seen by triggers, i.e. raw)
+      edge       - "rising" (default), "falling" or "both"
+      hysteresis - the signal must go back past threshold -/+ hysteresis
+                   before the same edge can trigger again
+      pre, post  - frames written before and after each trigger
+      holdoff    - minimum frames between two triggers
+      new_file   - open a new file for every (merged) trigger window
+
+    Overlapping windows are merged.  Windows reaching into the previous
+    buffer (pre) or into following buffers (post) are written in pieces, no
+    frame is written twice.  Only the previous buffer is kept, pre may not
+    exceed the frames of a buffer (see check_buffer).
+    """
+    edges = ("rising", "falling", "both")
+
+    def __init__(self, channel, threshold, edge="rising", hysteresis=0,
+                 pre=0, post=0, holdoff=0, new_file=False):
+        if edge not in self.edges:
+            raise ReadoutException("edge must be one of {}".format(self.edges))
+        if min(hysteresis, pre, post, holdoff) < 0:
+            raise ReadoutException("hysteresis, pre, post and holdoff must be >= 0")
+        self.channels = [channel]
+        self.channel = channel
+        self.threshold = threshold
+        self.edge = edge
+        self.hysteresis = hysteresis
+        self.pre = int(pre)
+        self.post = int(post)
+        self.holdoff = int(holdoff)
+        self.new_file = new_file
+
+        # Schmitt trigger states (1 fired, -1 armed, 0 unknown)
+        self._state = { "rising" : 0, "falling" : 0 }
+        # Absolute frame indices
+        self._offset = 0
+        self._prev_len = 0
+        self._written = 0
+        self._pending_end = 0
+        self._last_trigger = None
+
+    def check_buffer(self, frames):
+        """
+        Raise if the pre-trigger window does not fit into a buffer of frames
+        frames
+        """
+        if self.pre > frames:
+            raise ReadoutException("Trigger pre ({}) exceeds the {} frames of a buffer, increase buffer_size".format(self.pre, frames))
+
+    def _fired(self, on, off, key):
+        """
+        Indices where the state goes from armed (off) to fired (on)
+        """
+        ev = numpy.zeros(len(on), dtype=numpy.int8)
+        ev[off] = -1
+        ev[on] = 1
+        idx = numpy.flatnonzero(ev)
+        if len(idx) == 0:
+            return idx
+        states = ev[idx]
+        before = numpy.empty_like(states)
+        before[0] = self._state[key]
+        before[1:] = states[:-1]
+        self._state[key] = states[-1]
+        return idx[(states == 1) & (before == -1)]
+
+    def _triggers(self, x):
+        thr, hyst = self.threshold, self.hysteresis
+        fired = []
+        if self.edge in ("rising", "both"):
+            fired.append(self._fired(x >= thr, x < thr - hyst, "rising"))
+        if self.edge in ("falling", "both"):
+            fired.append(self._fired(x <= thr, x > thr + hyst, "falling"))
+        fired = numpy.unique(numpy.concatenate(fired)) + self._offset
+        # Holdoff is sequential, but triggers are few
+        trig = []
+        for t in fired:
+            if self._last_trigger is None or t - self._last_trigger >= self.holdoff:
+                trig.append(int(t))
+                self._last_trigger = int(t)
+        return trig
+
+    def trigger_frames(self, view):
+        n = len(view)
+        start, end = self._offset, self._offset + n
+
+        # [start, end, opens a new window]
+        windows = []
+        if self._pending_end > start:
+            windows.append([start, self._pending_end, False])
+        for t in self._triggers(view[self.channel]):
+            s, e = max(t - self.pre, start - self._prev_len), t + max(self.post, 1)
+            if windows and s <= windows[-1][1]:
+                windows[-1][1] = max(windows[-1][1], e)
+            else:
+                windows.append([s, e, True])
+
+        cmds = []
+        self._pending_end = 0
+        for s, e, new in windows:
+            s = max(s, self._written)
+            if new and self.new_file:
+                cmds.append(OpenNewReadoutFile)
+            if s < start:
+                cmds.append(WritePreviousBuffer(s - start + self._prev_len))
+                s = start
+            cmds.append((s - start, min(e, end) - start))
+            self._written = min(e, end)
+            if e > end:
+                self._pending_end = e
+
+        self._prev_len = n
+        self._offset = end
+        return cmds or False
+
 def get_trigger(exec_str=None):
    if not exec_str or exec_str=="":
        return Trigger()
+   if isinstance(exec_str, dict):
+       # Declarative trigger
+       spec = dict(exec_str)
+       spec.pop("type", None)
+       try:
+           return ThresholdTrigger(**spec)
+       except TypeError as e:
+           raise ReadoutException("Invalid trigger specification: {}".format(e))
    import imp, uuid
    import sys
    aname = str(uuid.uuid4())
    mod = imp.new_module(aname)
    mod.__dict__["Trigger"] = Trigger
+   mod.__dict__["FrameTrigger"] = FrameTrigger
    mod.__dict__["EndReadoutNow"] = EndReadoutNow
    mod.__dict__["OpenNewReadoutFile"] = OpenNewReadoutFile
+   mod.__dict__["WritePreviousBuffer"] = WritePreviousBuffer
    exec exec_str in mod.__dict__
    for name, c in mod.__dict__.items():
        try:
            x = issubclass(c, Trigger)
        except:
            continue
-       if x and c != Trigger:
+       if x and c not in (Trigger, FrameTrigger):
            logging.info("Using trigger class: " + name)
            o = c()
            # If trigger was not defined, the following will throw
-           o.trigger
+           if isinstance(o, FrameTrigger):
+               o.trigger_frames
+           else:
+               o.trigger
            sys.modules[aname] = mod
            return o
    raise ReadoutException("No Trigger class found")
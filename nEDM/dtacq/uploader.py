@@ -0,0 +1,225 @@
+"""
+Uploading finished .dig files to the attachment server
+
+Files are sent by at most max_concurrent transfers at a time.  Servers that
+support it get them in chunks of chunk_size bytes, for each file URL the
+server is asked how much it already has, and the upload continues from
+there:
+
+  HEAD <url>                          -> Accept-Ranges: bytes, and
+                                         200 with Content-Length of the bytes
+                                         received so far, or 404 if none
+  PUT <url> with
+    Content-Range: bytes a-b/total    -> 2xx once the chunk is stored,
+                                         416 if a does not match the server
+
+Any other server (e.g. plain CouchDB, where every PUT replaces the whole
+attachment) gets the whole file in one upload via pynedm's
+ProcessObject.upload_file.  After either upload, the size the server has
+is checked against the file.  Failed transfers are retried with
+exponential backoff.  Every pending upload is recorded in a journal file,
+so uploads interrupted by a restart can be sent again with
+FileUploader.resumePending().
+"""
+import os
+import json
+import time
+import logging
+import threading
+import traceback
+from twisted.internet import threads, defer
+from .settings import db_name, upload_journal
+
+
+class UploadJournal(object):
+    """
+    Pending uploads, persisted as a JSON file:
+
+      { file name : { "doc_id" : .., "db" : .., "offset" : .., "attempts" : .. } }
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                logging.error("Upload journal ({}) corrupt, ignoring".format(path))
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        os.rename(tmp, self.path)
+
+    def add(self, fn, doc_id, db):
+        with self._lock:
+            self._entries[fn] = dict(doc_id=doc_id, db=db, offset=0, attempts=0)
+            self._save()
+
+    def update(self, fn, **kw):
+        with self._lock:
+            if fn in self._entries:
+                self._entries[fn].update(kw)
+                self._save()
+
+    def remove(self, fn):
+        with self._lock:
+            if self._entries.pop(fn, None) is not None:
+                self._save()
+
+    def pending(self):
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._entries.items())
+
+
+class FileUploader(object):
+    """
+    Uploads files with bounded concurrency, chunking, resume and retries.
+
+    acct_func is called (in the upload thread) to get a context manager
+    giving an authenticated (cloudant.Account, database) pair.
+
+    chunked None uploads in chunks only if the server announces it
+    (Accept-Ranges: bytes in the answer to HEAD), True always, False never.
+    """
+    def __init__(self, acct_func, journal, max_concurrent=2,
+                 chunk_size=8*1024*1024, max_retries=5, retry_delay=2.,
+                 max_delay=120., chunked=None):
+        self.acct_func = acct_func
+        self.journal = journal
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self._sem = defer.DeferredSemaphore(max_concurrent)
+
+    def upload(self, fn, doc_id, db=None):
+        """
+        Queue fn for upload as attachment of doc_id.  Returns a Deferred
+        firing with the result dict (or an error string).
+        """
+        db = db or db_name
+        if fn not in self.journal.pending():
+            self.journal.add(fn, doc_id, db)
+        return self._sem.run(threads.deferToThread, self._uploadInThread, fn)
+
+    def resumePending(self):
+        """
+        Queue all uploads left in the journal, returns a DeferredList
+        """
+        ds = [self.upload(fn, e["doc_id"], e["db"])
+              for fn, e in self.journal.pending().items()
+              if os.path.exists(fn)]
+        for fn in self.journal.pending():
+            if not os.path.exists(fn):
+                logging.error("Pending upload ({}) no longer exists".format(fn))
+                self.journal.remove(fn)
+        return defer.DeferredList(ds)
+
+    def _uploadInThread(self, fn):
+        entry = self.journal.pending()[fn]
+        attempt = 0
+        logging.info("Sending file: {}".format(fn))
+        while True:
+            try:
+                resp = self._send(fn, entry["doc_id"], entry["db"])
+                break
+            except Exception:
+                attempt += 1
+                self.journal.update(fn, attempts=entry["attempts"] + attempt)
+                logging.error(" Error in upload file ({}, attempt {}): {}".format(
+                  fn, attempt, traceback.format_exc(limit=1)))
+                if attempt > self.max_retries:
+                    return "Upload of {} failed, kept for retry".format(fn)
+                time.sleep(min(self.retry_delay*2**(attempt-1), self.max_delay))
+
+        resp["url"] = "/_attachments/{db}/{id}/{fn}".format(db=entry["db"],
+                        fn=os.path.basename(fn), id=entry["doc_id"])
+        resp["file_name"] = fn
+        resp["type"] = "FileUpload"
+        self.journal.remove(fn)
+        os.remove(fn)
+        logging.info("response: {}".format(resp))
+        return resp
+
+    def _send(self, fn, doc_id, db):
+        with self.acct_func() as (acct, _):
+            return self._sendWithAcct(acct, fn, doc_id, db)
+
+    @staticmethod
+    def _path(fn, doc_id, db):
+        return "_attachments/{}/{}/{}".format(db, doc_id, os.path.basename(fn))
+
+    def _sendWithAcct(self, acct, fn, doc_id, db):
+        path = self._path(fn, doc_id, db)
+        total = os.path.getsize(fn)
+
+        if self.chunked is False:
+            return self._sendWhole(acct, fn, doc_id, db)
+        r = acct.head(path)
+        if r.status_code == 401:
+            # Expired session, the session pool logs in again
+            r.raise_for_status()
+        if self.chunked is None and \
+           r.headers.get("Accept-Ranges", "").lower() != "bytes":
+            return self._sendWhole(acct, fn, doc_id, db)
+        if r.status_code not in (200, 404):
+            r.raise_for_status()
+        offset = int(r.headers.get("Content-Length", 0)) if r.status_code == 200 else 0
+
+        headers = {"Content-Type" : "application/octet-stream"}
+        with open(fn, "rb") as f:
+            while offset < total:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                headers["Content-Range"] = "bytes {}-{}/{}".format(
+                  offset, offset + len(chunk) - 1, total)
+                r = acct.put(path, data=chunk, headers=headers)
+                if r.status_code == 416:
+                    # Out of sync with the server, ask again where to continue
+                    r = acct.head(path)
+                    r.raise_for_status()
+                    offset = int(r.headers.get("Content-Length", 0))
+                    continue
+                r.raise_for_status()
+                offset += len(chunk)
+                self.journal.update(fn, offset=offset)
+                logging.debug("{}: {}/{} bytes".format(fn, offset, total))
+
+        self._checkReceived(acct, path, fn)
+        return dict(ok=True, id=doc_id)
+
+    def _checkReceived(self, acct, path, fn):
+        # The file is removed after the upload, make sure all of it arrived
+        r = acct.head(path)
+        r.raise_for_status()
+        received = int(r.headers.get("Content-Length", -1))
+        total = os.path.getsize(fn)
+        if received != total:
+            raise IOError("Server has {} of {} bytes of {}".format(received, total, fn))
+
+    def _sendWhole(self, acct, fn, doc_id, db):
+        from pynedm import ProcessObject
+        po = ProcessObject(acct=acct)
+        resp = po.upload_file(fn, doc_id, db=db)
+        if "ok" not in resp:
+            raise IOError("Upload not accepted: {}".format(resp))
+        self._checkReceived(acct, self._path(fn, doc_id, db), fn)
+        return resp
+
+
+_uploader = None
+
+def get_uploader(acct_func):
+    """
+    Process-wide uploader, so the concurrency bound applies to all readouts
+    """
+    global _uploader
+    if _uploader is None:
+        _uploader = FileUploader(acct_func,
+          UploadJournal(upload_journal or "dtacq_upload_journal.json"))
+    return _uploader
@@ -6,14 +6,29 @@ import logging
 import numpy
 from .digitizer_utils import ReadoutException, ReleaseDigitizerNow
 from .readout import ReadoutObj
+from .merge import MergedReadout
+from .stream import Publisher
+from .settings import digitizers
 available_urls = [
                 "digitizer.1.nedm1",
                 "digitizer.2.nedm1"
 ]
+# Further digitizers (comma-separated), e.g. simulators for testing
+available_urls += [x.strip() for x in digitizers.split(",") if x.strip()]
 class ShipData(WebSocketServerProtocol):
+   # { client : { ip : ReadoutObj } }, a client may control several
+   # digitizers at once.  This is the only ReadoutObj (and acquisition) of
+   # a digitizer.
    _readoutObjects = {}
+   # { client : set of ips } streamed by a client, streaming clients read
+   # the ring of the controlling ReadoutObj with their own cursor and
+   # never talk to the digitizer
    _streamingObjects = {}
+   # { client : MergedReadout }
+   _mergedReadouts = {}
    _connectedClients = set()
+   # stream.Publisher of the client's subscriptions
+   _publisher = None
    def onMessage(self, payload, isBinary):
        retDic = {}
        retVal = None
@@ -23,30 +38,36 @@ class ShipData(WebSocketServerProtocol):
          obj = self
          if "ip" in mess:
            # Means we are referencing a digitizer
-           ro = self.__class__._readoutObjects
-           so = self.__class__._streamingObjects
-           if (self in ro) and (self in so):
+           ip = mess["ip"]
+           ro = self.__class__._readoutObjects.get(self, {})
+           so = self.__class__._streamingObjects.get(self, ())
+           if (ip in ro) and (ip in so):
                raise ReadoutException("Digitizer must be controlled or streamed!")
-           if (self not in ro) and (self not in so):
+           if (len(ro) == 0) and (len(so) == 0):
                raise ReadoutException("Digitizer control/stream must first be requested")
-           if (self in ro):
-               obj = ro[self]
-           if (self in so):
-               #self.announce(str(retDic["cmd"]))
+           if (ip in so) or (len(ro) == 0):
                #check if the streamer is not to powerful
-               if not((retDic["cmd"] == "getChannels") or (retDic["cmd"]=="readBuffer")): 
+               if retDic["cmd"] not in ("getChannels", "readBuffer", "getStats", "getSpectrum"):
                    raise ReadoutException("Permission denied. Only streaming!")
-               blub = ro.keys()
-               if (len(blub)==0): 
+               # Stream from whoever controls the digitizer
+               obj = self._controlledBy(self._selectIp(so, ip))
+               if obj is None:
                    raise ReadoutException("No digitizer control requested -> no Buffer to read ")
-               obj = ro[blub[0]]
+               if retDic["cmd"] == "getChannels":
+                   mess.setdefault("args", {})["cached"] = True
+           else:
+               obj = self._selectDigitizer(ro, ip)
                
          args = mess.get("args", {})
+         if mess["cmd"] == "readBuffer":
+           # Each client reads the buffer ring with its own cursor
+           args.setdefault("reader", self.req.peer)
          retVal = getattr(obj, mess["cmd"])(**args)
          retDic["ok"] = True
        except ReleaseDigitizerNow:
          self.announce("Digitizer release requested by program")
-         self.onMessage(json.dumps({ "cmd" : "releaseDigitizerControl"}), False)
+         self.onMessage(json.dumps({ "cmd" : "releaseDigitizerControl",
+                                     "args" : { "ip_addr" : obj.ip_addr } }), False)
          return
        except:
          retDic["error"]=traceback.format_exc(limit=1)
@@ -64,50 +85,138 @@ class ShipData(WebSocketServerProtocol):
          retDic += retVal
        self.sendMessage(retDic, isBinary = True)
 
+   @staticmethod
+   def _selectIp(ips, ip):
+       """
+       ip if in ips.  Clients with only one digitizer need not give a
+       matching ip.
+       """
+       if ip in ips:
+           return ip
+       if len(ips) == 1:
+           return list(ips)[0]
+       raise ReadoutException("'{}' not requested, have: {}".format(ip, ", ".join(ips)))
+
+   @classmethod
+   def _selectDigitizer(cls, objs, ip):
+       """
+       The object for ip in objs ({ ip : ReadoutObj })
+       """
+       return objs[cls._selectIp(objs, ip)]
+
+   @classmethod
+   def _controlledBy(cls, ip):
+       for objs in cls._readoutObjects.values():
+           if ip in objs:
+               return objs[ip]
+       return None
+
    def requestDigitizerControl(self, **kw):
        ip = kw.get("ip_addr")
-       ro = self.__class__._readoutObjects
-       if self in ro:
-           if ro[self].ip_addr == ip: return
-           raise ReadoutException("Only one digitizer allowed at a time, release your current control")
+       if ip in self.__class__._readoutObjects.get(self, {}): return
 
-       inv_map = dict([(v.ip_addr,k) for k,v in ro.items()])
-       if ip in inv_map:
-           raise ReadoutException("Jonas was here. Digitizer already controlled elsewhere ({})".format(inv_map[ip].req.peer))
+       for client, objs in self.__class__._readoutObjects.items():
+           if ip in objs:
+               raise ReadoutException("Jonas was here. Digitizer already controlled elsewhere ({})".format(client.req.peer))
 
        if ip not in available_urls:
          raise ReadoutException("'%s' not available" % ip)
        # OK, we can give control
        self.announce("This is the testing Version")
-       ro[self] = ReadoutObj(ip)
+       self.__class__._readoutObjects.setdefault(self, {})[ip] = ReadoutObj(ip)
 
    def requestBufferStream(self, **kw):
        ip = kw.get("ip_addr")
        self.announce("You really want to have the Buffer? Jonas was here 2nd")
 
-       ro = self.__class__._streamingObjects
-       if self in ro:
-           if ro[self].ip_addr == ip: return
-           raise ReadoutException("Only one digitizer allowed for streaming the buffer")
+       if ip in self.__class__._streamingObjects.get(self, ()): return
        
-       inv_map = dict([(v.ip_addr,k) for k,v in ro.items()])
-       if ip in inv_map:
-           self.announce("Jonas was here. Buffer stream shared with other IP ({})".format(inv_map[ip].req.peer))
+       for client, objs in self.__class__._streamingObjects.items():
+           if ip in objs and client != self:
+               self.announce("Jonas was here. Buffer stream shared with other IP ({})".format(client.req.peer))
+               break
 
        if ip not in available_urls:
          raise ReadoutException("'%s' not available" % ip)
-       ro[self] = ReadoutObj(ip)
-       self.announce(str(self._streamingObjects))
+       self.__class__._streamingObjects.setdefault(self, set()).add(ip)
+       self.announce("Streaming {}".format(", ".join(sorted(self._streamingObjects[self]))))
 
    def releaseDigitizerControl(self, **kw):
-       ro = self.__class__._readoutObjects
-       if self in ro:
-           ro[self].safeShutdown()
-           ip = ro[self].ip_addr
-           del ro[self]
+       """
+       Release the digitizer ip_addr, or all digitizers of this client
+       """
+       ro = self.__class__._readoutObjects.get(self, {})
+       ip_addr = kw.get("ip_addr")
+       for ip in list(ro):
+           if ip_addr is not None and ip != ip_addr: continue
+           for s in self.__class__._connectedClients:
+               if s._publisher is not None:
+                   s._publisher.dropObject(ro[ip])
+           ro[ip].safeShutdown()
+           del ro[ip]
            for s in self.__class__._connectedClients:
                if s == self: continue
                s.announce("'{}' digitizer released by '{}'".format(ip,self.req.peer))
+       if not ro:
+           self.__class__._readoutObjects.pop(self, None)
+           self.__class__._mergedReadouts.pop(self, None)
+
+   def startMergedReadout(self, **kw):
+       """
+       Read out several controlled digitizers (ips) into one merged file,
+       see merge.MergedReadout
+       """
+       ro = self.__class__._readoutObjects.get(self, {})
+       ips = kw.pop("ips", list(ro))
+       missing = [ip for ip in ips if ip not in ro]
+       if missing:
+           raise ReadoutException("Control of {} must first be requested".format(", ".join(missing)))
+       mr = self.__class__._mergedReadouts.get(self)
+       if mr is not None and mr.isRunning:
+           raise ReadoutException("Merged readout already running")
+       mr = MergedReadout([ro[ip] for ip in ips],
+                          align=kw.pop("align", "counter"),
+                          offsets=kw.pop("offsets", None))
+       self.__class__._mergedReadouts[self] = mr
+       return mr.startReadout(**kw)
+
+   def _mergedReadout(self):
+       mr = self.__class__._mergedReadouts.get(self)
+       if mr is None:
+           raise ReadoutException("No merged readout started")
+       return mr
+
+   def stopMergedReadout(self, **kw):
+       self._mergedReadout().stopReadout()
+
+   def mergeStats(self, **kw):
+       return self._mergedReadout().mergeStats()
+
+   def subscribe(self, **kw):
+       """
+       Push data of ip_addr (controlled or streamed by this client) instead
+       of polling readBuffer, see stream.Subscription for the other kw.
+       Returns the subscription id, used in the pushed "stream" messages.
+       """
+       ip = kw.pop("ip_addr", None)
+       obj = self.__class__._readoutObjects.get(self, {}).get(ip)
+       if obj is None and ip in self.__class__._streamingObjects.get(self, ()):
+           obj = self._controlledBy(ip)
+       if obj is None:
+           raise ReadoutException("Control or stream of '{}' must first be requested".format(ip))
+       if self._publisher is None:
+           self._publisher = Publisher(self)
+       return dict(sub=self._publisher.subscribe(obj, **kw).id)
+
+   def unsubscribe(self, **kw):
+       if self._publisher is None:
+           raise ReadoutException("No subscriptions")
+       self._publisher.unsubscribe(kw.get("sub"))
+
+   def subscriptionStats(self, **kw):
+       if self._publisher is None:
+           return {}
+       return self._publisher.stats()
 
    def announce(self, msg):
        if type(msg) == type([]):
@@ -133,7 +242,14 @@ class ShipData(WebSocketServerProtocol):
       logging.info("WebSocket connection open.")
 
    def onClose(self, wasClean, code, reason):
+      for objs in self.__class__._readoutObjects.values():
+          for o in objs.values():
+              o.ring.remove_reader(self.req.peer)
+      if self._publisher is not None:
+          self._publisher.stopProducing()
+          self._publisher = None
       self.releaseDigitizerControl()
+      self.__class__._streamingObjects.pop(self, None)
       try:
         self.__class__._connectedClients.remove(self)
       except: pass
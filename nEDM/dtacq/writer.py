@@ -0,0 +1,188 @@
+import threading
+import collections
+import logging
+import time
+import os
+import numpy
+
+
+class AsyncFileWriter(object):
+    """
+    Writes data to file on its own thread so that the readout callback never
+    does disk I/O.
+
+    Requests (open, write, close) are queued and performed in order.  The
+    queue is bounded to max_bytes of pending data; when full, on_full decides
+    whether enqueuing blocks ("block") or the data is dropped and counted
+    ("drop").  All requests pending at a wakeup are handled as one batch,
+    writes going through a file buffer of batch_bytes and followed by a
+    single flush.
+
+    fsync may be:
+      None     - never fsync
+      "close"  - fsync when a file is closed
+      "batch"  - fsync after every batch
+      float    - fsync at most every fsync seconds (and on close)
+    """
+    def __init__(self, max_bytes=256*1024*1024, batch_bytes=4*1024*1024,
+                 fsync="close", on_full="block"):
+        if on_full not in ("block", "drop"):
+            raise ValueError("on_full must be 'block' or 'drop'")
+        if not (fsync in (None, "close", "batch") or
+                (isinstance(fsync, (int, float)) and not isinstance(fsync, bool)
+                 and fsync >= 0)):
+            raise ValueError("fsync must be None, 'close', 'batch' or seconds >= 0")
+        self.max_bytes = max_bytes
+        self.batch_bytes = batch_bytes
+        self.fsync = fsync
+        self.on_full = on_full
+
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = collections.deque()
+        self._pending_bytes = 0
+        self._file = None
+        self._last_sync = time.time()
+        self._exc = None
+        self._stats = dict(queue_depth=0, max_queue_depth=0, queue_bytes=0,
+                           bytes_written=0, batches=0, dropped=0,
+                           dropped_bytes=0, lag=0., max_lag=0.)
+
+        self._thread = threading.Thread(target=self._run, name="AsyncFileWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def open(self, name, header=None):
+        """
+        Open a new file (closing the current one) and write header to it
+        """
+        self._put(("open", name, header), 0)
+
+    def write(self, dat):
+        """
+        Queue dat (numpy array or bytes) for writing.  Returns False if the
+        data was dropped because the queue was full.
+        """
+        if isinstance(dat, numpy.ndarray):
+            dat = numpy.ascontiguousarray(dat)
+            n = dat.nbytes
+        else:
+            n = len(dat)
+        return self._put(("write", dat), n)
+
+    def close(self, remove=False):
+        """
+        Close the current file (removing it if remove).  Returns a
+        threading.Event that is set once the file is closed.
+        """
+        ev = threading.Event()
+        self._put(("close", remove, ev), 0)
+        return ev
+
+    def stop(self):
+        """
+        Finish all pending requests, then end the writer thread.
+        """
+        self._put(("stop",), 0)
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["queue_depth"] = len(self._queue)
+            s["queue_bytes"] = self._pending_bytes
+            if self._queue:
+                # Age of the oldest pending request
+                s["lag"] = max(s["lag"], time.time() - self._queue[0][0])
+            s["error"] = self._exc
+            return s
+
+    def _put(self, req, nbytes):
+        with self._cond:
+            if self._exc is not None and req[0] in ("open", "write"):
+                raise IOError("Writer failed: {}".format(self._exc))
+            while nbytes and self._pending_bytes and \
+                  self._pending_bytes + nbytes > self.max_bytes:
+                if self.on_full == "drop":
+                    self._stats["dropped"] += 1
+                    self._stats["dropped_bytes"] += nbytes
+                    return False
+                self._cond.wait()
+            self._queue.append((time.time(), nbytes, req))
+            self._pending_bytes += nbytes
+            depth = len(self._queue)
+            if depth > self._stats["max_queue_depth"]:
+                self._stats["max_queue_depth"] = depth
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        running = True
+        while running:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                batch = list(self._queue)
+                self._queue.clear()
+            try:
+                for _, _, req in batch:
+                    if req[0] == "stop":
+                        running = False
+                        break
+                    getattr(self, "_do_" + req[0])(*req[1:])
+                if self._file is not None:
+                    self._file.flush()
+                    if self.fsync == "batch" or \
+                      (isinstance(self.fsync, (int, float)) and
+                       time.time() - self._last_sync >= self.fsync):
+                        self._sync()
+            except Exception as e:
+                logging.exception("Error in file writer")
+                with self._cond:
+                    self._exc = repr(e)
+                for _, _, req in batch:
+                    if req[0] == "close":
+                        req[2].set()
+            now = time.time()
+            with self._cond:
+                lag = now - batch[0][0]
+                self._pending_bytes -= sum(b[1] for b in batch)
+                self._stats["bytes_written"] += sum(b[1] for b in batch)
+                self._stats["batches"] += 1
+                self._stats["lag"] = lag
+                self._stats["max_lag"] = max(self._stats["max_lag"], lag)
+                self._cond.notify_all()
+        # Release anybody waiting on a close that never happened
+        for _, _, req in batch:
+            if req[0] == "close":
+                req[2].set()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._last_sync = time.time()
+
+    def _do_open(self, name, header):
+        if self._file is not None:
+            self._do_close(False, None)
+        self._file = open(name, "wb", self.batch_bytes)
+        self._name = name
+        if header is not None:
+            self._file.write(header)
+
+    def _do_write(self, dat):
+        if self._file is None:
+            return
+        self._file.write(dat)
+
+    def _do_close(self, remove, ev):
+        if self._file is not None:
+            if self.fsync is not None and not remove:
+                self._file.flush()
+                self._sync()
+            self._file.close()
+            self._file = None
+            if remove:
+                os.remove(self._name)
+        if ev is not None:
+            ev.set()
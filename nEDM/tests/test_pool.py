@@ -0,0 +1,71 @@
+"""
+  Runs of dtacq.pool.ProcessingPool, compared with inline processing
+
+  Usage: python -m unittest discover -s tests   (from nEDM)
+"""
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.pool import ProcessingPool
+from dtacq.processing import (Decimator, deinterleave, frames, select_channels,
+                              to_dtype)
+
+total_ch = 6
+ch_list = [0, 2, 3]
+
+
+class TestProcessingPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ProcessingPool(2, slots=4, slot_bytes=256*1024)
+        cls.pids = [p.pid for p in cls.pool._procs]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+
+    def buffers(self, n=12, frames_per_buffer=1000):
+        rng = numpy.random.RandomState(1)
+        return [rng.randint(-2**15, 2**15, size=frames_per_buffer*total_ch).astype(numpy.int16)
+                for _ in range(n)]
+
+    def run_pool(self, bufs, **kw):
+        got = []
+        run = self.pool.run(lambda meta, out: got.append((meta, numpy.array(out))),
+                            total_ch, ch_list, len(bufs[0]), numpy.int16, **kw)
+        for i, v in enumerate(bufs):
+            run.submit(v, i)
+        run.close()
+        self.assertEqual(run.error, None)
+        self.assertEqual([m for m, _ in got], list(range(len(bufs))))
+        return numpy.concatenate([o for _, o in got])
+
+    def test_consecutive_runs_reuse_workers(self):
+        bufs = self.buffers()
+        out = self.run_pool(bufs, downsample=10)
+        exp = numpy.concatenate([deinterleave(v, total_ch, ch_list, 10) for v in bufs])
+        numpy.testing.assert_array_equal(out, exp)
+
+        out = self.run_pool(bufs, downsample=10, ds_dtype=numpy.float32,
+                            decimator=Decimator(10, len(ch_list), dtype=numpy.float32))
+        f = select_channels(frames(numpy.concatenate(bufs), total_ch), ch_list)
+        exp = to_dtype(Decimator(10, len(ch_list), dtype=numpy.float32).process(f),
+                       numpy.float32)
+        numpy.testing.assert_array_equal(out, exp)
+
+        self.assertEqual([p.pid for p in self.pool._procs], self.pids)
+        self.assertEqual(self.pool._free.qsize(), len(self.pool._slots))
+
+    def test_terminated_run_frees_slots(self):
+        run = self.pool.run(lambda meta, out: None, total_ch, ch_list, 6000, numpy.int16)
+        for v in self.buffers(3):
+            run.submit(v)
+        run.terminate()
+        self.assertEqual(self.run_pool(self.buffers(2)).shape, (2000, 3))
+        self.assertEqual([p.pid for p in self.pool._procs], self.pids)
+
+if __name__ == '__main__':
+    unittest.main()
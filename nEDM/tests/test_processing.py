@@ -0,0 +1,40 @@
+"""
+  Downsampling of dtacq.processing
+
+  Usage: python -m unittest discover -s tests   (from nEDM)
+"""
+import os
+import sys
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.processing import (Decimator, can_decimate, downsample_filter,
+                              deinterleave)
+
+
+class TestDownsampleFilter(unittest.TestCase):
+    def test_default_is_fir_for_staged_factors(self):
+        for f in (2, 10, 64, 100, 1000):
+            self.assertTrue(can_decimate(f))
+            self.assertEqual(downsample_filter(f), "fir")
+
+    def test_prime_factor_falls_back_to_mean(self):
+        for f in (11, 13, 17, 22):
+            self.assertFalse(can_decimate(f))
+            self.assertEqual(downsample_filter(f), "mean")
+        self.assertRaises(ValueError, Decimator, 11, 2)
+
+    def test_requested_filter_is_kept(self):
+        self.assertEqual(downsample_filter(11, "fir"), "fir")
+        self.assertEqual(downsample_filter(10, "mean"), "mean")
+        self.assertRaises(ValueError, downsample_filter, 10, "median")
+
+    def test_mean_by_11(self):
+        v = numpy.arange(3*33, dtype=numpy.int16)
+        out = deinterleave(v, 3, [0, 2], 11)
+        self.assertEqual(out.shape, (3, 2))
+        self.assertEqual(list(out[:, 0]), [15., 48., 81.])
+
+if __name__ == '__main__':
+    unittest.main()
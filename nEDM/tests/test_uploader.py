@@ -0,0 +1,187 @@
+"""
+  Uploads of dtacq.uploader.FileUploader against a local stand-in of the
+  attachment server.
+
+  Usage: python -m unittest discover -s tests   (from nEDM)
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import types
+import BaseHTTPServer
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dtacq.uploader import FileUploader, UploadJournal
+
+
+class ProcessObject(object):
+    """
+    pynedm's ProcessObject, upload_file sends the whole file in one PUT
+    """
+    def __init__(self, acct):
+        self.acct = acct
+
+    def upload_file(self, fn, doc_id, db):
+        path = "_attachments/{}/{}/{}".format(db, doc_id, os.path.basename(fn))
+        with open(fn, "rb") as f:
+            self.acct.put(path, data=f.read()).raise_for_status()
+        return dict(ok=True, id=doc_id)
+
+# FileUploader._sendWhole imports it from pynedm
+pynedm = types.ModuleType("pynedm")
+pynedm.ProcessObject = ProcessObject
+sys.modules["pynedm"] = pynedm
+
+
+class StandInServer(BaseHTTPServer.HTTPServer):
+    """
+    Keeps attachments in memory.  With ranges, HEAD announces Accept-Ranges
+    and PUTs with Content-Range are appended at their offset, otherwise
+    every PUT replaces the attachment (like CouchDB).  fail_puts PUTs are
+    answered with 500, drop_puts are acknowledged but not stored.
+    """
+    def __init__(self, ranges=True, fail_puts=(), drop_puts=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.ranges = ranges
+        self.fail_puts = set(fail_puts)
+        self.drop_puts = set(drop_puts)
+        self.puts = []
+        self.files = {}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self.server_address[1])
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _answer(self, code, length=0):
+        self.send_response(code)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        if self.path not in self.server.files:
+            return self._answer(404)
+        self._answer(200, len(self.server.files[self.path]))
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        rng = self.headers.get("Content-Range")
+        n = len(self.server.puts)
+        self.server.puts.append(rng)
+        if n in self.server.fail_puts:
+            return self._answer(500)
+        if n in self.server.drop_puts:
+            return self._answer(201)
+        have = self.server.files.get(self.path, b"")
+        if rng is not None and self.server.ranges:
+            start = int(rng.split()[1].split("-")[0])
+            if start != len(have):
+                return self._answer(416)
+            self.server.files[self.path] = have + data
+        else:
+            self.server.files[self.path] = data
+        self._answer(201)
+
+
+class Account(object):
+    """
+    The head and put of cloudant.Account, relative to the server URL
+    """
+    def __init__(self, url):
+        self.url = url
+        self.session = requests.Session()
+
+    def head(self, path):
+        return self.session.head(self.url + path)
+
+    def put(self, path, **kw):
+        return self.session.put(self.url + path, **kw)
+
+
+class TestFileUploader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.dir, "run-0.dig")
+        self.data = os.urandom(10000)
+        with open(self.fn, "wb") as f:
+            f.write(self.data)
+        self.journal = UploadJournal(os.path.join(self.dir, "journal.json"))
+        self.journal.add(self.fn, "doc", "db")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def upload(self, chunked=None, **server_opts):
+        self.server = StandInServer(**server_opts)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        acct = Account(self.server.url)
+
+        class Acct(object):
+            def __enter__(s): return acct, None
+            def __exit__(s, *args): return False
+
+        up = FileUploader(Acct, self.journal, chunk_size=3000,
+                          max_retries=2, retry_delay=0., chunked=chunked)
+        return up._uploadInThread(self.fn)
+
+    def stored(self):
+        return self.server.files.get("/_attachments/db/doc/run-0.dig")
+
+    def test_chunked_resumes_after_failures(self):
+        resp = self.upload(fail_puts=(1, 3))
+        self.assertEqual(resp["type"], "FileUpload")
+        self.assertEqual(self.stored(), self.data)
+        self.assertTrue(all(p is not None for p in self.server.puts))
+        self.assertFalse(os.path.exists(self.fn))
+        self.assertEqual(self.journal.pending(), {})
+
+    def test_whole_file_without_range_support(self):
+        resp = self.upload(ranges=False)
+        self.assertEqual(resp["type"], "FileUpload")
+        self.assertEqual(self.stored(), self.data)
+        self.assertEqual(self.server.puts, [None])
+        self.assertFalse(os.path.exists(self.fn))
+
+    def test_whole_file_not_stored_is_sent_again(self):
+        # Found by the size check after the upload
+        resp = self.upload(ranges=False, drop_puts=(0,))
+        self.assertEqual(resp["type"], "FileUpload")
+        self.assertEqual(self.stored(), self.data)
+        self.assertEqual(self.server.puts, [None, None])
+
+    def test_whole_file_never_stored_keeps_file(self):
+        resp = self.upload(chunked=False, drop_puts=(0, 1, 2))
+        self.assertIn("failed", resp)
+        self.assertTrue(os.path.exists(self.fn))
+        self.assertIn(self.fn, self.journal.pending())
+
+    def test_forced_chunks_to_server_without_ranges_keep_file(self):
+        # Every chunk replaces the attachment, the size check catches it
+        resp = self.upload(chunked=True, ranges=False)
+        self.assertIn("failed", resp)
+        self.assertTrue(os.path.exists(self.fn))
+        self.assertIn(self.fn, self.journal.pending())
+
+    def test_lost_last_chunk_is_sent_again(self):
+        # Found by the size check, the retry continues from the server
+        resp = self.upload(drop_puts=(3,))
+        self.assertEqual(resp["type"], "FileUpload")
+        self.assertEqual(self.stored(), self.data)
+        self.assertEqual(len(self.server.puts), 5)
+
+if __name__ == '__main__':
+    unittest.main()